@@ -42,4 +42,48 @@ headers = {'Authorization': f'Bearer {BUBBLE_API_KEY}'}
 headers_bulk = {'Authorization': f'Bearer {BUBBLE_API_KEY}', 'Content-Type': 'text/plain'}
 interval_aggregate = os.environ.get('interval_aggregate')
 RATE_LIMIT_TIME_WINDOW = os.environ.get('RATE_LIMIT_TIME_WINDOW')
+interval_votes_sync = os.environ.get('interval_votes_sync', 300)
 
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 16))
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 10000))
+INGEST_BATCH_MAX = int(os.environ.get('INGEST_BATCH_MAX', 1000))
+OUTBOX_CONCURRENCY = int(os.environ.get('OUTBOX_CONCURRENCY', 8))
+OUTBOX_TIMEOUT = int(os.environ.get('OUTBOX_TIMEOUT', 30))
+OUTBOX_MAX_BACKOFF = int(os.environ.get('OUTBOX_MAX_BACKOFF', 300))
+RAW_BATCH_SIZE = int(os.environ.get('RAW_BATCH_SIZE', 100))
+RAW_BATCH_AGE = float(os.environ.get('RAW_BATCH_AGE', 2))
+REPLY_WORKERS_PER_GATEWAY = int(os.environ.get('REPLY_WORKERS_PER_GATEWAY', 2))
+REPLY_RATE_SMS = float(os.environ.get('REPLY_RATE_SMS', 5))
+REPLY_RATE_WA = float(os.environ.get('REPLY_RATE_WA', 1))
+REPLY_RATE_LIMITS = os.environ.get('REPLY_RATE_LIMITS')
+REPLY_TIMEOUT = int(os.environ.get('REPLY_TIMEOUT', 30))
+REPLY_RETRIES = int(os.environ.get('REPLY_RETRIES', 3))
+REPLY_MAX_BACKOFF = int(os.environ.get('REPLY_MAX_BACKOFF', 60))
+JOURNAL_FSYNC = os.environ.get('JOURNAL_FSYNC', 'interval')
+JOURNAL_FSYNC_INTERVAL = float(os.environ.get('JOURNAL_FSYNC_INTERVAL', 1))
+JOURNAL_MAX_BYTES = int(os.environ.get('JOURNAL_MAX_BYTES', 64 * 1024 * 1024))
+JOURNAL_INDEX_EVERY = int(os.environ.get('JOURNAL_INDEX_EVERY', 1000))
+DEDUP_CAPACITY = int(os.environ.get('DEDUP_CAPACITY', 100000))
+DEDUP_WINDOW = int(os.environ.get('DEDUP_WINDOW', 86400))
+GATEWAY_SYNC_INTERVAL = int(os.environ.get('GATEWAY_SYNC_INTERVAL', 10))
+SCTO_CURSOR_OVERLAP = int(os.environ.get('SCTO_CURSOR_OVERLAP', 300))
+SCTO_MAX_ATTEMPTS = int(os.environ.get('SCTO_MAX_ATTEMPTS', 5))
+SCTO_POLL_MIN = int(os.environ.get('SCTO_POLL_MIN', 15))
+SCTO_POLL_MAX = int(os.environ.get('SCTO_POLL_MAX', 300))
+SCTO_POLL_WORKERS = int(os.environ.get('SCTO_POLL_WORKERS', 4))
+SCTO_WORKERS = int(os.environ.get('SCTO_WORKERS', 16))
+SCTO_GPS_DISTANCE = os.environ.get('SCTO_GPS_DISTANCE', 'false').lower() == 'true'
+GEODATA_CACHE = os.environ.get('GEODATA_CACHE', f'{local_disk}/geodata')
+REGION_MATCH_CACHE = int(os.environ.get('REGION_MATCH_CACHE', 100000))
+REGION_MATCH_SHORTLIST = int(os.environ.get('REGION_MATCH_SHORTLIST', 40))
+REGION_WORKERS = int(os.environ.get('REGION_WORKERS', os.cpu_count() or 1))
+REGION_POOL_MIN = int(os.environ.get('REGION_POOL_MIN', 200))
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 100))
+BULK_CONCURRENCY = int(os.environ.get('BULK_CONCURRENCY', 4))
+BULK_MAX_CONCURRENCY = int(os.environ.get('BULK_MAX_CONCURRENCY', 16))
+BULK_RETRIES = int(os.environ.get('BULK_RETRIES', 5))
+UID_FETCH_WORKERS = int(os.environ.get('UID_FETCH_WORKERS', 8))
+XLSFORM_WORKERS = int(os.environ.get('XLSFORM_WORKERS', 2))
+JOB_STALE = int(os.environ.get('JOB_STALE', 600))
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 7 * 86400))
+WARMUP_STEPS = os.environ.get('WARMUP_STEPS', 'events,geodata').split(',')
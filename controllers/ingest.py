@@ -0,0 +1,296 @@
+import json
+import asyncio
+from datetime import datetime
+from functools import partial
+from fastapi import Request, HTTPException
+
+from config.config import *
+from utils.outbox import enqueue_write
+from utils.rawlog import log_raw
+from utils.registry import get_event
+from utils.journal import sms_journal, wa_journal
+from utils.pipeline import ingest_executor, ingest_offsets, ingest_offsets_lock, set_offset, submit_message
+from utils.message import check_message, split_message, MSG_UNRECOGNIZED
+from utils.dispatcher import send_sms_reply, send_wa_reply
+from utils.dedup import check_duplicates, commit_messages, forget_messages, message_key
+from utils.gateway_health import record_echo
+from utils.votes_store import get_votes_row, prefetch_votes, record_votes_write
+
+
+
+# What differs between the SMS and WhatsApp channels (ports: the gateway ports with a receive endpoint)
+CHANNELS = {
+    'sms': {
+        'label': 'SMS',
+        'ports': range(1, 5),
+        'reply': send_sms_reply,
+        'journal': sms_journal,
+        'gateway_table': 'GatewayCheckSMS',
+        'raw_table': 'RAW_SMS',
+        'raw_id': 'SMS ID',
+    },
+    'wa': {
+        'label': 'WhatsApp',
+        'ports': range(1, len(list_WhatsApp_Gateway) + 1),
+        'reply': send_wa_reply,
+        'journal': wa_journal,
+        'gateway_table': 'GatewayCheckWA',
+        'raw_table': 'RAW_WhatsApp',
+        'raw_id': 'WA ID',
+    },
+}
+
+
+
+def upsert_votes(result, event_data, raw_data):
+    """
+    Update the Votes row of an accepted message in the Bubble database (through the outbox).
+    """
+    uid, event = result['uid'], result['event']
+    votes, invalid, total_votes = result['votes'], result['invalid'], result['total']
+    receive_date = raw_data['Receive Date']
+    data = get_votes_row(event, uid)
+    if data is None:
+        raise ValueError(f'UID {uid} has no Votes row in event {event}')
+
+    validator = data.get('Validator', None)
+    scto = data['SCTO']
+    status = 'Verified' if scto and votes == [int(v) for v in data['SCTO Votes']] and invalid == int(data['SCTO Invalid']) else 'Not Verified' if scto else 'SMS Only'
+    hour = datetime.strptime(receive_date, "%Y-%m-%d %H:%M:%S").hour
+    delta_time_hours = (datetime.strptime(data['SCTO Timestamp'], "%Y-%m-%dT%H:%M:%S.%fZ") - datetime.strptime(receive_date, "%Y-%m-%d %H:%M:%S")).total_seconds() / 3600 if 'SCTO Timestamp' in data else None
+
+    payload = {
+        'Active': True,
+        'SMS': True,
+        'SMS Int': 1,
+        'UID': uid.upper(),
+        'SMS Gateway Port': raw_data['Gateway Port'],
+        'SMS Gateway ID': raw_data['Gateway ID'],
+        'SMS Sender': raw_data['Sender'],
+        'SMS Timestamp': receive_date,
+        'SMS Hour': hour,
+        'Event ID': event,
+        'SMS Votes': votes,
+        'SMS Invalid': invalid,
+        'Vote1': votes[0] if len(votes) > 0 else None,
+        'Vote2': votes[1] if len(votes) > 1 else None,
+        'Vote3': votes[2] if len(votes) > 2 else None,
+        'Vote4': votes[3] if len(votes) > 3 else None,
+        'Vote5': votes[4] if len(votes) > 4 else None,
+        'Vote6': votes[5] if len(votes) > 5 else None,
+        'Total Votes': total_votes,
+        'Final Votes': votes,
+        'Invalid Votes': invalid,
+        'Complete': scto,
+        'Status': status,
+        'Delta Time': delta_time_hours,
+        'Validator': validator
+    }
+
+    url_votes = f"{url_bubble}/votes/{event_data['uid_dict'][uid.upper()]}"
+    enqueue_write('PATCH', url_votes, payload, coalesce_key=url_votes)
+    record_votes_write(event, uid, payload)
+
+
+
+def validate_message(channel, info):
+    """
+    Validate a split KK# message. Unknown events, unparsable fields and
+    other unexpected errors become error type 1.
+    """
+    try:
+        event_data = get_event(info[2])
+        return check_message(event_data['spec'], info, event_data['uids']), event_data
+    except Exception as e:
+        print(f"Error Location: {CHANNELS[channel]['label']} - Error Type 1, keyword: {e}")
+        return {'error_type': 1, 'message': MSG_UNRECOGNIZED}, None
+
+
+
+def update_gateway_status(channel, raw_data):
+    """
+    Handles the 'the gateway is active' message: records the gateway as seen (with the round-trip
+    latency of its probe). The status is written to the Bubble database by the gateway health sync.
+    """
+    record_echo(channel, raw_data['Gateway ID'], raw_data['Gateway Port'], raw_data['Receive Date'])
+
+
+
+def process_message(channel, raw_data, checked=None):
+    """
+    Processes a received SMS or WhatsApp message: validates it, updates the Bubble database,
+    replies to the sender and logs the raw message.
+    `checked` is the result of `validate_message` when the message was already validated (batch ingest).
+    """
+    config = CHANNELS[channel]
+    msg = raw_data['Message']
+
+    # Split message and remove spaces
+    info = split_message(msg)
+
+    # Default Values
+    error_type = None
+    raw_status = 'Rejected'
+
+    # Check Error Type 1 (prefix)
+    if info[0] == 'kk':
+        result, event_data = checked or validate_message(channel, info)
+        error_type = result['error_type']
+        message = result['message']
+        if error_type is None:
+            try:
+                upsert_votes(result, event_data, raw_data)
+                raw_status = 'Accepted'
+            except Exception as e:
+                error_type = 1
+                message = MSG_UNRECOGNIZED
+                print(f"Error Location: {config['label']} - Error Type 1, keyword: {e}")
+
+        # Return the message to the sender via SMS Masking / WhatsApp Gateway
+        config['reply'](raw_data['Gateway Port'], raw_data['Sender'], message)
+
+    elif msg == 'the gateway is active':
+        update_gateway_status(channel, raw_data)
+        raw_status = 'Check Gateway'
+
+    else:
+        error_type = 0
+
+    # Payload (RAW SMS / RAW WhatsApp)
+    payload_raw = {
+        config['raw_id']: raw_data['ID'],
+        'Receive Date': raw_data['Receive Date'],
+        'Sender': raw_data['Sender'],
+        'Gateway Port': raw_data['Gateway Port'],
+        'Gateway ID': raw_data['Gateway ID'],
+        'Message': msg,
+        'Error Type': error_type,
+        'Status': raw_status
+    }
+
+    # Forward data to Bubble database (Raw SMS / Raw WhatsApp), inserted in bulk through the outbox
+    log_raw(config['raw_table'], payload_raw, [config['raw_id'], 'Gateway ID'])
+
+
+
+def validate_batch(messages):
+    """
+    Validate a batch of (channel, raw data) messages in one pass.
+    The Votes rows of accepted messages are looked up in Bubble together, grouped per event.
+    Returns the validation result of each KK# message (None for other messages).
+    """
+    checked = []
+    uids_per_event = {}
+    for channel, raw_data in messages:
+        info = split_message(raw_data['Message'])
+        if info[0] != 'kk':
+            checked.append(None)
+            continue
+        result, event_data = validate_message(channel, info)
+        checked.append((result, event_data))
+        if result['error_type'] is None:
+            uids_per_event.setdefault(result['event'], set()).add(result['uid'])
+
+    for event, uids in uids_per_event.items():
+        try:
+            prefetch_votes(event, uids)
+        except Exception as e:
+            print(f'Process: batch ingest prefetch {event}\t Keyword: {e}')
+    return checked
+
+
+
+async def receive_batch(request: Request):
+    """
+    Receives a batch of SMS and WhatsApp messages buffered by a gateway, as a JSON array or NDJSON.
+
+    Each message has the fields of the single-message endpoints plus its channel and port:
+    {"channel": "sms" | "wa", "port": 1, "id": ..., "gateway_number": ..., "originator": ..., "msg": ..., "receive_date": ...}
+
+    Messages are deduplicated, logged to the inbox journals and validated in one pass, then handed over
+    to the ingest pipeline. Returns the status, error type and reply of each message, in order;
+    messages with an unknown channel or a port without a receive endpoint are reported as Invalid.
+    A batch holds at most INGEST_BATCH_MAX messages.
+    """
+    body = (await request.body()).decode('utf-8').strip()
+    try:
+        items = json.loads(body) if body.startswith('[') else [json.loads(line) for line in body.splitlines() if line.strip()]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f'Invalid JSON: {e}')
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail='Expected a JSON array or NDJSON')
+    if len(items) > INGEST_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f'{len(items)} messages, a batch holds at most {INGEST_BATCH_MAX}')
+
+    results = [None] * len(items)
+    received = []
+    for i, item in enumerate(items):
+        try:
+            channel = item['channel']
+            raw_data = {
+                "ID": str(item['id']),
+                "Gateway Port": str(item['port']),
+                "Gateway ID": str(item['gateway_number']),
+                "Sender": str(item['originator']),
+                "Message": str(item['msg']),
+                "Receive Date": str(item['receive_date'])
+            }
+        except (KeyError, TypeError) as e:
+            results[i] = {'status': 'Invalid', 'detail': f'Missing field {e}'}
+            continue
+        if channel not in CHANNELS:
+            results[i] = {'id': raw_data['ID'], 'status': 'Invalid', 'detail': f'Unknown channel {channel}'}
+            continue
+        if not raw_data['Gateway Port'].isdigit() or int(raw_data['Gateway Port']) not in CHANNELS[channel]['ports']:
+            results[i] = {'id': raw_data['ID'], 'status': 'Invalid', 'detail': f"Unknown {CHANNELS[channel]['label']} port {raw_data['Gateway Port']}"}
+            continue
+        received.append((i, channel, raw_data, message_key(channel, raw_data['Gateway ID'], raw_data['ID'])))
+
+    # Acknowledge gateway retries of messages we already received
+    duplicates = await check_duplicates([key for _, _, _, key in received])
+    for (i, _, raw_data, _), duplicate in zip(received, duplicates):
+        if duplicate:
+            results[i] = {'id': raw_data['ID'], 'status': 'Duplicate'}
+    received = [message for message, duplicate in zip(received, duplicates) if not duplicate]
+
+    # Log the received data to the inbox journals, in one group commit per journal
+    logged = await asyncio.gather(*[CHANNELS[channel]['journal'].write(raw_data) for _, channel, raw_data, _ in received], return_exceptions=True)
+    await forget_messages([key for (_, _, _, key), seq in zip(received, logged) if isinstance(seq, Exception)])
+    await commit_messages([key for (_, _, _, key), seq in zip(received, logged) if not isinstance(seq, Exception)])
+    for (i, _, raw_data, key), seq in zip(received, logged):
+        if isinstance(seq, Exception):
+            results[i] = {'id': raw_data['ID'], 'status': 'Error', 'detail': str(seq)}
+    seqs = [seq for seq in logged if not isinstance(seq, Exception)]
+    received = [message for message, seq in zip(received, logged) if not isinstance(seq, Exception)]
+
+    # Validate the whole batch off the event loop, then hand the messages over to the pipeline
+    loop = asyncio.get_event_loop()
+    checked = await loop.run_in_executor(ingest_executor, validate_batch, [(channel, raw_data) for _, channel, raw_data, _ in received])
+    for (i, channel, raw_data, _), seq, check in zip(received, seqs, checked):
+        await submit_message(partial(process_message, channel, checked=check), raw_data, source=(CHANNELS[channel]['journal'].name, seq))
+        results[i] = {'id': raw_data['ID'], 'status': 'Received'}
+        if check:
+            results[i].update(error_type=check[0]['error_type'], reply=check[0]['message'])
+
+    return {'results': results}
+
+
+
+async def replay_inbox():
+    """
+    Hand the inbox records received after the last processed one (queued but not processed when the
+    server stopped) over to the pipeline again. On the first start, the journals' ends become the offsets.
+    """
+    loop = asyncio.get_event_loop()
+    for channel, config in CHANNELS.items():
+        journal = config['journal']
+        with ingest_offsets_lock:
+            offset = ingest_offsets.get(journal.name)
+        if offset is None:
+            set_offset(journal.name, await loop.run_in_executor(None, journal.next_seq))
+            continue
+        records = await loop.run_in_executor(None, lambda: list(journal.read(journal.snapshot(), offset)))
+        if records:
+            print(f'Process: replay {journal.name}\t {len(records)} unprocessed messages from {offset}')
+        for seq, raw_data in records:
+            await submit_message(partial(process_message, channel), raw_data, source=(journal.name, seq))
@@ -1,6 +1,5 @@
 import json
 import time
-import pandas as pd
 from typing import List
 from fastapi import Request, HTTPException
 
@@ -8,6 +7,7 @@ from pydantic import BaseModel
 
 
 from config.config import *
+from utils.lazy import pd
 
 # Dictionary to store request timestamps for rate limiting
 request_timestamps = {}
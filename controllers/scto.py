@@ -1,14 +1,27 @@
-import json
-import requests
-import numpy as np
-from fastapi import Form
+import time
+from fastapi import Form, Query, HTTPException
 from datetime import datetime, timedelta
-from pysurveycto import SurveyCTOObject
 from concurrent.futures import ThreadPoolExecutor
 
 from utils.utils import *
 from config.config import *
 from utils.preprocess import *
+from utils.outbox import enqueue_write
+from utils.scto_cursor import *
+from utils.lazy import geodata, pysurveycto
+from utils.registry import get_event
+from utils.votes_store import get_votes_row, record_votes_write
+from utils.jobs import create_job, run_job, set_job_stage, record_job_item
+
+
+
+
+# SurveyCTO client shared by all syncs and OCR reads (created on first use)
+scto_client = None
+
+# Bounded worker pools: form syncs (fetch and bookkeeping), and the submissions they process
+scto_sync_executor = ThreadPoolExecutor(max_workers=SCTO_POLL_WORKERS, thread_name_prefix='scto-sync')
+scto_executor = ThreadPoolExecutor(max_workers=SCTO_WORKERS, thread_name_prefix='scto')
 
 
 
@@ -23,123 +36,345 @@ def scto_data(
     input_time: datetime = Form(...), 
     proc_id_a4: str = Form(None),
 ):
+    """
+    Fetches new and changed submissions of a form from SurveyCTO and processes them.
+
+    A sync cursor per form (last SubmissionDate and processed KEYs with a fingerprint) is kept on the
+    local disk, so submissions already processed are skipped before any network call. Syncs of the
+    same form run one at a time.
+
+    The sync runs in the background: returns a job id right away. GET /jobs/{job_id} reports the
+    progress, failed submissions, timings and finally the number of fetched, new, changed, skipped,
+    processed and failed submissions.
+    """
     print(f'\nEvent: {event}\t Input Time: {input_time}')
+    params = {'event': event, 'form_id': form_id, 'n_candidate': n_candidate, 'input_time': input_time, 'proc_id_a4': proc_id_a4}
+    job_id = create_job('scto_data', params)
+    run_job(scto_sync_executor, job_id, sync_form, event, form_id, n_candidate, input_time, proc_id_a4)
+    return {'job_id': job_id}
+
+
+
+
+
+
+def get_scto_client():
+    """
+    Return the shared SurveyCTO client, creating it on first use.
+    """
+    global scto_client
+    if scto_client is None:
+        scto_client = pysurveycto.SurveyCTOObject(SCTO_SERVER_NAME, SCTO_USER_NAME, SCTO_PASSWORD)
+    return scto_client
+
+
+
+
+
+
+def sync_form(event, form_id, n_candidate, input_time, proc_id_a4=None, blocking=True, job_id=None):
+    """
+    Sync a form from its cursor (see `scto_data`). With blocking=False, returns None right away
+    when a sync of the same form is already running. Progress is reported to `job_id` when given.
+    """
+    counts = {'fetched': 0, 'new': 0, 'changed': 0, 'skipped': 0, 'processed': 0, 'failed': 0, 'given_up': 0}
+
+    lock = form_lock(form_id)
+    if not lock.acquire(blocking=blocking):
+        return None
 
     try:
-        # Calculate the oldest completion date based on the current time
-        date_obj = input_time - timedelta(seconds=301)
+        set_job_stage(job_id, 'fetch')
+        cursor = load_cursor(form_id)
 
-        # Build SCTO connection
-        scto = SurveyCTOObject(SCTO_SERVER_NAME, SCTO_USER_NAME, SCTO_PASSWORD)
+        # Calculate the oldest completion date from the sync cursor (or the input time on the first sync)
+        date_obj = fetch_window_start(cursor, input_time)
 
         # Retrieve data from SCTO
-        list_data = scto.get_form_data(form_id, format='json', shape='wide', oldest_completion_date=date_obj)
+        list_data = get_scto_client().get_form_data(form_id, format='json', shape='wide', oldest_completion_date=date_obj)
+        counts['fetched'] = len(list_data)
+
+        # Keep only new or changed submissions
+        todo = []
+        for data in list_data:
+            fingerprint = submission_fingerprint(data)
+            seen = cursor['processed'].get(data['KEY'])
+            if seen and seen[0] == fingerprint:
+                counts['skipped'] += 1
+                continue
+            if given_up(cursor, data['KEY'], fingerprint):
+                counts['given_up'] += 1
+                continue
+            counts['changed' if seen else 'new'] += 1
+            todo.append((data, fingerprint))
+
+        # Verify the whole pull against the expected polygons of the UIDs in one call
+        set_job_stage(job_id, 'geocode')
+        expected = get_event(event)['expected']
+        locations = geodata.verify_locations(
+            [submission_coordinate(data) for data, _ in todo],
+            [expected.get(str(data.get('UID', '')).upper()) for data, _ in todo]
+        )
 
         # Loop over data
-        if len(list_data) > 0:
-            with ThreadPoolExecutor() as executor:
-                for data in list_data:
-                    # Run 'scto_process' function asynchronously
-                    executor.submit(scto_process, data, event, n_candidate, proc_id_a4)
-    
+        set_job_stage(job_id, 'process', total=len(todo))
+        if len(todo) > 0:
+            # Run 'scto_process' in the shared worker pool
+            results = list(scto_executor.map(
+                lambda item: run_scto_process(item[0][0], event, n_candidate, proc_id_a4, job_id, gps=item[1]),
+                zip(todo, locations)
+            ))
+
+            # Advance the cursor over the submissions processed successfully. Failed ones are recorded and
+            # retried on the next syncs (the cursor stays before them) until SCTO_MAX_ATTEMPTS attempts
+            for (data, fingerprint), error in zip(todo, results):
+                if error is None:
+                    counts['processed'] += 1
+                    completed = completion_date(data)
+                    cursor['processed'][data['KEY']] = [fingerprint, completed]
+                    cursor['failed'].pop(data['KEY'], None)
+                    cursor['last_completion'] = max(cursor['last_completion'] or completed, completed)
+                else:
+                    counts['failed'] += 1
+                    record_failure(cursor, data, fingerprint, error)
+            save_cursor(form_id, cursor)
+
     except Exception as e:
         print(f'Process: scto_data endpoint\t Keyword: {e}\n')
+        counts['error'] = str(e)
+        if job_id is not None:
+            raise
 
+    finally:
+        lock.release()
 
+    return counts
 
 
 
 
-def scto_process(data, event, n_candidate, proc_id_a4):
+
+
+def poll_form(form):
     """
-    Process SCTO data and update the Bubble server.
+    Poll one registered form and schedule its next poll: sooner when new or changed
+    submissions came in, later when none did.
+    """
+    input_time = datetime.fromisoformat(form['registered'])
+    counts = sync_form(form['event'], form['form_id'], form['n_candidate'], input_time, form['proc_id_a4'], blocking=False)
+    if counts is None:
+        return
+    interval = next_interval(form['interval'], counts['new'] + counts['changed'])
+    update_form(
+        form['form_id'],
+        create=False,
+        interval=interval,
+        last_poll=datetime.utcnow().isoformat(),
+        next_poll=(datetime.utcnow() + timedelta(seconds=interval)).isoformat(),
+        last_counts=counts,
+    )
+
+
+
+# Register a form with the built-in poller
+def register_scto_form(
+    event: str = Form(...),
+    form_id: str = Form(...),
+    n_candidate: int = Form(...),
+    input_time: datetime = Form(None),
+    proc_id_a4: str = Form(None),
+):
+    """
+    Adds (or updates) a form polled by the built-in SurveyCTO poller. `input_time` (UTC) sets
+    the fetch window of the first sync and defaults to now.
+    """
+    now = datetime.utcnow()
+    return update_form(
+        form_id,
+        event=event,
+        form_id=form_id,
+        n_candidate=n_candidate,
+        proc_id_a4=proc_id_a4,
+        registered=(input_time or now).isoformat(),
+        interval=SCTO_POLL_MIN,
+        next_poll=now.isoformat(),
+    )
+
+
+
+# Remove a form from the built-in poller
+def unregister_scto_form(form_id: str = Form(...)):
+    """
+    Stops polling a form. Its sync cursor is kept.
+    """
+    return {'form_id': form_id, 'removed': unregister_form(form_id) is not None}
+
+
+
+# List the forms polled by the built-in poller
+async def list_scto_forms():
+    with scto_forms_lock:
+        return load_forms()
+
+
+
+def list_scto_failed(form_id: str = Query(...)):
+    """
+    Lists the submissions of a form that failed to process, oldest first, with their error and attempts.
+    Submissions with SCTO_MAX_ATTEMPTS attempts are given up (until they change, or are requeued).
+    """
+    with form_lock(form_id):
+        failed = load_cursor(form_id)['failed']
+    submissions = [dict(key=key, given_up=failure['attempts'] >= SCTO_MAX_ATTEMPTS, **failure) for key, failure in failed.items()]
+    submissions.sort(key=lambda submission: submission['completed'])
+    return {'form_id': form_id, 'count': len(submissions), 'submissions': submissions}
+
+
+
+def requeue_scto_failed(form_id: str = Form(...), keys: str = Form(None)):
+    """
+    Processes failed submissions of a form again on its next sync: the given comma-separated KEYs, or all failed submissions.
+    The cursor moves back to the oldest of them, so submissions completed since that were no longer tracked are processed again too.
+    """
+    with form_lock(form_id):
+        cursor = load_cursor(form_id)
+        requeued = [key for key in cursor['failed'] if not keys or key in keys.split(',')]
+        if keys and not requeued:
+            raise HTTPException(status_code=404, detail=f'No failed submission {keys} in form {form_id}')
+        for key in requeued:
+            cursor['failed'][key]['attempts'] = 0
+        save_cursor(form_id, cursor)
+    return {'form_id': form_id, 'requeued': len(requeued)}
+
+
+
+
+
+
+def submission_coordinate(data):
+    """
+    Return the (longitude, latitude) of a submission's 'koordinat' field, or None when missing or malformed.
     """
-    event = event.lower()
     try:
-        uid = data['UID']
-        std_datetime = datetime.strptime(data['SubmissionDate'], "%b %d, %Y %I:%M:%S %p") + timedelta(hours=7)
-        filter_params = [
-            {"key": "UID", "constraint_type": "equals", "value": uid},
-            {"key": "Event ID", "constraint_type": "equals", "value": event}
-        ]
-        res_bubble = requests.get(f'{url_bubble}/Votes', headers=headers, params={"constraints": json.dumps(filter_params)})
-        data_bubble = res_bubble.json()['response']['results'][0]
-        
-        validator = data_bubble.get('Validator')
-        sms_timestamp = data_bubble.get('SMS Timestamp')
-        delta_time_hours = None
-        if sms_timestamp:
-            delta_time = abs(std_datetime - datetime.strptime(sms_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ"))
-            delta_time_hours = delta_time.total_seconds() / 3600
-        
-        coordinate = np.array(data['koordinat'].split(' ')[1::-1]).astype(float)
-        loc = get_location(coordinate)
-        key = data['KEY'].split('uuid:')[-1]
-        link = f"https://{SCTO_SERVER_NAME}.surveycto.com/view/submission.html?uuid=uuid%3A{key}"
-        formulir_c1_a4 = data['formulir_c1_a4']
-        formulir_c1_plano = data['formulir_c1_plano']
-        selfie = data['selfie']
-
-        if proc_id_a4:
-            try:
-                attachment_url = data['formulir_c1_a4']
-                scto = SurveyCTOObject(SCTO_SERVER_NAME, SCTO_USER_NAME, SCTO_PASSWORD)
-                deviceid = data['deviceid']
-                ai_votes, ai_invalid = read_form(scto, attachment_url, n_candidate, proc_id_a4, deviceid)
-            except Exception as e:
-                print(f'Process: scto_process endpoint\t Keyword: {e}\n')
-                ai_votes = [0] * n_candidate
-                ai_invalid = 0
-        else:
-            ai_votes = [0] * n_candidate
-            ai_invalid = 0
-        
-        sms = data_bubble['SMS']
-        status = 'Not Verified' if sms else 'SCTO Only'
-        
-        gps_status = 'Verified' if all(data_bubble[k] == loc[k] for k in ['Provinsi', 'Kab/Kota', 'Kecamatan', 'Kelurahan']) else 'Not Verified'
-        
-        payload = {
-            'Active': True,
-            'Complete': sms,
-            'UID': uid,
-            'Event ID': event,
-            'SCTO TPS': data['no_tps'],
-            'SCTO Dapil': data['dapil'],
-            'SCTO Address': data['alamat'],
-            'SCTO RT': data['rt'],
-            'SCTO RW': data['rw'],
-            'SCTO': True,
-            'SCTO Int': 1,
-            'SCTO Enum Name': data['nama'],
-            'SCTO Enum Phone': data['no_hp'],
-            'SCTO Timestamp': std_datetime,
-            'SCTO Hour': std_datetime.hour,
-            'SCTO Provinsi': data['selected_provinsi'].replace('_', ' '),
-            'SCTO Kab/Kota': data['selected_kabkota'].replace('_', ' '),
-            'SCTO Kecamatan': data['selected_kecamatan'].replace('_', ' '),
-            'SCTO Kelurahan': data['selected_kelurahan'].replace('_', ' '),
-            'SCTO Votes': ai_votes,
-            'SCTO Invalid': ai_invalid,
-            'SCTO C1 A4': formulir_c1_a4,
-            'SCTO C1 Plano': formulir_c1_plano,
-            'SCTO Selfie': selfie,
-            'GPS Provinsi': loc['Provinsi'],
-            'GPS Kab/Kota': loc['Kab/Kota'],
-            'GPS Kecamatan': loc['Kecamatan'],
-            'GPS Kelurahan': loc['Kelurahan'],
-            'GPS Status': gps_status,
-            'Delta Time': delta_time_hours,
-            'Status': status,
-            'Survey Link': link,
-            'Validator': validator
-        }
-        
-        with open(f'{local_disk}/uid_{event}.json', 'r') as json_file:
-            uid_dict = json.load(json_file)
-        _id = uid_dict[uid.upper()]
-        out = requests.patch(f'{url_bubble}/votes/{_id}', headers=headers, data=payload)
-        print(out)
+        return [float(v) for v in data['koordinat'].split(' ')[1::-1]]
+    except (KeyError, AttributeError, ValueError):
+        return None
+
+
+
+
+
+
+def run_scto_process(data, event, n_candidate, proc_id_a4, job_id=None, gps=None):
+    """
+    Run `scto_process` on one submission, reporting its duration and error to the job.
+    Returns the error, or None when the submission was processed successfully.
+    """
+    start = time.time()
+    error = None
+    try:
+        scto_process(data, event, n_candidate, proc_id_a4, gps)
     except Exception as e:
         with print_lock:
-            print(f'Process: scto_process\t Keyword: {e}')
\ No newline at end of file
+            print(f'Process: scto_process\t Keyword: {e}')
+        error = str(e)
+    record_job_item(job_id, data.get('KEY'), time.time() - start, error)
+    return error
+
+
+
+
+
+
+def scto_process(data, event, n_candidate, proc_id_a4, gps=None):
+    """
+    Process SCTO data and update the Bubble server. `gps` is the (location, GPS status, distance)
+    of the submission's coordinate when already verified (see `verify_locations`).
+    Raises when the submission cannot be processed.
+    """
+    event = event.lower()
+    uid = data['UID']
+    std_datetime = datetime.strptime(data['SubmissionDate'], "%b %d, %Y %I:%M:%S %p") + timedelta(hours=7)
+    data_bubble = get_votes_row(event, uid)
+    if data_bubble is None:
+        raise ValueError(f'UID {uid} has no Votes row in event {event}')
+    
+    validator = data_bubble.get('Validator')
+    sms_timestamp = data_bubble.get('SMS Timestamp')
+    delta_time_hours = None
+    if sms_timestamp:
+        delta_time = abs(std_datetime - datetime.strptime(sms_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ"))
+        delta_time_hours = delta_time.total_seconds() / 3600
+    
+    if gps is None:
+        coordinate = [float(v) for v in data['koordinat'].split(' ')[1::-1]]
+        gps = geodata.verify_locations([coordinate], [[data_bubble[k] for k in geodata.REGION_FIELDS]])[0]
+    loc, gps_status, gps_distance = gps
+    if loc is None:
+        raise ValueError(f"No region contains coordinate {data['koordinat']}")
+    key = data['KEY'].split('uuid:')[-1]
+    link = f"https://{SCTO_SERVER_NAME}.surveycto.com/view/submission.html?uuid=uuid%3A{key}"
+    formulir_c1_a4 = data['formulir_c1_a4']
+    formulir_c1_plano = data['formulir_c1_plano']
+    selfie = data['selfie']
+
+    if proc_id_a4:
+        try:
+            attachment_url = data['formulir_c1_a4']
+            deviceid = data['deviceid']
+            ai_votes, ai_invalid = read_form(get_scto_client(), attachment_url, n_candidate, proc_id_a4, deviceid)
+        except Exception as e:
+            print(f'Process: scto_process endpoint\t Keyword: {e}\n')
+            ai_votes = [0] * n_candidate
+            ai_invalid = 0
+    else:
+        ai_votes = [0] * n_candidate
+        ai_invalid = 0
+    
+    sms = data_bubble['SMS']
+    status = 'Not Verified' if sms else 'SCTO Only'
+    
+    payload = {
+        'Active': True,
+        'Complete': sms,
+        'UID': uid,
+        'Event ID': event,
+        'SCTO TPS': data['no_tps'],
+        'SCTO Dapil': data['dapil'],
+        'SCTO Address': data['alamat'],
+        'SCTO RT': data['rt'],
+        'SCTO RW': data['rw'],
+        'SCTO': True,
+        'SCTO Int': 1,
+        'SCTO Enum Name': data['nama'],
+        'SCTO Enum Phone': data['no_hp'],
+        'SCTO Timestamp': std_datetime,
+        'SCTO Hour': std_datetime.hour,
+        'SCTO Provinsi': data['selected_provinsi'].replace('_', ' '),
+        'SCTO Kab/Kota': data['selected_kabkota'].replace('_', ' '),
+        'SCTO Kecamatan': data['selected_kecamatan'].replace('_', ' '),
+        'SCTO Kelurahan': data['selected_kelurahan'].replace('_', ' '),
+        'SCTO Votes': ai_votes,
+        'SCTO Invalid': ai_invalid,
+        'SCTO C1 A4': formulir_c1_a4,
+        'SCTO C1 Plano': formulir_c1_plano,
+        'SCTO Selfie': selfie,
+        'GPS Provinsi': loc['Provinsi'],
+        'GPS Kab/Kota': loc['Kab/Kota'],
+        'GPS Kecamatan': loc['Kecamatan'],
+        'GPS Kelurahan': loc['Kelurahan'],
+        'GPS Status': gps_status,
+        'Delta Time': delta_time_hours,
+        'Status': status,
+        'Survey Link': link,
+        'Validator': validator
+    }
+    
+    # Only sent when enabled: Bubble rejects the whole update (dropped by the outbox) if the Votes table lacks the field
+    if SCTO_GPS_DISTANCE:
+        payload['GPS Distance'] = gps_distance
+
+    _id = get_event(event)['uid_dict'][uid.upper()]
+    url_votes = f'{url_bubble}/votes/{_id}'
+    enqueue_write('PATCH', url_votes, payload, coalesce_key=url_votes)
+    record_votes_write(event, uid, payload)
\ No newline at end of file
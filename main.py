@@ -1,14 +1,28 @@
 import time
 import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI
 from collections import defaultdict
 from fastapi.middleware.cors import CORSMiddleware
 
 from utils.utils import *
+from utils.outbox import *
+from utils.dedup import *
+from utils.gateway_health import *
+from utils.pipeline import *
+from utils.dispatcher import *
+from utils.rawlog import *
+from utils.journal import *
+from utils.jobs import *
+from utils.warmup import *
+from utils.region_alias import *
+from utils.votes_store import *
 from utils.preprocess import *
 from utils.postprocess import *
 from config.config import *
 from controllers.sms import *
+from controllers.ingest import *
 from controllers.scto import *
 from controllers.media import *
 from controllers.whatsapp import *
@@ -39,33 +53,49 @@ request_timestamps = defaultdict(float)
 # Endpoints
 
 # GET
+app.get("/healthz")(liveness)
+app.get("/readyz")(readiness)
 app.get("/wa_inbox")(read_wa_inbox)
 app.get("/sms_inbox")(read_sms_inbox)
+app.get("/ingest_status")(ingest_status)
+app.get("/outbox_status")(outbox_status)
+app.get("/outbox_failed")(list_failed_writes)
+app.get("/reply_stats")(reply_stats)
+app.get("/dedup_stats")(dedup_stats)
+app.get("/gateway_health")(gateway_health_status)
+app.get("/scto_forms")(list_scto_forms)
+app.get("/scto_failed")(list_scto_failed)
+app.get("/jobs/{job_id}")(get_job_status)
+app.get("/jobs/{job_id}/download")(download_job_file)
+app.get("/region_aliases")(list_region_aliases)
 app.get("/api/quickcount_kedaikopi")(quickcount_kedaikopi)
 
 # POST
 app.post("/getUID")(get_uid)
 app.post("/scto_data")(scto_data)
+app.post("/scto_forms/register")(register_scto_form)
+app.post("/scto_forms/unregister")(unregister_scto_form)
+app.post("/scto_failed/requeue")(requeue_scto_failed)
 app.post("/delete_event")(delete_event)
 app.post("/generate_xlsform")(generate_xlsform)
 app.post("/receive_media_info")(receive_media_info)
 app.post("/create_json_ncandidate")(create_json_ncandidate)
 app.post("/check_gateway_status_sms")(check_gateway_status_sms)
+app.post("/batch-receive")(receive_batch)
+app.post("/outbox_failed/requeue")(requeue_failed_writes)
+app.post("/region_aliases")(set_region_alias)
+app.post("/region_aliases/delete")(delete_region_alias)
 
 
 
 
 
-# Define the number of endpoints
-num_sms_endpoints = 4
-num_whatsapp_endpoints = 16
-
 # Endpoint to receive SMS message, to validate, and to forward the pre-processed data
-for port in range(1, num_sms_endpoints + 1):
+for port in CHANNELS['sms']['ports']:
     app.post(f"/sms-receive-{port}")(receive_sms)
 
 # Endpoint to receive WhatsApp message, to validate, and to forward the pre-processed data
-for port in range(1, num_whatsapp_endpoints + 1):
+for port in CHANNELS['wa']['ports']:
     app.post(f"/wa-receive-{port}")(receive_whatsapp)
 
 
@@ -73,7 +103,21 @@ for port in range(1, num_whatsapp_endpoints + 1):
 
 
 # ================================================================================================================
-# Scheduler For Quickcount Aggregation
+# Ingest Pipeline For SMS And WhatsApp Messages
+
+@app.on_event("startup")
+async def start_pipeline():
+    for journal in [sms_journal, wa_journal]:
+        journal.start()
+    await start_ingest_pipeline()
+    await replay_inbox()
+
+
+
+
+
+# ================================================================================================================
+# Scheduler For Quickcount Aggregation, SurveyCTO Polling And Votes Reconciliation
 
 # Global flag to ensure the scheduler runs only once
 scheduler_started = False
@@ -85,8 +129,24 @@ def startup_event():
     with scheduler_lock:
         if not scheduler_started:
             scheduler_started = True
+            start_warmup()
             fetch_thread = threading.Thread(target=scheduled_fetch_quickcount, daemon=True)
             fetch_thread.start()
+            scto_thread = threading.Thread(target=scheduled_poll_scto, daemon=True)
+            scto_thread.start()
+            votes_thread = threading.Thread(target=scheduled_reconcile_votes, daemon=True)
+            votes_thread.start()
+            start_outbox_sender()
+            start_raw_flusher()
+            start_gateway_health_sync()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    save_offsets()
+    flush_all_raw()
+    save_aliases()
+    shutdown_region_pool()
 
 
 def scheduled_fetch_quickcount():
@@ -95,4 +155,36 @@ def scheduled_fetch_quickcount():
             fetch_quickcount()
         except Exception as e:
             print(f"Error in fetch_quickcount: {str(e)}")
-        time.sleep(int(interval_aggregate))
\ No newline at end of file
+        time.sleep(int(interval_aggregate))
+
+
+def scheduled_poll_scto():
+    # Poll each registered form when it is due, skipping forms whose previous poll is still running
+    polling = {}
+    with ThreadPoolExecutor(max_workers=SCTO_POLL_WORKERS, thread_name_prefix='scto-poll') as executor:
+        while True:
+            try:
+                now = datetime.utcnow().isoformat()
+                with scto_forms_lock:
+                    forms = load_forms()
+                for form_id, form in forms.items():
+                    if form_id in polling and not polling[form_id].done():
+                        continue
+                    if form.get('next_poll', now) <= now:
+                        polling[form_id] = executor.submit(poll_form, form)
+                for form_id in [form_id for form_id, future in polling.items() if future.done()]:
+                    error = polling.pop(form_id).exception()
+                    if error:
+                        print(f"Error in poll_form {form_id}: {str(error)}")
+            except Exception as e:
+                print(f"Error in scheduled_poll_scto: {str(e)}")
+            time.sleep(1)
+
+
+def scheduled_reconcile_votes():
+    while True:
+        time.sleep(int(interval_votes_sync))
+        try:
+            reconcile_votes()
+        except Exception as e:
+            print(f"Error in reconcile_votes: {str(e)}")
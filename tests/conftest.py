@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# The modules read their settings from the environment when imported: point the local disk to a scratch directory
+os.environ['local_disk'] = tempfile.mkdtemp(prefix='local_disk_')
+os.environ.setdefault('url_bubble', 'https://bubble.test/api/1.1/obj')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -0,0 +1,77 @@
+import pytest
+
+from utils import bulk_loader
+
+
+@pytest.fixture
+def bubble(monkeypatch):
+    """
+    Bubble table stand-in: the bulk endpoint inserts rows whose UID is not in `reject`,
+    and `find_existing` looks rows up among the inserted ones.
+    """
+    table = {'inserted': [], 'requests': [], 'lookups': [], 'reject': set()}
+
+    def bulk_request(name, rows):
+        table['requests'].append([row['UID'] for row in rows])
+        failed = [i for i, row in enumerate(rows) if row['UID'] in table['reject']]
+        table['inserted'].extend((row['UID'], row['Event ID']) for i, row in enumerate(rows) if i not in failed)
+        return 'done', failed, 'rejected' if failed else None, None
+
+    def find_existing(name, rows, unique_fields):
+        table['lookups'].append([row['UID'] for row in rows])
+        return set(i for i, row in enumerate(rows) if tuple(row[field] for field in unique_fields) in table['inserted'])
+
+    monkeypatch.setattr(bulk_loader, 'bulk_request', bulk_request)
+    monkeypatch.setattr(bulk_loader, 'find_existing', find_existing)
+    monkeypatch.setattr(bulk_loader, 'BULK_BATCH_SIZE', 3)
+    return table
+
+
+def uid_rows(n):
+    return [{'UID': f'U{i}', 'Event ID': 'pilpres'} for i in range(n)]
+
+
+def test_bulk_insert_resumes_with_the_failed_rows_only(bubble, tmp_path):
+    state_path = str(tmp_path / 'bulk_state.json')
+    rows = uid_rows(8)
+    bubble['reject'] = {'U1', 'U7'}
+    first = bulk_loader.bulk_insert('Votes', rows, state_path, ['UID', 'Event ID'])
+    assert first == {'batches': 3, 'skipped': 0, 'rows': 8, 'failed_rows': 2}
+
+    bubble['reject'] = set()
+    bubble['requests'] = []
+    second = bulk_loader.bulk_insert('Votes', rows, state_path, ['UID', 'Event ID'])
+    assert second == {'batches': 3, 'skipped': 1, 'rows': 8, 'failed_rows': 0}
+    assert sorted(bubble['requests']) == [['U1'], ['U7']]
+    assert sorted(bubble['inserted']) == sorted((row['UID'], row['Event ID']) for row in rows)
+
+    bubble['requests'] = []
+    third = bulk_loader.bulk_insert('Votes', rows, state_path, ['UID', 'Event ID'])
+    assert third['skipped'] == 3
+    assert bubble['requests'] == []
+
+
+def test_bulk_insert_checks_rows_of_a_resumed_batch_before_sending(bubble, tmp_path):
+    state_path = str(tmp_path / 'bulk_state.json')
+    rows = uid_rows(3)
+    bubble['reject'] = {'U0', 'U1', 'U2'}
+    bulk_loader.bulk_insert('Votes', rows, state_path, ['UID', 'Event ID'])
+
+    # The rows made it to Bubble after all (e.g. applied after a timeout): they are not sent again
+    bubble['reject'] = set()
+    bubble['inserted'] = [('U0', 'pilpres'), ('U2', 'pilpres')]
+    bubble['requests'] = []
+    bulk_loader.bulk_insert('Votes', rows, state_path, ['UID', 'Event ID'])
+    assert bubble['lookups'] == [['U0', 'U1', 'U2']]
+    assert bubble['requests'] == [['U1']]
+
+
+def test_changed_batch_is_sent_again_without_the_rows_already_inserted(bubble, tmp_path):
+    state_path = str(tmp_path / 'bulk_state.json')
+    bulk_loader.bulk_insert('Votes', uid_rows(3), state_path, ['UID', 'Event ID'])
+    bubble['requests'] = []
+    changed = uid_rows(3)
+    changed[0]['Event ID'] = 'pilkada'
+    result = bulk_loader.bulk_insert('Votes', changed, state_path, ['UID', 'Event ID'])
+    assert result['skipped'] == 0
+    assert bubble['requests'] == [['U0']]
@@ -0,0 +1,69 @@
+import pytest
+
+from utils import dedup
+
+
+@pytest.fixture(autouse=True)
+def fresh_dedup(tmp_path, monkeypatch):
+    monkeypatch.setattr(dedup, 'local_disk', str(tmp_path))
+    monkeypatch.setattr(dedup, 'dedup_db', None)
+    monkeypatch.setattr(dedup, 'dedup_lru', dedup.OrderedDict())
+    yield
+    dedup.dedup_db.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(dedup.time, 'time', lambda: now[0])
+    return now
+
+
+def restart(monkeypatch):
+    dedup.dedup_db.close()
+    monkeypatch.setattr(dedup, 'dedup_db', None)
+    monkeypatch.setattr(dedup, 'dedup_lru', dedup.OrderedDict())
+
+
+def test_repeat_within_window_is_duplicate(clock):
+    key = dedup.message_key('sms', '628123', '42')
+    assert dedup.is_duplicate(key) is False
+    clock[0] += dedup.DEDUP_WINDOW - 1
+    assert dedup.is_duplicate(key) is True
+
+
+def test_repeat_after_window_is_received_again(clock):
+    key = dedup.message_key('sms', '628123', '42')
+    assert dedup.is_duplicate(key) is False
+    clock[0] += dedup.DEDUP_WINDOW + 1
+    assert dedup.is_duplicate(key) is False
+
+
+def test_mark_survives_restart_only_once_committed(clock, monkeypatch):
+    committed = dedup.message_key('sms', '628123', '1')
+    not_journaled = dedup.message_key('sms', '628123', '2')
+    dedup.is_duplicate(committed)
+    dedup.is_duplicate(not_journaled)
+    dedup.commit_message(committed)
+
+    restart(monkeypatch)
+    assert dedup.is_duplicate(committed) is True
+    assert dedup.is_duplicate(not_journaled) is False
+
+
+def test_committed_mark_expires_after_restart(clock, monkeypatch):
+    key = dedup.message_key('wa', '628123', '1')
+    dedup.is_duplicate(key)
+    dedup.commit_message(key)
+
+    restart(monkeypatch)
+    clock[0] += dedup.DEDUP_WINDOW + 1
+    assert dedup.is_duplicate(key) is False
+
+
+def test_forgotten_message_is_received_again(clock):
+    key = dedup.message_key('sms', '628123', '1')
+    dedup.is_duplicate(key)
+    dedup.commit_message(key)
+    dedup.forget_message(key)
+    assert dedup.is_duplicate(key) is False
@@ -0,0 +1,114 @@
+import os
+import asyncio
+
+import pytest
+
+from utils import journal as journal_module
+from utils.journal import Journal
+
+
+@pytest.fixture
+def disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal_module, 'local_disk', str(tmp_path))
+    monkeypatch.setattr(journal_module, 'JOURNAL_FSYNC', 'always')
+    return tmp_path
+
+
+def write_all(journal, records):
+    async def main():
+        return await asyncio.gather(*[journal.write(record) for record in records], return_exceptions=True)
+    return asyncio.run(main())
+
+
+def record(i):
+    return {'ID': str(i), 'Receive Date': f'2024-02-14 10:00:{i:02d}'}
+
+
+def test_write_returns_sequence_numbers_and_reads_from_any_of_them(disk):
+    journal = Journal('inbox')
+    assert write_all(journal, [record(i) for i in range(5)]) == [0, 1, 2, 3, 4]
+    assert journal.next_seq() == 5
+    assert [seq for seq, _ in journal.read(journal.snapshot(), 3)] == [3, 4]
+    assert [r['ID'] for _, r in journal.read(journal.snapshot())] == ['0', '1', '2', '3', '4']
+
+
+def test_rotate_into_segments_and_reopen(disk, monkeypatch):
+    monkeypatch.setattr(journal_module, 'JOURNAL_MAX_BYTES', 100)
+    monkeypatch.setattr(journal_module, 'JOURNAL_INDEX_EVERY', 2)
+    journal = Journal('inbox')
+    for i in range(12):
+        write_all(journal, [record(i)])
+    assert len(journal.segments) > 1
+
+    reopened = Journal('inbox')
+    assert reopened.next_seq() == 12
+    assert [seq for seq, _ in reopened.read(reopened.snapshot(), 7)] == [7, 8, 9, 10, 11]
+    assert write_all(reopened, [record(12)]) == [12]
+
+
+def test_reopen_drops_a_partial_last_line(disk):
+    journal = Journal('inbox')
+    write_all(journal, [record(0), record(1)])
+    with open(disk / 'inbox.json', 'ab') as f:
+        f.write(b'{"ID": "2", "Rec')
+
+    reopened = Journal('inbox')
+    assert reopened.next_seq() == 2
+    assert write_all(reopened, [record(2)]) == [2]
+    assert [r['ID'] for _, r in reopened.read(reopened.snapshot())] == ['0', '1', '2']
+
+
+class FailingFile:
+    """
+    File wrapper whose n-th write stores only part of the line and fails.
+    """
+    def __init__(self, f, fail_at):
+        self.f = f
+        self.writes = 0
+        self.fail_at = fail_at
+
+    def write(self, data):
+        self.writes += 1
+        if self.writes == self.fail_at:
+            self.f.write(data[:5])
+            self.f.flush()
+            raise OSError('No space left on device')
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def test_failed_write_commits_the_records_written_before_it(disk):
+    journal = Journal('inbox')
+    journal.start()
+    journal.file = FailingFile(journal.file, fail_at=3)
+    results = write_all(journal, [record(i) for i in range(5)])
+    assert results[:2] == [0, 1]
+    assert all(isinstance(result, OSError) for result in results[2:])
+
+    assert write_all(journal, [record(5)]) == [2]
+    assert [r['ID'] for _, r in journal.read(journal.snapshot())] == ['0', '1', '5']
+
+
+def test_failed_rotate_keeps_the_active_file_open(disk, monkeypatch):
+    monkeypatch.setattr(journal_module, 'JOURNAL_MAX_BYTES', 1)
+    journal = Journal('inbox')
+    assert write_all(journal, [record(0)]) == [0]
+
+    save_index = journal.save_index
+    calls = []
+
+    def failing_save_index():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError('No space left on device')
+        save_index()
+
+    journal.save_index = failing_save_index
+    assert isinstance(write_all(journal, [record(1)])[0], OSError)
+    journal.save_index = save_index
+
+    assert write_all(journal, [record(2)]) == [1]
+    assert os.path.exists(disk / 'inbox.json')
+    assert [r['ID'] for _, r in journal.read(journal.snapshot())] == ['0', '2']
@@ -0,0 +1,69 @@
+import pytest
+
+from utils.message import MAX_TOTAL_VOTES, compile_spec, split_message, parse_votes, check_message
+
+
+UIDS = {'a1b2', 'c3d4'}
+
+
+def baseline_reply(msg, n_candidate, uids):
+    """
+    Error type and reply of a KK# message as the SMS endpoint computed them before the spec was precompiled.
+    """
+    info = [part.strip() for part in msg.lower().split('#')]
+    uid, event = info[1].lower(), info[2].lower()
+    format = 'KK#UID#EventID#' + '#'.join([f'0{i+1}' for i in range(n_candidate)]) + '#Rusak'
+    template_error_msg = 'cek & kirim ulang dgn format:\n' + format
+    if uid not in uids:
+        return 2, f'UID "{uid.upper()}" tidak terdaftar untuk EventID "{event}", ' + template_error_msg
+    if len(info) != n_candidate + 4:
+        return 3, 'Data tidak lengkap, ' + template_error_msg
+    votes = [int(v) for v in info[3:-1]]
+    invalid = int(info[-1])
+    total_votes = sum(votes) + invalid
+    summary = f'EventID: {event}\n' + '\n'.join([f'Paslon_{i+1}: {votes[i]}' for i in range(n_candidate)]) + f'\nTidak Sah: {invalid}\nTotal: {total_votes}\n'
+    if total_votes > 700:
+        return 4, summary + 'Jumlah suara melebihi 700, ' + template_error_msg
+    return None, summary + 'Berhasil diterima. Utk koreksi, kirim ulang dgn format yg sama:\n' + format
+
+
+@pytest.mark.parametrize('n_candidate', [1, 2, 3, 6])
+@pytest.mark.parametrize('msg', [
+    'KK#A1B2#Pilpres#10#20#30#4',
+    'kk # a1b2 # pilpres # 10 # 20 # 30 # 4',
+    'KK#C3D4#Pilpres#300#300#100#1',
+    'KK#A1B2#Pilpres#0#0#0#0',
+    'KK#A1B2#Pilpres#10#20',
+    'KK#A1B2#Pilpres#1#2#3#4#5#6#7',
+    'KK#ZZZZ#Pilpres#10#20#30#4',
+    'KK#A1B2#Pilpres#10',
+    'KK#A1B2#Pilpres#1#1#1#1#1#1#0',
+])
+def test_check_message_matches_baseline(msg, n_candidate):
+    info = split_message(msg)
+    result = check_message(compile_spec(n_candidate), info, UIDS)
+    assert (result['error_type'], result['message']) == baseline_reply(msg, n_candidate, UIDS)
+
+
+def test_check_message_reports_parsed_votes():
+    result = check_message(compile_spec(3), split_message('KK#A1B2#Pilpres#10#20#30#4'), UIDS)
+    assert (result['uid'], result['event']) == ('a1b2', 'pilpres')
+    assert (result['votes'], result['invalid'], result['total']) == ([10, 20, 30], 4, 64)
+
+
+def test_check_message_raises_on_unparsable_votes():
+    with pytest.raises(ValueError):
+        check_message(compile_spec(3), split_message('KK#A1B2#Pilpres#10#x#30#4'), UIDS)
+
+
+def test_parse_votes():
+    assert parse_votes(['kk', 'a1b2', 'pilpres', '1', '2', '3']) == ([1, 2], 3, 6)
+    with pytest.raises(ValueError):
+        parse_votes(['kk', 'a1b2', 'pilpres', '1', '', '3'])
+
+
+def test_compile_spec():
+    spec = compile_spec(2)
+    assert spec['n_fields'] == 6
+    assert spec['format'] == 'KK#UID#EventID#01#02#Rusak'
+    assert spec['msg_too_many'].startswith(f'Jumlah suara melebihi {MAX_TOTAL_VOTES}, ')
@@ -0,0 +1,137 @@
+import json
+import time
+
+import pytest
+import requests
+
+from utils import outbox
+
+
+class Response:
+    def __init__(self, status_code, body=None, text=''):
+        self.status_code = status_code
+        self.body = body
+        self.text = text
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f'{self.status_code}', response=self)
+
+
+@pytest.fixture(autouse=True)
+def fresh_outbox(tmp_path, monkeypatch):
+    monkeypatch.setattr(outbox, 'local_disk', str(tmp_path))
+    monkeypatch.setattr(outbox, 'outbox_db', None)
+    monkeypatch.setattr(outbox, 'outbox_in_flight', {})
+    yield
+    outbox.outbox_db.close()
+
+
+def rows():
+    return outbox.outbox_connection().execute(
+        'SELECT id, method, url, body, body_type, attempts, unique_fields, check_first, status, last_error FROM outbox ORDER BY id'
+    ).fetchall()
+
+
+def sender_row(row_id):
+    return outbox.outbox_connection().execute(
+        'SELECT id, method, url, body, body_type, attempts, unique_fields, check_first FROM outbox WHERE id = ?', (row_id,)
+    ).fetchone()
+
+
+def test_enqueue_write_coalesces_pending_writes():
+    outbox.enqueue_write('PATCH', 'https://b/votes/1', {'SMS': True, 'Vote1': 1}, coalesce_key='votes/1')
+    outbox.enqueue_write('PATCH', 'https://b/votes/1', {'Vote1': 2}, coalesce_key='votes/1')
+    outbox.enqueue_write('PATCH', 'https://b/votes/2', {'Vote1': 3}, coalesce_key='votes/2')
+    stored = rows()
+    assert len(stored) == 2
+    assert json.loads(stored[0][3]) == {'SMS': True, 'Vote1': 2}
+
+
+def test_enqueue_write_does_not_coalesce_into_a_write_in_flight():
+    outbox.enqueue_write('PATCH', 'https://b/votes/1', {'Vote1': 1}, coalesce_key='votes/1')
+    outbox.outbox_in_flight[rows()[0][0]] = 'votes/1'
+    outbox.enqueue_write('PATCH', 'https://b/votes/1', {'Vote1': 2}, coalesce_key='votes/1')
+    stored = rows()
+    assert [json.loads(row[3]) for row in stored] == [{'Vote1': 1}, {'Vote1': 2}]
+    assert stored[1][7] == 0
+
+
+def test_post_enqueued_while_one_is_in_flight_checks_first():
+    payload = {'Event ID': 'e', 'Region': 'r'}
+    outbox.enqueue_write('POST', 'https://b/AggregateRegion', payload, body_type='json', coalesce_key='k', unique_fields=['Event ID', 'Region'])
+    outbox.outbox_in_flight[rows()[0][0]] = 'k'
+    outbox.enqueue_write('POST', 'https://b/AggregateRegion', payload, body_type='json', coalesce_key='k', unique_fields=['Event ID', 'Region'])
+    assert [row[7] for row in rows()] == [0, 1]
+
+
+@pytest.mark.parametrize('response, status, attempts', [
+    (Response(200), None, None),
+    (Response(429), 'pending', 1),
+    (Response(503), 'pending', 1),
+    (Response(400, text='bad field'), 'failed', 1),
+])
+def test_process_write_transitions(monkeypatch, response, status, attempts):
+    monkeypatch.setattr(outbox.bubble_session, 'request', lambda *args, **kwargs: response)
+    outbox.enqueue_write('PATCH', 'https://b/votes/1', {'Vote1': 1}, coalesce_key='votes/1')
+    row = sender_row(rows()[0][0])
+    outbox.outbox_in_flight[row[0]] = 'votes/1'
+    outbox.process_write(row)
+    assert outbox.outbox_in_flight == {}
+    stored = rows()
+    if status is None:
+        assert stored == []
+    else:
+        assert (stored[0][8], stored[0][5]) == (status, attempts)
+    if status == 'pending':
+        next_attempt = outbox.outbox_connection().execute('SELECT next_attempt FROM outbox').fetchone()[0]
+        assert next_attempt > time.time()
+
+
+def test_failed_writes_can_be_requeued(monkeypatch):
+    monkeypatch.setattr(outbox.bubble_session, 'request', lambda *args, **kwargs: Response(400, text='bad field'))
+    outbox.enqueue_write('PATCH', 'https://b/votes/1', {'Vote1': 1})
+    outbox.process_write(sender_row(rows()[0][0]))
+    assert rows()[0][8] == 'failed'
+    assert outbox.requeue_failed_writes(ids=None) == {'requeued': 1}
+    assert (rows()[0][8], rows()[0][5]) == ('pending', 0)
+
+
+def test_post_with_unknown_outcome_becomes_patch_of_found_record(monkeypatch):
+    sent = []
+
+    def request(method, url, **kwargs):
+        sent.append((method, url))
+        if len(sent) == 1:
+            raise requests.exceptions.ReadTimeout('read timed out')
+        return Response(200)
+
+    monkeypatch.setattr(outbox.bubble_session, 'request', request)
+    monkeypatch.setattr(outbox.bubble_session, 'get', lambda url, **kwargs: Response(200, {'response': {'results': [{'_id': 'rec1'}]}}))
+    outbox.enqueue_write('POST', 'https://b/AggregateRegion', {'Event ID': 'e', 'Region': 'r'}, body_type='json', coalesce_key='k', unique_fields=['Event ID', 'Region'])
+    row_id = rows()[0][0]
+
+    outbox.process_write(sender_row(row_id))
+    assert rows()[0][7] == 1
+
+    outbox.process_write(sender_row(row_id))
+    assert sent == [('POST', 'https://b/AggregateRegion'), ('PATCH', 'https://b/AggregateRegion/rec1')]
+    assert rows() == []
+
+
+def test_unexpected_error_counts_as_failed_attempt_and_releases_row(monkeypatch):
+    def request(*args, **kwargs):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(outbox.bubble_session, 'request', request)
+    outbox.enqueue_write('PATCH', 'https://b/votes/1', {'Vote1': 1}, coalesce_key='votes/1')
+    row = sender_row(rows()[0][0])
+    outbox.outbox_in_flight[row[0]] = 'votes/1'
+    outbox.process_write(row)
+    assert outbox.outbox_in_flight == {}
+    stored = rows()[0]
+    assert (stored[8], stored[5]) == ('pending', 1)
+    assert 'boom' in stored[9]
@@ -0,0 +1,56 @@
+import asyncio
+import json
+
+import pytest
+
+from utils import pipeline
+
+
+@pytest.fixture(autouse=True)
+def fresh_offsets(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'OFFSETS_PATH', str(tmp_path / 'ingest_offsets.json'))
+    monkeypatch.setattr(pipeline, 'ingest_offsets', {})
+    monkeypatch.setattr(pipeline, 'ingest_processed', {})
+    monkeypatch.setattr(pipeline, 'ingest_offsets_state', {'dirty': False})
+
+
+def test_offset_moves_past_records_processed_in_a_row():
+    pipeline.set_offset('sms_inbox', 10)
+    pipeline.mark_processed('sms_inbox', 11)
+    pipeline.mark_processed('sms_inbox', 12)
+    assert pipeline.ingest_offsets['sms_inbox'] == 10
+    pipeline.mark_processed('sms_inbox', 10)
+    assert pipeline.ingest_offsets['sms_inbox'] == 13
+    pipeline.mark_processed('sms_inbox', 14)
+    assert pipeline.ingest_offsets['sms_inbox'] == 13
+
+
+def test_offsets_are_saved_when_moved_and_loaded_back():
+    pipeline.set_offset('wa_inbox', 3)
+    pipeline.save_offsets()
+    with open(pipeline.OFFSETS_PATH) as json_file:
+        assert json.load(json_file) == {'wa_inbox': 3}
+
+    pipeline.ingest_offsets.clear()
+    assert pipeline.load_offsets() == {'wa_inbox': 3}
+    assert pipeline.ingest_offsets == {'wa_inbox': 3}
+
+
+def test_worker_marks_records_processed_even_when_processing_fails():
+    processed = []
+
+    def process(raw_data):
+        processed.append(raw_data['ID'])
+        if raw_data['ID'] == '1':
+            raise ValueError('Bubble is down')
+
+    async def main():
+        await pipeline.start_ingest_pipeline()
+        pipeline.set_offset('sms_inbox', 0)
+        for seq in range(3):
+            await pipeline.submit_message(process, {'ID': str(seq)}, source=('sms_inbox', seq))
+        await pipeline.ingest_queue.join()
+
+    asyncio.run(main())
+    assert sorted(processed) == ['0', '1', '2']
+    assert pipeline.ingest_offsets['sms_inbox'] == 3
@@ -0,0 +1,67 @@
+import pytest
+
+from utils import scto_cursor
+from utils.scto_cursor import SCTO_MAX_ATTEMPTS, SCTO_POLL_MAX, SCTO_POLL_MIN, completion_date, given_up, load_cursor, next_interval, record_failure, save_cursor
+
+
+@pytest.fixture
+def disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(scto_cursor, 'local_disk', str(tmp_path))
+    return tmp_path
+
+
+def submission(key, completed):
+    return {'KEY': key, 'CompletionDate': completed}
+
+
+@pytest.mark.parametrize('interval, n_new, expected', [
+    (60, 3, 30),
+    (20, 1, SCTO_POLL_MIN),
+    (SCTO_POLL_MIN, 10, SCTO_POLL_MIN),
+    (60, 0, 90),
+    (SCTO_POLL_MAX - 10, 0, SCTO_POLL_MAX),
+    (SCTO_POLL_MAX, 0, SCTO_POLL_MAX),
+])
+def test_next_interval(interval, n_new, expected):
+    assert next_interval(interval, n_new) == expected
+
+
+def test_next_interval_settles_within_bounds():
+    interval = SCTO_POLL_MIN
+    for _ in range(50):
+        interval = next_interval(interval, 0)
+    assert interval == SCTO_POLL_MAX
+    for _ in range(50):
+        interval = next_interval(interval, 5)
+    assert interval == SCTO_POLL_MIN
+
+
+def test_failed_submission_holds_the_cursor_back_until_given_up(disk):
+    failed = submission('uuid:a', 'Feb 14, 2024 10:00:00 AM')
+    later = submission('uuid:b', 'Feb 14, 2024 11:00:00 AM')
+    cursor = load_cursor('form')
+    cursor['processed'][later['KEY']] = ['fp-b', completion_date(later)]
+    cursor['last_completion'] = completion_date(later)
+
+    for attempt in range(1, SCTO_MAX_ATTEMPTS + 1):
+        record_failure(cursor, failed, 'fp-a', 'Bubble timeout')
+        save_cursor('form', cursor)
+        cursor = load_cursor('form')
+        assert cursor['failed'][failed['KEY']]['attempts'] == attempt
+        assert cursor['last_completion'] == completion_date(failed)
+    assert given_up(cursor, failed['KEY'], 'fp-a')
+    assert later['KEY'] in cursor['processed']
+
+    cursor['last_completion'] = completion_date(later)
+    save_cursor('form', cursor)
+    assert load_cursor('form')['last_completion'] == completion_date(later)
+
+
+def test_changed_submission_is_retried_from_the_first_attempt(disk):
+    failed = submission('uuid:a', 'Feb 14, 2024 10:00:00 AM')
+    cursor = load_cursor('form')
+    for _ in range(SCTO_MAX_ATTEMPTS):
+        record_failure(cursor, failed, 'fp-a', 'No region contains coordinate')
+    assert given_up(cursor, failed['KEY'], 'fp-a')
+    assert not given_up(cursor, failed['KEY'], 'fp-a-corrected')
+    assert record_failure(cursor, failed, 'fp-a-corrected', 'No region contains coordinate')['attempts'] == 1
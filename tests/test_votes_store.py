@@ -0,0 +1,48 @@
+from datetime import datetime
+
+import pytest
+
+from utils import votes_store
+from utils.votes_store import bubble_date, merge_votes, record_votes_write
+
+
+@pytest.fixture(autouse=True)
+def fresh_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(votes_store, 'local_disk', str(tmp_path))
+    monkeypatch.setattr(votes_store, 'votes_store', {})
+    monkeypatch.setattr(votes_store, 'pending_keys', lambda: set())
+
+
+def test_bubble_date_converts_local_times_to_utc():
+    assert bubble_date('2024-02-14 10:00:00') == '2024-02-14T10:00:00.000Z'
+    assert bubble_date('2024-02-14 10:00:00', local=True) == '2024-02-14T03:00:00.000Z'
+    assert bubble_date(datetime(2024, 2, 14, 6, 30, 0, 250000), local=True) == '2024-02-13T23:30:00.250Z'
+
+
+def test_merge_keeps_only_the_fields_we_wrote_recently():
+    record_votes_write('pilpres', 'a1b2', {'SMS': True, 'SMS Timestamp': '2024-02-14 10:00:00', 'Validator': None})
+    pulled = {'UID': 'A1B2', '_id': 'x', 'SMS': False, 'SMS Timestamp': None, 'Validator': 'budi'}
+    merge_votes('pilpres', [pulled], votes_store.time.time())
+    row = votes_store.votes_store['pilpres']['A1B2']
+    assert (row['SMS'], row['SMS Timestamp'], row['Validator']) == (True, '2024-02-14T03:00:00.000Z', 'budi')
+
+
+def test_merge_takes_bubble_values_once_writes_settled():
+    record_votes_write('pilpres', 'a1b2', {'SMS': True})
+    pulled = {'UID': 'A1B2', '_id': 'x', 'SMS': False}
+    merge_votes('pilpres', [pulled], votes_store.time.time() + votes_store.VOTES_SYNC_GRACE + 1)
+    assert votes_store.votes_store['pilpres']['A1B2'] == pulled
+
+
+def test_merge_keeps_fields_of_writes_still_in_the_outbox(monkeypatch):
+    monkeypatch.setattr(votes_store, 'pending_keys', lambda: {f'{votes_store.url_bubble}/votes/x'})
+    record_votes_write('pilpres', 'a1b2', {'SMS': True})
+    merge_votes('pilpres', [{'UID': 'A1B2', '_id': 'x', 'SMS': False}], votes_store.time.time() + 3600)
+    assert votes_store.votes_store['pilpres']['A1B2']['SMS'] is True
+
+
+def test_echoed_values_are_left_to_bubble():
+    votes_store.votes_store['pilpres'] = {'A1B2': {'UID': 'A1B2', '_id': 'x', 'Validator': 'budi'}}
+    record_votes_write('pilpres', 'a1b2', {'SMS': True, 'Validator': 'budi'})
+    merge_votes('pilpres', [{'UID': 'A1B2', '_id': 'x', 'SMS': True, 'Validator': 'ani'}], votes_store.time.time())
+    assert votes_store.votes_store['pilpres']['A1B2']['Validator'] == 'ani'
@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import hashlib
+import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from config.config import *
+from utils.outbox import bubble_session, encode_value, not_sent
+
+
+
+class AdaptiveLimiter:
+    """
+    Limit on the requests in flight, driven by Bubble's responses: raised by one after a full window
+    of successes, halved with a pause when Bubble throttles (429), fails (5xx) or cannot be reached.
+    """
+    def __init__(self, limit, max_limit):
+        self.limit = limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.paused_until = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until a request may be sent.
+        """
+        with self.cond:
+            while True:
+                pause = self.paused_until - time.time()
+                if pause <= 0 and self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                self.cond.wait(timeout=pause if pause > 0 else None)
+
+    def release(self, throttled=False, retry_after=None):
+        """
+        Report the outcome of a request.
+        """
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                self.paused_until = max(self.paused_until, time.time() + (retry_after or 1))
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.cond.notify_all()
+
+
+
+def encode_rows(rows):
+    """
+    Serialize rows as newline-delimited JSON for the Bubble bulk endpoint.
+    """
+    return '\n'.join(json.dumps(row, default=encode_value) for row in rows)
+
+
+
+def bulk_request(table, rows):
+    """
+    Send rows to the Bubble bulk endpoint once. Returns (outcome, failed positions, error, retry after), outcome being:
+    - 'done': Bubble answered for every row, `failed` being the rows it rejected
+    - 'throttled': not applied (429, or the connection could not be opened), can be sent again
+    - 'unknown': may have been applied (timeout, 5xx, cut-off response), to be checked before sending again
+    - 'rejected': refused as a whole (other 4xx), not applied
+    """
+    positions = list(range(len(rows)))
+    try:
+        res = bubble_session.post(f'{url_bubble}/{table}/bulk', headers=headers_bulk, data=encode_rows(rows).encode('utf-8'), timeout=OUTBOX_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        return 'throttled' if not_sent(e) else 'unknown', positions, str(e), None
+    if res.status_code == 429:
+        return 'throttled', positions, 'HTTP 429', float(res.headers.get('Retry-After', 0) or 0) or None
+    if res.status_code >= 500:
+        return 'unknown', positions, f'HTTP {res.status_code}', None
+    if res.status_code >= 400:
+        return 'rejected', positions, f'HTTP {res.status_code}: {res.text[:200]}', None
+    try:
+        results = [json.loads(line) for line in res.text.splitlines() if line.strip()]
+    except ValueError as e:
+        return 'unknown', positions, f'Invalid bulk response: {e}', None
+    failed = [i for i, result in enumerate(results) if result.get('status') != 'success']
+    error = results[failed[0]].get('message') if failed else None
+    if len(results) < len(rows):
+        return 'unknown', failed + positions[len(results):], error or 'Incomplete bulk response', None
+    return 'done', failed, error, None
+
+
+
+def find_existing(table, rows, unique_fields):
+    """
+    Return the positions of the rows that exist in a Bubble table, matched on `unique_fields`.
+    """
+    constraints = []
+    for field in unique_fields:
+        values = sorted(set(str(row[field]) for row in rows))
+        if len(values) == 1:
+            constraints.append({'key': field, 'constraint_type': 'equals', 'value': values[0]})
+        else:
+            constraints.append({'key': field, 'constraint_type': 'in', 'value': values})
+    found = set()
+    cursor = 0
+    while True:
+        params = {'constraints': json.dumps(constraints), 'cursor': cursor, 'limit': 100}
+        res = bubble_session.get(f'{url_bubble}/{table}', headers=headers, params=params, timeout=60)
+        res.raise_for_status()
+        out = res.json()['response']
+        found.update(tuple(str(result.get(field)) for field in unique_fields) for result in out['results'])
+        cursor += len(out['results'])
+        if out.get('remaining', 0) <= 0 or len(out['results']) == 0:
+            break
+    return set(i for i, row in enumerate(rows) if tuple(str(row[field]) for field in unique_fields) in found)
+
+
+
+def post_bulk(table, rows, limiter, unique_fields, check_first=False):
+    """
+    Insert rows through the Bubble bulk endpoint, which is not idempotent: requests known not to have been
+    applied (429, connection not opened) are sent again, up to BULK_RETRIES times, but after a timeout or
+    5xx the rows found in Bubble (matched on `unique_fields`) are dropped before the rest is sent again.
+    With check_first (a batch resumed from an earlier run), the rows already in Bubble are dropped first.
+    Returns the positions of the rows that were not inserted, and the last error.
+    """
+    todo = list(range(len(rows)))
+    error = None
+    check = check_first
+    for attempt in range(BULK_RETRIES + 1):
+        if check:
+            try:
+                existing = find_existing(table, [rows[i] for i in todo], unique_fields)
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                return todo, f'Could not check which rows were inserted ({e}), last error: {error}'
+            todo = [i for j, i in enumerate(todo) if j not in existing]
+            check = False
+            if not todo:
+                return [], None
+        if attempt == BULK_RETRIES:
+            break
+
+        limiter.acquire()
+        try:
+            outcome, failed, error, retry_after = bulk_request(table, [rows[i] for i in todo])
+        except Exception as e:
+            outcome, failed, error, retry_after = 'unknown', list(range(len(todo))), str(e), None
+        slow = outcome in ('throttled', 'unknown')
+        limiter.release(slow, (retry_after or 2 ** attempt) if slow else None)
+        todo = [todo[i] for i in failed]
+        if outcome in ('done', 'rejected'):
+            return todo, error
+        if outcome == 'unknown':
+            # Give Bubble time to finish applying the request before checking
+            time.sleep(2 ** attempt)
+            check = True
+    return todo, error
+
+
+
+def load_bulk_state(path):
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {'batches': {}}
+
+
+
+def save_bulk_state(path, state):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(state, json_file)
+    os.replace(tmp_path, path)
+
+
+
+def bulk_insert(table, rows, state_path, unique_fields, progress=None):
+    """
+    Insert rows into a Bubble table in batches of BULK_BATCH_SIZE, several batches in flight under an
+    adaptive limit (BULK_CONCURRENCY to start, up to BULK_MAX_CONCURRENCY).
+    `unique_fields` identify a row, to find out which rows a request with an unknown outcome inserted.
+
+    The outcome of each batch is kept in `state_path`, so a second run with the same rows skips the
+    batches already inserted and sends only the rows that failed, after dropping the ones found in Bubble
+    (a batch sent when the previous run stopped is checked the same way). `progress(done, total, failed_rows)`
+    is called after each batch. Returns the number of batches, skipped batches, rows and failed rows.
+    """
+    batches = [rows[start:start + BULK_BATCH_SIZE] for start in range(0, len(rows), BULK_BATCH_SIZE)]
+    state = load_bulk_state(state_path)
+    resuming = bool(state['batches'])
+    state_lock = threading.Lock()
+
+    todo = []
+    skipped = 0
+    for index, batch in enumerate(batches):
+        digest = hashlib.sha1(encode_rows(batch).encode('utf-8')).hexdigest()
+        previous = state['batches'].get(str(index))
+        if previous and previous['hash'] == digest:
+            if not previous['failed']:
+                skipped += 1
+                continue
+            todo.append((index, digest, previous['failed']))
+        else:
+            todo.append((index, digest, list(range(len(batch)))))
+
+    limiter = AdaptiveLimiter(BULK_CONCURRENCY, BULK_MAX_CONCURRENCY)
+    done = skipped
+    failed_rows = 0
+    with ThreadPoolExecutor(max_workers=BULK_MAX_CONCURRENCY, thread_name_prefix='bulk') as executor:
+        futures = {
+            executor.submit(post_bulk, table, [batches[index][i] for i in positions], limiter, unique_fields, resuming): (index, digest, positions)
+            for index, digest, positions in todo
+        }
+        for future in as_completed(futures):
+            index, digest, positions = futures[future]
+            failed, error = future.result()
+            with state_lock:
+                state['batches'][str(index)] = {'hash': digest, 'failed': [positions[i] for i in failed], 'error': error}
+                save_bulk_state(state_path, state)
+                done += 1
+                failed_rows += len(failed)
+            if error:
+                print(f'Process: bulk insert {table} batch {index}\t {len(failed)} rows failed, keyword: {error}')
+            if progress:
+                progress(done, len(batches), failed_rows)
+
+    return {'batches': len(batches), 'skipped': skipped, 'rows': len(rows), 'failed_rows': failed_rows}
+
+
+
+def fetch_uid_dict(event, n_rows):
+    """
+    Fetch the UID -> Bubble id mapping of an event from url_getUID, pages of 50 fetched concurrently.
+    """
+    def fetch_page(uid_start):
+        params = {'Event ID': event, 'start': uid_start, 'end': uid_start + 50}
+        for attempt in range(BULK_RETRIES):
+            try:
+                res = bubble_session.get(url_getUID, headers=headers, params=params, timeout=60)
+                res.raise_for_status()
+                out = res.json()['response']
+                return list(zip(out['UID'], out['id_']))
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                if attempt == BULK_RETRIES - 1:
+                    raise
+                print(f'Process: getUID page {uid_start}\t Keyword: {e}')
+                time.sleep(2 ** attempt)
+
+    uid_dict = {}
+    with ThreadPoolExecutor(max_workers=UID_FETCH_WORKERS, thread_name_prefix='getuid') as executor:
+        for pairs in executor.map(fetch_page, range(1, n_rows, 50)):
+            uid_dict.update(pairs)
+    return uid_dict
@@ -0,0 +1,150 @@
+import time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from config.config import *
+
+
+
+# Recently seen message keys (most recent last), backed by a persisted window in dedup.db
+dedup_lru = OrderedDict()
+dedup_lock = threading.Lock()
+dedup_db = None
+
+# Thread running the checks for the async handlers, as a key missing from the LRU is looked up in SQLite
+dedup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dedup')
+
+# Counters for the duplicate hit rate
+dedup_counts = {'checked': 0, 'duplicates': 0, 'inserted': 0}
+
+
+
+def dedup_connection():
+    """
+    Open the persisted window on first use and warm the LRU with its most recent keys.
+    """
+    global dedup_db
+    if dedup_db is None:
+        db = sqlite3.connect(f'{local_disk}/dedup.db', check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, ts REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS seen_ts ON seen (ts)')
+        db.execute('DELETE FROM seen WHERE ts < ?', (time.time() - DEDUP_WINDOW,))
+        rows = db.execute('SELECT key, ts FROM seen ORDER BY ts DESC LIMIT ?', (DEDUP_CAPACITY,)).fetchall()
+        for key, ts in reversed(rows):
+            dedup_lru[key] = ts
+        dedup_db = db
+    return dedup_db
+
+
+
+def message_key(channel, gateway_number, message_id):
+    """
+    Build the deduplication key of a gateway message.
+    """
+    return f'{channel}:{gateway_number}:{message_id}'
+
+
+
+def is_duplicate(key):
+    """
+    Check whether a message was already received within the window, and mark it as received if not.
+    The mark is kept in memory only until `commit_message` persists it, once the message is journaled:
+    a crash in between leaves no mark, so the gateway's retry is received again.
+    """
+    now = time.time()
+    with dedup_lock:
+        db = dedup_connection()
+        dedup_counts['checked'] += 1
+        ts = dedup_lru.get(key)
+        if ts is None:
+            row = db.execute('SELECT ts FROM seen WHERE key = ?', (key,)).fetchone()
+            ts = row[0] if row else None
+        if ts is not None and now - ts < DEDUP_WINDOW:
+            dedup_lru[key] = ts
+            dedup_lru.move_to_end(key)
+            dedup_counts['duplicates'] += 1
+            return True
+
+        dedup_lru[key] = now
+        dedup_lru.move_to_end(key)
+        if len(dedup_lru) > DEDUP_CAPACITY:
+            dedup_lru.popitem(last=False)
+        return False
+
+
+
+def commit_message(key):
+    """
+    Persist the mark of a received message (see `is_duplicate`), once it is journaled.
+    """
+    with dedup_lock:
+        db = dedup_connection()
+        ts = dedup_lru.get(key) or time.time()
+        db.execute('INSERT OR REPLACE INTO seen (key, ts) VALUES (?, ?)', (key, ts))
+        dedup_counts['inserted'] += 1
+        if dedup_counts['inserted'] % 1000 == 0:
+            db.execute('DELETE FROM seen WHERE ts < ?', (time.time() - DEDUP_WINDOW,))
+
+
+
+async def check_duplicates(keys):
+    """
+    Run `is_duplicate` on keys in order, off the event loop. Returns whether each one is a duplicate.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(dedup_executor, lambda: [is_duplicate(key) for key in keys])
+
+
+
+async def check_duplicate(key):
+    """
+    Run `is_duplicate` off the event loop.
+    """
+    return (await check_duplicates([key]))[0]
+
+
+
+async def commit_messages(keys):
+    """
+    Run `commit_message` on keys off the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(dedup_executor, lambda: [commit_message(key) for key in keys])
+
+
+
+async def forget_messages(keys):
+    """
+    Run `forget_message` on keys off the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(dedup_executor, lambda: [forget_message(key) for key in keys])
+
+
+
+def forget_message(key):
+    """
+    Unmark a message, so a retry of it is processed (used when it could not be logged).
+    """
+    with dedup_lock:
+        dedup_lru.pop(key, None)
+        dedup_connection().execute('DELETE FROM seen WHERE key = ?', (key,))
+
+
+
+async def dedup_stats():
+    """
+    Report the number of checked and duplicate messages and the duplicate hit rate.
+    """
+    checked, duplicates = dedup_counts['checked'], dedup_counts['duplicates']
+    return {
+        'checked': checked,
+        'duplicates': duplicates,
+        'hit_rate': duplicates / checked if checked else 0,
+        'cached_keys': len(dedup_lru),
+    }
@@ -0,0 +1,198 @@
+import json
+import math
+import time
+import queue
+import random
+import requests
+import threading
+from collections import deque
+
+from config.config import *
+from utils.outbox import not_sent
+
+
+
+# Pooled HTTP session for gateway replies
+reply_session = requests.Session()
+reply_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=REPLY_WORKERS_PER_GATEWAY * 20))
+reply_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=REPLY_WORKERS_PER_GATEWAY * 20))
+
+# Send rate overrides per gateway (messages per second): WhatsApp gateway numbers, or the
+# SMS Masking account (see SMS_GATEWAY), e.g. {"628123456789": 0.5, "sms-masking": 10}
+reply_rate_limits = json.loads(REPLY_RATE_LIMITS) if REPLY_RATE_LIMITS else {}
+
+# Gateways with their queue, rate limiter and statistics, keyed by gateway name.
+# Replies are kept in memory and delivered at most once: a reply that may have reached the gateway
+# (timeout) is not sent again, and queued replies are lost on restart.
+reply_gateways = {}
+reply_gateways_lock = threading.Lock()
+
+# Every SMS reply goes out through the one SMS Masking account, whatever port the message came in on
+SMS_GATEWAY = 'sms-masking'
+
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: `rate` tokens per second, up to `burst` tokens saved.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a token is available and take it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+
+def get_gateway(name, rate):
+    """
+    Return the reply queue of a gateway, starting its workers on first use
+    (enough for the rate limit, at least REPLY_WORKERS_PER_GATEWAY).
+    """
+    gateway = reply_gateways.get(name)
+    if gateway is None:
+        with reply_gateways_lock:
+            gateway = reply_gateways.get(name)
+            if gateway is None:
+                rate = float(reply_rate_limits.get(name, rate))
+                gateway = {
+                    'queue': queue.Queue(),
+                    'bucket': TokenBucket(rate, max(1.0, rate)),
+                    'rate': rate,
+                    'sent': 0,
+                    'retried': 0,
+                    'failed': 0,
+                    'latency': deque(maxlen=1000),
+                    'last_error': None,
+                    'lock': threading.Lock(),
+                }
+                for _ in range(max(REPLY_WORKERS_PER_GATEWAY, math.ceil(rate))):
+                    threading.Thread(target=reply_worker, args=(name, gateway), daemon=True).start()
+                reply_gateways[name] = gateway
+    return gateway
+
+
+
+def reply_worker(name, gateway):
+    """
+    Send the replies queued for one gateway, within its rate limit.
+    Replies the gateway did not take (429, 5xx, connection not opened) are queued again with exponential
+    backoff (or the gateway's Retry-After), up to REPLY_RETRIES times.
+    """
+    while True:
+        method, url, kwargs, attempts = gateway['queue'].get()
+        gateway['bucket'].acquire()
+        start = time.monotonic()
+        try:
+            res = reply_session.request(method, url, timeout=REPLY_TIMEOUT, **kwargs)
+            res.raise_for_status()
+            with gateway['lock']:
+                gateway['sent'] += 1
+        except requests.exceptions.RequestException as e:
+            res = getattr(e, 'response', None)
+            status = res.status_code if res is not None else None
+            retry = status == 429 or (status is not None and status >= 500) or (status is None and not_sent(e))
+            with gateway['lock']:
+                gateway['last_error'] = str(e)
+                gateway['retried' if retry and attempts < REPLY_RETRIES else 'failed'] += 1
+            if retry and attempts < REPLY_RETRIES:
+                delay = min(REPLY_MAX_BACKOFF, 2 ** attempts) * random.uniform(0.5, 1.0)
+                if status == 429:
+                    try:
+                        delay = max(delay, float(res.headers.get('Retry-After', 0)))
+                    except ValueError:
+                        pass
+                timer = threading.Timer(delay, gateway['queue'].put, args=((method, url, kwargs, attempts + 1),))
+                timer.daemon = True
+                timer.start()
+            else:
+                print(f'Process: reply dispatcher {name}\t Keyword: {e}')
+        finally:
+            with gateway['lock']:
+                gateway['latency'].append(time.monotonic() - start)
+            gateway['queue'].task_done()
+
+
+
+def send_sms_reply(port, destination, message):
+    """
+    Queue a reply to the sender via SMS Masking. Replies of every port share the account's rate limit.
+    """
+    params = {
+        "user": NUSA_USER_NAME,
+        "password": NUSA_PASSWORD,
+        "SMSText": message,
+        "GSM": destination,
+        "output": "json",
+    }
+    get_gateway(SMS_GATEWAY, REPLY_RATE_SMS)['queue'].put(('GET', url_send_sms, {'params': params}, 0))
+
+
+
+def send_wa_reply(port, destination, message):
+    """
+    Queue a reply to the sender via the WhatsApp Gateway of the given port.
+    """
+    sender = list_WhatsApp_Gateway[int(port)]
+    HEADERS = {
+        "Accept": "application/json",
+        "APIKey": NUSA_API_KEY
+    }
+    PAYLOADS = {
+        'message': message,
+        'destination': destination,
+        'sender': sender,
+        'include_unsubscribe': False
+    }
+    get_gateway(sender, REPLY_RATE_WA)['queue'].put(('POST', url_send_wa, {'headers': HEADERS, 'json': PAYLOADS}, 0))
+
+
+
+def percentile(values, q):
+    """
+    Return the q-th percentile of a list of values (None when empty).
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+
+async def reply_stats():
+    """
+    Report queue depth, send counts, failures and send latency (seconds) per gateway.
+    """
+    stats = {}
+    for name, gateway in list(reply_gateways.items()):
+        with gateway['lock']:
+            latency = list(gateway['latency'])
+            sent, retried, failed, last_error = gateway['sent'], gateway['retried'], gateway['failed'], gateway['last_error']
+        stats[name] = {
+            'queued': gateway['queue'].qsize(),
+            'rate': gateway['rate'],
+            'sent': sent,
+            'retried': retried,
+            'failed': failed,
+            'latency_p50': percentile(latency, 50),
+            'latency_p95': percentile(latency, 95),
+            'latency_max': max(latency) if latency else None,
+            'last_error': last_error,
+        }
+    return stats
@@ -0,0 +1,227 @@
+import re
+import time
+import requests
+import threading
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from config.config import *
+from utils.outbox import enqueue_write
+from utils.dispatcher import percentile, reply_session
+
+
+
+# Health state per gateway, keyed by (channel, normalized gateway number)
+gateway_health = {}
+gateway_health_lock = threading.Lock()
+
+# Send time of the pending probe per normalized gateway number. A probe is matched with the echo
+# coming back on either channel, so SMS and WhatsApp gateways both get a round-trip latency.
+gateway_probes = {}
+
+# Bubble tables holding the gateway status, and their record ids per gateway number
+GATEWAY_TABLES = {'sms': 'GatewayCheckSMS', 'wa': 'GatewayCheckWA'}
+gateway_record_ids = {}
+
+# Gateways without a Bubble record: (channel, number) -> (time of the next lookup, backoff in seconds).
+# The backoff doubles on every lookup that still finds no record, up to GATEWAY_MISS_MAX_BACKOFF.
+gateway_record_misses = {}
+GATEWAY_MISS_MAX_BACKOFF = 3600
+
+
+
+def normalize_number(number):
+    """
+    Normalize a phone number to the 628... format (from 08..., +628..., 8...).
+    """
+    digits = re.sub(r'\D', '', str(number))
+    if digits.startswith('0'):
+        return '62' + digits[1:]
+    if digits.startswith('8'):
+        return '62' + digits
+    return digits
+
+
+
+def get_health(channel, gateway_number):
+    """
+    Return the health entry of a gateway, creating it on first use. Called with gateway_health_lock held.
+    """
+    key = (channel, normalize_number(gateway_number))
+    if key not in gateway_health:
+        gateway_health[key] = {
+            'port': None,
+            'last_seen': None,
+            'last_check': None,
+            'latency': deque(maxlen=100),
+            'dirty': False,
+        }
+    return gateway_health[key]
+
+
+
+def record_probe(gateway_number, sent_at):
+    """
+    Record the time a probe message was sent to a gateway.
+    """
+    with gateway_health_lock:
+        gateway_probes[normalize_number(gateway_number)] = sent_at
+
+
+
+def record_echo(channel, gateway_number, port, receive_date):
+    """
+    Record a 'the gateway is active' message coming back through a gateway, and its round-trip latency.
+    """
+    now = time.time()
+    with gateway_health_lock:
+        health = get_health(channel, gateway_number)
+        probe_sent = gateway_probes.pop(normalize_number(gateway_number), None)
+        if probe_sent is not None:
+            health['latency'].append(now - probe_sent)
+        health['port'] = port
+        health['last_seen'] = now
+        health['last_check'] = receive_date
+        health['dirty'] = True
+
+
+
+def fetch_gateway_record_ids(channel):
+    """
+    Fetch the Bubble record ids of all gateways of a channel, page by page.
+    """
+    cursor = 0
+    while True:
+        res = requests.get(f'{url_bubble}/{GATEWAY_TABLES[channel]}', headers=headers, params={'cursor': cursor, 'limit': 100}, timeout=30)
+        res.raise_for_status()
+        out = res.json()['response']
+        for record in out['results']:
+            if 'Gateway ID' in record:
+                gateway_record_ids[(channel, normalize_number(record['Gateway ID']))] = record['_id']
+        cursor += len(out['results'])
+        if out.get('remaining', 0) <= 0 or len(out['results']) == 0:
+            break
+
+
+
+def sync_gateway_health():
+    """
+    Write the status of every gateway that changed since the last sync to Bubble, in one pass.
+    The record ids of a channel are fetched again when a changed gateway has none, at most once per
+    backoff period for gateways that had no record at the last lookup (their status waits meanwhile).
+    """
+    now = time.time()
+    with gateway_health_lock:
+        changed = [(key, dict(health)) for key, health in gateway_health.items() if health['dirty']]
+        for _, health in gateway_health.items():
+            health['dirty'] = False
+
+    missing = [key for key, _ in changed if key not in gateway_record_ids]
+    lookup = [key for key in missing if gateway_record_misses.get(key, (0, 0))[0] <= now]
+    for channel in set(channel for channel, _ in lookup):
+        try:
+            fetch_gateway_record_ids(channel)
+        except requests.exceptions.RequestException as e:
+            print(f'Failed to fetch gateway records for {channel}: {e}')
+    for key in lookup:
+        if key in gateway_record_ids:
+            gateway_record_misses.pop(key, None)
+        else:
+            backoff = min(GATEWAY_MISS_MAX_BACKOFF, max(GATEWAY_SYNC_INTERVAL, 2 * gateway_record_misses.get(key, (0, 0))[1]))
+            gateway_record_misses[key] = (now + backoff, backoff)
+            print(f'Process: gateway health\t No {GATEWAY_TABLES[key[0]]} record for gateway {key[1]}, looked up again in {backoff:.0f} s')
+
+    for (channel, number), health in changed:
+        record_id = gateway_record_ids.get((channel, number))
+        if record_id is None:
+            with gateway_health_lock:
+                gateway_health[(channel, number)]['dirty'] = True
+            continue
+        payload_status = {
+            'Gateway Port': health['port'],
+            'Gateway Status': True,
+            'Last Check': health['last_check'],
+        }
+        url_status = f'{url_bubble}/{GATEWAY_TABLES[channel]}/{record_id}'
+        enqueue_write('PATCH', url_status, payload_status, body_type='data' if channel == 'sms' else 'json', coalesce_key=url_status)
+
+
+
+def scheduled_sync_gateway_health():
+    """
+    Sync gateway health to Bubble every GATEWAY_SYNC_INTERVAL seconds.
+    """
+    while True:
+        time.sleep(GATEWAY_SYNC_INTERVAL)
+        try:
+            sync_gateway_health()
+        except Exception as e:
+            print(f'Error in sync_gateway_health: {e}')
+
+
+
+def start_gateway_health_sync():
+    """
+    Start the background gateway health sync.
+    """
+    threading.Thread(target=scheduled_sync_gateway_health, daemon=True).start()
+
+
+
+def send_probe(number):
+    """
+    Send the 'the gateway is active' trigger to a gateway number via SMS Masking and record its send time.
+    """
+    params = {
+        "user": NUSA_USER_NAME,
+        "password": NUSA_PASSWORD,
+        "SMSText": 'the gateway is active',
+        "GSM": number,
+        "output": "json",
+    }
+    sent_at = time.time()
+    try:
+        reply_session.get(url_send_sms, params=params, timeout=REPLY_TIMEOUT).raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f'Failed to send gateway probe to {number}: {e}')
+        return False
+    record_probe(number, sent_at)
+    return True
+
+
+
+def send_probes(numbers):
+    """
+    Send probes to several gateway numbers concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(numbers))) as executor:
+        return dict(zip(numbers, executor.map(send_probe, numbers)))
+
+
+
+def format_time(ts):
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') if ts else None
+
+
+
+async def gateway_health_status():
+    """
+    Report last-seen time, pending probe and round-trip latency percentiles (seconds) of every SMS and WA gateway.
+    """
+    now = time.time()
+    status = {'sms': {}, 'wa': {}}
+    with gateway_health_lock:
+        for (channel, number), health in gateway_health.items():
+            latency = list(health['latency'])
+            status[channel][number] = {
+                'port': health['port'],
+                'last_seen': format_time(health['last_seen']),
+                'seconds_since_seen': now - health['last_seen'] if health['last_seen'] else None,
+                'probe_pending_since': format_time(gateway_probes.get(number)),
+                'latency_p50': percentile(latency, 50),
+                'latency_p90': percentile(latency, 90),
+                'latency_p99': percentile(latency, 99),
+                'samples': len(latency),
+            }
+    return status
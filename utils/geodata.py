@@ -0,0 +1,340 @@
+import os
+import json
+import fcntl
+import pickle
+import shutil
+import hashlib
+import threading
+import numpy as np
+from shapely import wkb
+from shapely.prepared import prep
+from shapely.geometry import Point
+from shapely.ops import nearest_points
+
+from config.config import *
+from utils.lazy import gpd
+
+
+
+# Source files of the geodata cache: the kelurahan shapefile and the region tree
+SHAPEFILE_PATH = 'data/location.shp'
+REGION_PATH = 'data/region.json'
+GEODATA_SOURCES = [SHAPEFILE_PATH, 'data/location.shx', 'data/location.dbf', REGION_PATH]
+
+# Layout version of the cache (bump when it changes) and grid cell size in degrees
+GEODATA_VERSION = 1
+GRID_CELL = 0.1
+
+# Region fields of a polygon, in the format used by the Votes table
+REGION_FIELDS = ['Provinsi', 'Kab/Kota', 'Kecamatan', 'Kelurahan']
+
+# Loaded cache (arrays are memory-mapped, so workers share their pages), decoded and prepared polygons
+geodata = None
+geodata_lock = threading.Lock()
+geodata_polygons = {}
+geodata_prepared = {}
+geodata_region_positions = None
+geodata_region_data = None
+
+
+
+def sources_signature():
+    """
+    Return a signature of the source files (size and modification time), naming their cache.
+    """
+    digest = hashlib.sha1(f'v{GEODATA_VERSION}'.encode('utf-8'))
+    for path in GEODATA_SOURCES:
+        try:
+            stat = os.stat(path)
+            digest.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns};'.encode('utf-8'))
+        except FileNotFoundError:
+            digest.update(f'{path}:missing;'.encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+
+def build_geodata(cache_dir):
+    """
+    Compile the shapefile and region tree into `cache_dir`:
+    - wkb.bin / offsets.npy: WKB geometries, concatenated, and their byte offsets
+    - bounds.npy: bounding box of each polygon (minx, miny, maxx, maxy)
+    - codes.npy: Provinsi, Kab/Kota, Kecamatan and Kelurahan of each polygon, as codes into the interned names
+    - cell_start.npy / cell_items.npy: grid of GRID_CELL degree cells listing the polygons whose bounds overlap each cell
+    - meta.json: interned names and grid origin and shape
+    - region.pkl: the region tree
+    """
+    gdf = gpd.read_file(SHAPEFILE_PATH)
+    n = len(gdf)
+
+    names = []
+    name_codes = {}
+    def intern(name):
+        if name not in name_codes:
+            name_codes[name] = len(names)
+            names.append(name)
+        return name_codes[name]
+
+    codes = np.empty((n, 4), dtype=np.int32)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    bounds = np.empty((n, 4), dtype=np.float64)
+    with open(f'{cache_dir}/wkb.bin', 'wb') as wkb_file:
+        for i, (geom, provinsi, kabkota, kecamatan, kelurahan) in enumerate(zip(gdf.geometry, gdf['Provinsi'], gdf['Kab/Kota'], gdf['Kecamatan'], gdf['Kelurahan'])):
+            data = geom.wkb
+            wkb_file.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+            bounds[i] = geom.bounds
+            kabkota = f'Kab. {kabkota}' if kabkota.split(' ')[0] not in ['Kab.', 'Kota'] else kabkota
+            codes[i] = [intern(provinsi), intern(kabkota), intern(kecamatan), intern(kelurahan)]
+
+    # Grid over the bounds of all polygons, stored as CSR (cell -> polygon positions)
+    origin = [float(bounds[:, 0].min()), float(bounds[:, 1].min())]
+    shape = [
+        int(np.floor((bounds[:, 2].max() - origin[0]) / GRID_CELL)) + 1,
+        int(np.floor((bounds[:, 3].max() - origin[1]) / GRID_CELL)) + 1,
+    ]
+    cx0 = np.floor((bounds[:, 0] - origin[0]) / GRID_CELL).astype(np.int64)
+    cy0 = np.floor((bounds[:, 1] - origin[1]) / GRID_CELL).astype(np.int64)
+    cx1 = np.floor((bounds[:, 2] - origin[0]) / GRID_CELL).astype(np.int64)
+    cy1 = np.floor((bounds[:, 3] - origin[1]) / GRID_CELL).astype(np.int64)
+    cells = []
+    items = []
+    for i in range(n):
+        xs, ys = np.meshgrid(np.arange(cx0[i], cx1[i] + 1), np.arange(cy0[i], cy1[i] + 1))
+        cell = (ys * shape[0] + xs).ravel()
+        cells.append(cell)
+        items.append(np.full(len(cell), i, dtype=np.int32))
+    cells = np.concatenate(cells)
+    items = np.concatenate(items)
+    order = np.argsort(cells, kind='stable')
+    cell_start = np.zeros(shape[0] * shape[1] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells, minlength=shape[0] * shape[1]), out=cell_start[1:])
+
+    np.save(f'{cache_dir}/offsets.npy', offsets)
+    np.save(f'{cache_dir}/bounds.npy', bounds)
+    np.save(f'{cache_dir}/codes.npy', codes)
+    np.save(f'{cache_dir}/cell_start.npy', cell_start)
+    np.save(f'{cache_dir}/cell_items.npy', items[order])
+
+    with open(REGION_PATH, 'r') as json_file:
+        region_data = json.load(json_file)
+    with open(f'{cache_dir}/region.pkl', 'wb') as pkl_file:
+        pickle.dump(region_data, pkl_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    with open(f'{cache_dir}/meta.json', 'w') as json_file:
+        json.dump({'names': names, 'origin': origin, 'shape': shape, 'cell': GRID_CELL, 'count': n}, json_file)
+
+
+
+def ensure_geodata():
+    """
+    Return the cache directory of the current source files, building it first when missing.
+    Builds are serialized across workers by a file lock, and older caches are removed.
+    """
+    os.makedirs(GEODATA_CACHE, exist_ok=True)
+    signature = sources_signature()
+    cache_dir = f'{GEODATA_CACHE}/{signature}'
+    if os.path.exists(f'{cache_dir}/meta.json'):
+        return cache_dir
+
+    with open(f'{GEODATA_CACHE}/.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if not os.path.exists(f'{cache_dir}/meta.json'):
+            print(f'Process: geodata\t Building cache {cache_dir}')
+            tmp_dir = f'{cache_dir}.tmp'
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            build_geodata(tmp_dir)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            os.rename(tmp_dir, cache_dir)
+            for name in os.listdir(GEODATA_CACHE):
+                if name not in (signature, '.lock'):
+                    shutil.rmtree(f'{GEODATA_CACHE}/{name}', ignore_errors=True)
+    return cache_dir
+
+
+
+def get_geodata():
+    """
+    Return the geodata cache, loading it (memory-mapped) on first use.
+    """
+    global geodata
+    if geodata is None:
+        with geodata_lock:
+            if geodata is None:
+                cache_dir = ensure_geodata()
+                with open(f'{cache_dir}/meta.json', 'r') as json_file:
+                    meta = json.load(json_file)
+                meta.update({
+                    'wkb': np.memmap(f'{cache_dir}/wkb.bin', dtype=np.uint8, mode='r'),
+                    'offsets': np.load(f'{cache_dir}/offsets.npy', mmap_mode='r'),
+                    'bounds': np.load(f'{cache_dir}/bounds.npy', mmap_mode='r'),
+                    'codes': np.load(f'{cache_dir}/codes.npy', mmap_mode='r'),
+                    'cell_start': np.load(f'{cache_dir}/cell_start.npy', mmap_mode='r'),
+                    'cell_items': np.load(f'{cache_dir}/cell_items.npy', mmap_mode='r'),
+                    'dir': cache_dir,
+                })
+                geodata = meta
+    return geodata
+
+
+
+def get_region_data():
+    """
+    Return the region tree (Provinsi -> Kab/Kota -> Kecamatan -> [Kelurahan]), loading it from the geodata cache on first use.
+    """
+    global geodata_region_data
+    if geodata_region_data is None:
+        with open(f"{get_geodata()['dir']}/region.pkl", 'rb') as pkl_file:
+            geodata_region_data = pickle.load(pkl_file)
+    return geodata_region_data
+
+
+
+def polygon(i):
+    """
+    Return the polygon at position i, decoding its WKB on first use.
+    """
+    geom = geodata_polygons.get(i)
+    if geom is None:
+        data = get_geodata()
+        geom = geodata_polygons.setdefault(i, wkb.loads(bytes(data['wkb'][data['offsets'][i]:data['offsets'][i + 1]])))
+    return geom
+
+
+
+def prepared_polygon(i):
+    """
+    Return the prepared geometry of the polygon at position i, preparing it on first use.
+    """
+    prepared = geodata_prepared.get(i)
+    if prepared is None:
+        prepared = geodata_prepared.setdefault(i, prep(polygon(i)))
+    return prepared
+
+
+
+def polygon_region(i):
+    """
+    Return the region names of the polygon at position i.
+    """
+    data = get_geodata()
+    return {field: data['names'][code] for field, code in zip(REGION_FIELDS, data['codes'][i])}
+
+
+
+def region_position(region):
+    """
+    Return the position of the polygon of a region [Provinsi, Kab/Kota, Kecamatan, Kelurahan], or None.
+    """
+    global geodata_region_positions
+    if geodata_region_positions is None:
+        data = get_geodata()
+        positions = {}
+        for i, codes in enumerate(np.asarray(data['codes']).tolist()):
+            positions.setdefault(tuple(data['names'][code] for code in codes), i)
+        geodata_region_positions = positions
+    return geodata_region_positions.get(tuple(region))
+
+
+
+def grid_cells(xs, ys):
+    """
+    Return the grid cell of each point (-1 outside the grid).
+    """
+    data = get_geodata()
+    nx, ny = data['shape']
+    cx = np.floor((xs - data['origin'][0]) / data['cell']).astype(np.int64)
+    cy = np.floor((ys - data['origin'][1]) / data['cell']).astype(np.int64)
+    inside = (cx >= 0) & (cx < nx) & (cy >= 0) & (cy < ny)
+    return np.where(inside, cy * nx + cx, -1)
+
+
+
+def locate_polygon(x, y, cell):
+    """
+    Return the position of the polygon containing the point (x, y) in the given grid cell, or None.
+    """
+    if cell < 0:
+        return None
+    data = get_geodata()
+    items = data['cell_items'][data['cell_start'][cell]:data['cell_start'][cell + 1]]
+    bounds = data['bounds'][items]
+    candidates = items[(bounds[:, 0] <= x) & (bounds[:, 2] >= x) & (bounds[:, 1] <= y) & (bounds[:, 3] >= y)]
+    point = Point(x, y)
+    for i in candidates:
+        if prepared_polygon(int(i)).contains(point):
+            return int(i)
+    return None
+
+
+
+def polygon_distance(i, point):
+    """
+    Return the distance in meters from a point to the polygon at position i (0 inside it).
+    """
+    nearest = nearest_points(polygon(i), point)[0]
+    lon1, lat1, lon2, lat2 = np.radians([point.x, point.y, nearest.x, nearest.y])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return float(2 * 6371000 * np.arcsin(np.sqrt(a)))
+
+
+
+def get_location(coordinate):
+    """
+    Get location details based on coordinates.
+    Raises ValueError when no region contains the coordinate.
+    """
+    location = get_locations([coordinate])[0]
+    if location is None:
+        raise ValueError(f'No region contains coordinate {tuple(coordinate)}')
+    return location
+
+
+
+def get_locations(coordinates):
+    """
+    Get location details of many coordinates in one call (e.g. a whole SurveyCTO pull).
+    Grid cells are computed for all points at once and repeated coordinates are looked up once.
+    Returns one entry per coordinate, None when the coordinate is missing or outside every region.
+    """
+    keys = sorted(set(tuple(coordinate) for coordinate in coordinates if coordinate is not None))
+    if len(keys) == 0:
+        return [None] * len(coordinates)
+    points = np.array(keys, dtype=np.float64)
+    cells = grid_cells(points[:, 0], points[:, 1])
+    found = {key: locate_polygon(x, y, cell) for key, (x, y), cell in zip(keys, points, cells)}
+    return [
+        polygon_region(found[tuple(coordinate)]) if coordinate is not None and found[tuple(coordinate)] is not None else None
+        for coordinate in coordinates
+    ]
+
+
+
+def verify_locations(coordinates, expected_regions):
+    """
+    Check coordinates against the polygon of their expected region [Provinsi, Kab/Kota, Kecamatan, Kelurahan].
+
+    A coordinate inside its expected polygon is verified with one prepared `contains` test. Only the
+    others are geocoded (in one `get_locations` call), with their distance in meters to the expected polygon.
+    Returns (location, GPS status, distance) per coordinate, None when the coordinate or expected region is missing.
+    """
+    results = []
+    misses = []
+    for n, (coordinate, expected) in enumerate(zip(coordinates, expected_regions)):
+        if coordinate is None or expected is None:
+            results.append(None)
+            continue
+        point = Point(coordinate)
+        i = region_position(expected)
+        if i is not None and prepared_polygon(i).contains(point):
+            results.append((polygon_region(i), 'Verified', 0.0))
+        else:
+            results.append((i, point, list(expected)))
+            misses.append(n)
+
+    locations = get_locations([results[n][1].coords[0] for n in misses])
+    for n, loc in zip(misses, locations):
+        i, point, expected = results[n]
+        status = 'Verified' if loc is not None and [loc[k] for k in REGION_FIELDS] == expected else 'Not Verified'
+        results[n] = (loc, status, polygon_distance(i, point) if i is not None else None)
+    return results
@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from config.config import *
+from utils.dispatcher import percentile
+
+
+
+# Background jobs, most recent last, and where finished jobs are kept on the local disk
+jobs = OrderedDict()
+jobs_lock = threading.Lock()
+JOBS_DIR = f'{local_disk}/jobs'
+
+# Number of jobs kept in memory (older ones are read back from the local disk)
+JOBS_KEEP = 1000
+
+# Serializes attaching to / creating jobs by key
+job_keys_lock = threading.Lock()
+
+# Job files not updated for JOB_RETENTION seconds are removed, checked at most once per hour
+jobs_pruned = {'at': 0}
+
+# Identifies this process among the processes that had its pid before (e.g. pid 1 after a container restart).
+# Written to JOBS_DIR/boot_{pid}.json by the first job created, and stored in each job next to the pid.
+jobs_boot = {'id': uuid.uuid4().hex, 'registered': False}
+
+
+
+def save_job(job):
+    """
+    Write a job to the local disk. Called with jobs_lock held.
+    """
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    job['updated'] = time.time()
+    tmp_path = f"{JOBS_DIR}/{job['id']}.json.tmp"
+    with open(tmp_path, 'w') as json_file:
+        json.dump({k: v for k, v in job.items() if not k.startswith('_')}, json_file, default=str)
+    os.replace(tmp_path, f"{JOBS_DIR}/{job['id']}.json")
+
+
+
+def prune_jobs():
+    """
+    Remove the files of jobs not updated for JOB_RETENTION seconds, and the key files of removed jobs.
+    Called with jobs_lock held.
+    """
+    now = time.time()
+    if now - jobs_pruned['at'] < 3600 or not os.path.isdir(JOBS_DIR):
+        return
+    jobs_pruned['at'] = now
+    names = os.listdir(JOBS_DIR)
+    for name in names:
+        path = f'{JOBS_DIR}/{name}'
+        if not name.startswith(('key_', 'boot_')) and name.endswith('.json') and name[:-len('.json')] not in jobs:
+            try:
+                if now - os.path.getmtime(path) > JOB_RETENTION:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+    for name in names:
+        if name.startswith('key_'):
+            path = f'{JOBS_DIR}/{name}'
+            try:
+                with open(path, 'r') as json_file:
+                    job_id = json.load(json_file)['id']
+                if not os.path.exists(f'{JOBS_DIR}/{job_id}.json'):
+                    os.remove(path)
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+
+
+
+def create_job(kind, params, key=None):
+    """
+    Register a new job and return its id. A job with a key (e.g. the hash of its input) can be
+    found again with `find_job`.
+    """
+    job = {
+        'id': uuid.uuid4().hex,
+        'kind': kind,
+        'key': key,
+        'pid': os.getpid(),
+        'boot': jobs_boot['id'],
+        'params': params,
+        'status': 'queued',
+        'created': datetime.now().isoformat(),
+        'started': None,
+        'finished': None,
+        'stage': None,
+        'progress': {'total': 0, 'done': 0, 'failed': 0},
+        'failures': [],
+        'timings': {},
+        'result': None,
+        'error': None,
+        '_durations': [],
+    }
+    with jobs_lock:
+        prune_jobs()
+        if not jobs_boot['registered']:
+            os.makedirs(JOBS_DIR, exist_ok=True)
+            with open(f"{JOBS_DIR}/boot_{job['pid']}.json", 'w') as json_file:
+                json.dump({'boot': jobs_boot['id']}, json_file)
+            jobs_boot['registered'] = True
+        jobs[job['id']] = job
+        for old_id in [k for k, v in jobs.items() if v['finished']][:max(0, len(jobs) - JOBS_KEEP)]:
+            del jobs[old_id]
+        save_job(job)
+        if key is not None:
+            with open(f'{JOBS_DIR}/key_{kind}_{key}.json', 'w') as json_file:
+                json.dump({'id': job['id']}, json_file)
+    return job['id']
+
+
+
+def read_job(job_id):
+    """
+    Return the state of a job (from memory, or from the local disk for jobs of other workers), or None.
+    """
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            status = {k: v for k, v in job.items() if not k.startswith('_')}
+            status['progress'] = dict(job['progress'])
+            status['failures'] = list(job['failures'])
+            status['timings'] = dict(job['timings'])
+            return status
+    try:
+        with open(f'{JOBS_DIR}/{os.path.basename(job_id)}.json', 'r') as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return None
+
+
+
+def job_alive(job):
+    """
+    Whether an unfinished job is still being worked on: by this worker, or by another worker
+    that is alive and updated it within the last JOB_STALE seconds. A worker is identified by its pid
+    and boot id, as pids are reused after a restart: a job of an earlier boot is dead.
+    """
+    with jobs_lock:
+        if job['id'] in jobs:
+            return True
+    if job.get('boot') is None or job['boot'] == jobs_boot['id']:
+        return False
+    try:
+        os.kill(job['pid'], 0)
+        with open(f"{JOBS_DIR}/boot_{job['pid']}.json", 'r') as json_file:
+            if json.load(json_file)['boot'] != job['boot']:
+                return False
+    except (OSError, KeyError, TypeError, ValueError):
+        return False
+    return time.time() - job.get('updated', 0) < JOB_STALE
+
+
+
+def find_job(kind, key, finished=True):
+    """
+    Return the job of a kind with the given key that can be attached to: queued or running, or (with
+    `finished`) finished with its result file still on disk. Returns None otherwise.
+    """
+    try:
+        with open(f'{JOBS_DIR}/key_{kind}_{key}.json', 'r') as json_file:
+            job = read_job(json.load(json_file)['id'])
+    except (FileNotFoundError, ValueError):
+        return None
+    if job is None:
+        return None
+    if job['status'] in ('queued', 'running'):
+        return job if job_alive(job) else None
+    if finished and job['status'] == 'finished':
+        result = job.get('result') or {}
+        return job if not result.get('file') or os.path.exists(result['file']) else None
+    return None
+
+
+
+def submit_job(executor, kind, key, params, fn, *args, prepare=None, finished=True):
+    """
+    Run `fn(*args)` as a job of the given kind and key, unless such a job can be attached to (see `find_job`,
+    `finished` telling whether a finished job's result is reused). `prepare` is called before a new job
+    is created (e.g. to store its input). Returns the job state.
+    """
+    with job_keys_lock:
+        job = find_job(kind, key, finished)
+        if job is not None:
+            return job
+        if prepare is not None:
+            prepare()
+        job_id = create_job(kind, params, key=key)
+        run_job(executor, job_id, fn, *args)
+    return read_job(job_id)
+
+
+
+async def job_response(job, async_job):
+    """
+    Return the state of a submitted job right away (async_job), or wait for it and stream its result file.
+    """
+    if async_job:
+        return {
+            'job_id': job['id'],
+            'status': job['status'],
+            'stage': job['stage'],
+            'progress': job['progress'],
+            'status_url': f"/jobs/{job['id']}",
+            'download_url': f"/jobs/{job['id']}/download",
+        }
+    return job_file_response(await wait_for_job(job['id']))
+
+
+
+def set_job_progress(job_id, done, total=None, failed=None):
+    """
+    Update the progress counts of a job's current stage.
+    """
+    if job_id is None:
+        return
+    with jobs_lock:
+        job = jobs[job_id]
+        job['progress']['done'] = done
+        if total is not None:
+            job['progress']['total'] = total
+        if failed is not None:
+            job['progress']['failed'] = failed
+        save_job(job)
+
+
+
+def start_job(job_id, stage=None):
+    """
+    Mark a job as running.
+    """
+    if job_id is None:
+        return
+    with jobs_lock:
+        job = jobs[job_id]
+        job.update(status='running', started=datetime.now().isoformat(), stage=stage, _start=time.time())
+        save_job(job)
+
+
+
+def set_job_stage(job_id, stage, total=None):
+    """
+    Move a job to its next stage, recording how long the previous stage took.
+    The progress counts start over, with the stage's total when known.
+    """
+    if job_id is None:
+        return
+    with jobs_lock:
+        job = jobs[job_id]
+        now = time.time()
+        if job['stage'] is not None:
+            job['timings'][job['stage']] = now - job.get('_stage_start', job['_start'])
+        job['stage'] = stage
+        job['_stage_start'] = now
+        job['progress'] = {'total': total or 0, 'done': 0, 'failed': 0}
+        save_job(job)
+
+
+
+def record_job_item(job_id, key, duration, error=None):
+    """
+    Count one processed item of a job, with its duration and the error when it failed.
+    """
+    if job_id is None:
+        return
+    with jobs_lock:
+        job = jobs[job_id]
+        job['progress']['done'] += 1
+        job['_durations'].append(duration)
+        if error is not None:
+            job['progress']['failed'] += 1
+            job['failures'].append({'key': key, 'error': error})
+
+
+
+def finish_job(job_id, result=None, error=None):
+    """
+    Mark a job as finished (or failed), with its result and timings.
+    """
+    if job_id is None:
+        return
+    with jobs_lock:
+        job = jobs[job_id]
+        now = time.time()
+        if job['stage'] is not None:
+            job['timings'][job['stage']] = now - job.get('_stage_start', job.get('_start', now))
+        durations = job['_durations']
+        job['timings'].update({
+            'total': now - job.get('_start', now),
+            'item_p50': percentile(durations, 50),
+            'item_p90': percentile(durations, 90),
+            'item_max': max(durations) if durations else None,
+        })
+        job.update(status='failed' if error else 'finished', finished=datetime.now().isoformat(), stage=None, result=result, error=error)
+        save_job(job)
+
+
+
+def run_job(executor, job_id, fn, *args, **kwargs):
+    """
+    Run `fn` as a job in the given executor. Its return value becomes the job result.
+    """
+    def run():
+        start_job(job_id)
+        try:
+            result = fn(*args, job_id=job_id, **kwargs)
+        except Exception as e:
+            print(f'Process: job {job_id}\t Keyword: {e}')
+            finish_job(job_id, error=str(e))
+            return
+        finish_job(job_id, result=result)
+    return executor.submit(run)
+
+
+
+async def get_job_status(job_id: str):
+    """
+    Report the status, stage, progress, failures, timings and result of a job.
+    """
+    job = read_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Job {job_id} not found')
+    return job
+
+
+
+async def wait_for_job(job_id):
+    """
+    Wait until a job finished, and return its state. Raises HTTPException when it failed or was abandoned.
+    """
+    while True:
+        job = read_job(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f'Job {job_id} not found')
+        if job['status'] == 'finished':
+            return job
+        if job['status'] == 'failed':
+            raise HTTPException(status_code=500, detail=job['error'])
+        if not job_alive(job):
+            raise HTTPException(status_code=500, detail=f'Job {job_id} was abandoned, submit it again')
+        await asyncio.sleep(1)
+
+
+
+def job_file_response(job):
+    """
+    Stream the result file of a finished job.
+    """
+    file_path = job['result']['file']
+
+    def file_generator():
+        with open(file_path, 'rb') as file_content:
+            yield from file_content
+
+    response = StreamingResponse(file_generator(), media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    response.headers["Content-Disposition"] = f"attachment; filename={job['result']['filename']}"
+    return response
+
+
+
+# Download the result file of a finished job
+async def download_job_file(job_id: str):
+    job = read_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Job {job_id} not found')
+    if job['status'] != 'finished':
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']}")
+    if not (job.get('result') or {}).get('file') or not os.path.exists(job['result']['file']):
+        raise HTTPException(status_code=410, detail=f'The result of job {job_id} is no longer available')
+    return job_file_response(job)
@@ -0,0 +1,337 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import asyncio
+import threading
+
+from config.config import *
+
+
+
+def resolve_future(future, seq=None, error=None):
+    """
+    Complete a commit future (on its event loop) with the sequence number of the committed record.
+    """
+    if future.done():
+        return
+    if error is None:
+        future.set_result(seq)
+    else:
+        future.set_exception(error)
+
+
+
+class Journal:
+    """
+    Append-only JSON-lines journal (e.g. sms_inbox.json) written by a single writer thread.
+
+    Lines are group-committed: everything appended while the previous write was running goes out in one
+    write, followed by an fsync according to JOURNAL_FSYNC ('always', 'interval' or 'never').
+    The active file is rotated by size (JOURNAL_MAX_BYTES) or day into gzip segments, and a sidecar
+    index ({name}.index.json) keeps, per segment, the first sequence number, line count, first/last
+    receive date and the byte offset of every JOURNAL_INDEX_EVERY-th line.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.path = f'{local_disk}/{name}.json'
+        self.index_path = f'{local_disk}/{name}.index.json'
+        self.cond = threading.Condition()
+        self.pending = []
+        self.opened = False
+        # Segment index and the state of the active file, guarded by index_lock
+        self.index_lock = threading.Lock()
+        self.segments = []
+        self.active = None
+        self.file = None
+
+    def new_active(self, first_seq):
+        return {'first_seq': first_seq, 'count': 0, 'size': 0, 'first_ts': None, 'last_ts': None, 'min_ts': None, 'max_ts': None, 'offsets': [], 'day': None}
+
+    def open(self):
+        """
+        Load the segment index, recover the active file and start the writer thread.
+        """
+        try:
+            with open(self.index_path, 'r') as json_file:
+                self.segments = json.load(json_file)['segments']
+        except FileNotFoundError:
+            self.segments = []
+        next_seq = self.segments[-1]['first_seq'] + self.segments[-1]['count'] if self.segments else 0
+        self.active = self.new_active(next_seq)
+        self.load_active()
+
+        # Finish compressing segments interrupted by a restart
+        for segment in self.segments:
+            if not segment['file'].endswith('.gz') and os.path.exists(f"{local_disk}/{segment['file']}"):
+                threading.Thread(target=self.compress, args=(segment,), daemon=True).start()
+
+        self.file = open(self.path, 'ab')
+        threading.Thread(target=self.writer, daemon=True).start()
+        self.opened = True
+
+    def load_active(self):
+        """
+        Drop a partial last line of the active file (left by a crash or a failed write), then rebuild its index.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.truncate(end)
+        offset = 0
+        for line in data[:end].splitlines(keepends=True):
+            self.track_line(line, offset)
+            offset += len(line)
+        self.active['day'] = time.strftime('%Y%m%d', time.localtime(os.path.getmtime(self.path)))
+
+    def recover(self):
+        """
+        Bring the active file back to the lines fully written after a failed write: records still buffered
+        are dropped, and the file is reopened with its index rebuilt. Called by the writer with index_lock held.
+        """
+        try:
+            self.file.close()
+        except Exception:
+            pass
+        self.active = self.new_active(self.active['first_seq'])
+        self.load_active()
+        self.file = open(self.path, 'ab')
+
+    def start(self):
+        """
+        Open the journal unless it is open already. Called on startup, so the first append
+        does not rebuild the active file's index on the request path.
+        """
+        with self.cond:
+            if not self.opened:
+                self.open()
+
+    def track_line(self, line, offset, receive_date=None):
+        """
+        Update the active file's index with a line written at `offset`.
+        """
+        active = self.active
+        if active['count'] % JOURNAL_INDEX_EVERY == 0:
+            active['offsets'].append([active['first_seq'] + active['count'], offset])
+        if receive_date is None:
+            try:
+                receive_date = json.loads(line).get('Receive Date')
+            except ValueError:
+                receive_date = None
+        if active['first_ts'] is None:
+            active['first_ts'] = receive_date
+        active['last_ts'] = receive_date or active['last_ts']
+        if receive_date:
+            active['min_ts'] = min(active['min_ts'] or receive_date, receive_date)
+            active['max_ts'] = max(active['max_ts'] or receive_date, receive_date)
+        active['count'] += 1
+        active['size'] = offset + len(line)
+
+    def append(self, record, waiter=None):
+        """
+        Queue a record for the next group commit. `waiter` is an (event loop, future) pair resolved once committed.
+        """
+        with self.cond:
+            if not self.opened:
+                self.open()
+            self.pending.append((record, waiter))
+            self.cond.notify()
+
+    async def write(self, record):
+        """
+        Append a record and wait until it is committed (written, and fsynced when JOURNAL_FSYNC is 'always').
+        Returns the sequence number of the record.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.append(record, (loop, future))
+        return await future
+
+    def next_seq(self):
+        """
+        Return the sequence number the next committed record will get.
+        """
+        self.start()
+        with self.index_lock:
+            return self.active['first_seq'] + self.active['count']
+
+    def writer(self):
+        """
+        Write queued records in groups and fsync them according to the configured policy.
+        """
+        last_sync = time.monotonic()
+        dirty = False
+        while True:
+            with self.cond:
+                if not self.pending:
+                    self.cond.wait(timeout=JOURNAL_FSYNC_INTERVAL)
+                batch, self.pending = self.pending, []
+
+            error = None
+            seqs = []
+            try:
+                if batch:
+                    with self.index_lock:
+                        for record, _ in batch:
+                            today = time.strftime('%Y%m%d')
+                            if self.active['count'] and (self.active['size'] >= JOURNAL_MAX_BYTES or self.active['day'] != today):
+                                self.rotate()
+                            if self.active['day'] is None:
+                                self.active['day'] = today
+                            line = (json.dumps(record) + '\n').encode('utf-8')
+                            self.file.write(line)
+                            seqs.append(self.active['first_seq'] + self.active['count'])
+                            self.track_line(line, self.active['size'], record.get('Receive Date'))
+                    self.file.flush()
+                    dirty = True
+
+                now = time.monotonic()
+                if dirty and (JOURNAL_FSYNC == 'always' or (JOURNAL_FSYNC == 'interval' and now - last_sync >= JOURNAL_FSYNC_INTERVAL)):
+                    os.fsync(self.file.fileno())
+                    last_sync = now
+                    dirty = False
+            except Exception as e:
+                error = e
+                print(f'Process: journal {self.name}\t Keyword: {e}')
+                try:
+                    with self.index_lock:
+                        self.recover()
+                except Exception as e:
+                    print(f'Process: journal {self.name}\t Recovery failed, keyword: {e}')
+
+            # After a failure, the records that made it to the file are committed all the same
+            with self.index_lock:
+                committed = self.active['first_seq'] + self.active['count']
+            for i, (_, waiter) in enumerate(batch):
+                if waiter:
+                    loop, future = waiter
+                    if i < len(seqs) and (error is None or seqs[i] < committed):
+                        loop.call_soon_threadsafe(resolve_future, future, seqs[i])
+                    else:
+                        loop.call_soon_threadsafe(resolve_future, future, None, error)
+
+    def rotate(self):
+        """
+        Close the active file as a segment and start a new one. The segment is compressed in the background.
+        On failure the active file is left as it was, still open. Called by the writer with index_lock held.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        segment_file = f"{self.name}.{stamp}.{self.active['first_seq']}.json"
+        segment = {k: self.active[k] for k in ['first_seq', 'count', 'first_ts', 'last_ts', 'min_ts', 'max_ts', 'offsets']}
+        segment['file'] = segment_file
+        os.replace(self.path, f'{local_disk}/{segment_file}')
+        try:
+            self.segments.append(segment)
+            self.save_index()
+            new_file = open(self.path, 'ab')
+        except Exception:
+            # Put the active file back
+            if self.segments and self.segments[-1] is segment:
+                self.segments.pop()
+            os.replace(f'{local_disk}/{segment_file}', self.path)
+            self.save_index()
+            raise
+
+        self.file.close()
+        self.file = new_file
+        self.active = self.new_active(segment['first_seq'] + segment['count'])
+        threading.Thread(target=self.compress, args=(segment,), daemon=True).start()
+
+    def snapshot(self):
+        """
+        Return the committed segments and active file as a list of sources to read from.
+        The active file is pinned by its inode, as it may be rotated before it is read.
+        """
+        self.start()
+        with self.index_lock:
+            sources = [dict(segment, offsets=list(segment['offsets'])) for segment in self.segments]
+            sources.append(dict(self.active, offsets=list(self.active['offsets']), file=f'{self.name}.json', inode=os.fstat(self.file.fileno()).st_ino))
+        return sources
+
+    def open_source(self, source):
+        """
+        Open a source of a snapshot: the segment the active file became if it was rotated since,
+        and the compressed segment if it was compressed since.
+        """
+        path = f"{local_disk}/{source['file']}"
+        if 'inode' in source:
+            try:
+                f = open(path, 'rb')
+                if os.fstat(f.fileno()).st_ino == source['inode']:
+                    return f
+                f.close()
+            except FileNotFoundError:
+                pass
+            with self.index_lock:
+                path = next((f"{local_disk}/{segment['file']}" for segment in self.segments if segment['first_seq'] == source['first_seq']), path)
+        for candidate in [path] if path.endswith('.gz') else [path, path + '.gz']:
+            try:
+                return gzip.open(candidate, 'rb') if candidate.endswith('.gz') else open(candidate, 'rb')
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(path)
+
+    def read(self, sources, start_seq=0, start=None, end=None):
+        """
+        Yield (sequence number, record) from `start_seq` on, seeking through the offset index.
+        Sources whose receive dates are all outside [start, end] are skipped without being read,
+        and a last line not fully written yet (no newline) is left out.
+        """
+        for source in sources:
+            last_seq = source['first_seq'] + source['count']
+            if source['count'] == 0 or last_seq <= start_seq:
+                continue
+            min_ts = source.get('min_ts', source['first_ts'])
+            max_ts = source.get('max_ts', source['last_ts'])
+            if (start and max_ts and max_ts < start) or (end and min_ts and min_ts > end):
+                continue
+
+            seq, offset = source['first_seq'], 0
+            for s, o in source['offsets']:
+                if s <= start_seq:
+                    seq, offset = s, o
+
+            with self.open_source(source) as f:
+                f.seek(offset)
+                for line in f:
+                    if seq >= last_seq or not line.endswith(b'\n'):
+                        break
+                    if seq >= start_seq:
+                        yield seq, json.loads(line)
+                    seq += 1
+
+    def compress(self, segment):
+        """
+        Gzip a rotated segment and point the index to the compressed file.
+        """
+        source = f"{local_disk}/{segment['file']}"
+        target = source + '.gz'
+        with open(source, 'rb') as f_in, gzip.open(target + '.tmp', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.replace(target + '.tmp', target)
+        with self.index_lock:
+            segment['file'] = segment['file'] + '.gz'
+            self.save_index()
+        os.remove(source)
+
+    def save_index(self):
+        """
+        Write the segment index to the sidecar file.
+        """
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump({'segments': self.segments}, json_file)
+        os.replace(tmp_path, self.index_path)
+
+
+
+# Inbox journals of received messages
+sms_journal = Journal('sms_inbox')
+wa_journal = Journal('wa_inbox')
@@ -0,0 +1,26 @@
+import importlib
+
+
+
+class LazyModule:
+    """
+    Module imported on first attribute access, so that importing the server does not load
+    heavy dependencies that only some endpoints and background tasks need.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+
+# Heavy dependencies, and the modules of ours that import them at module level
+pd = LazyModule('pandas')
+gpd = LazyModule('geopandas')
+pysurveycto = LazyModule('pysurveycto')
+geodata = LazyModule('utils.geodata')
+region_match = LazyModule('utils.region_match')
@@ -0,0 +1,77 @@
+# Maximum number of votes (valid + invalid) accepted for one TPS
+MAX_TOTAL_VOTES = 700
+
+# Reply for messages that cannot be parsed at all
+MSG_UNRECOGNIZED = 'Format tidak dikenali. Kirim ulang dengan format yg sudah ditentukan. Contoh utk 3 paslon:\nKK#UID#EventID#01#02#03#Rusak'
+
+
+
+def compile_spec(n_candidate):
+    """
+    Build the message spec of an event: expected field count and prebuilt reply templates.
+    Messages look like KK#UID#EventID#01#02#...#Rusak, with one vote field per candidate.
+    """
+    format = 'KK#UID#EventID#' + '#'.join([f'0{i+1}' for i in range(n_candidate)]) + '#Rusak'
+    template_error_msg = 'cek & kirim ulang dgn format:\n' + format
+    return {
+        'n_candidate': n_candidate,
+        'n_fields': n_candidate + 4,
+        'format': format,
+        'msg_unregistered': 'UID "{uid}" tidak terdaftar untuk EventID "{event}", ' + template_error_msg,
+        'msg_incomplete': 'Data tidak lengkap, ' + template_error_msg,
+        'msg_too_many': f'Jumlah suara melebihi {MAX_TOTAL_VOTES}, ' + template_error_msg,
+        'msg_accepted': 'Berhasil diterima. Utk koreksi, kirim ulang dgn format yg sama:\n' + format,
+        'summary': 'EventID: {event}\n' + ''.join([f'Paslon_{i+1}: {{votes[{i}]}}\n' for i in range(n_candidate)]) + 'Tidak Sah: {invalid}\nTotal: {total}\n',
+    }
+
+
+
+def split_message(msg):
+    """
+    Split a message into lowercase fields and remove spaces.
+    """
+    return [part.strip() for part in msg.lower().split('#')]
+
+
+
+def parse_votes(info):
+    """
+    Parse the vote fields of a split message.
+    Returns (votes, invalid, total); raises ValueError on non-integer fields.
+    """
+    votes = [int(v) for v in info[3:-1]]
+    invalid = int(info[-1])
+    return votes, invalid, sum(votes) + invalid
+
+
+
+def check_message(spec, info, uids):
+    """
+    Validate a split KK# message against the event's spec and registered UIDs.
+
+    Returns a dictionary with the error type (None when accepted), the reply message and,
+    when the votes could be parsed, the votes, invalid count and total.
+    Raises on unparsable vote fields (error type 1 for the caller).
+    """
+    uid, event = info[1], info[2]
+    result = {'uid': uid, 'event': event, 'error_type': None, 'votes': None, 'invalid': None, 'total': None}
+
+    # Check Error Type 2 (UID within the context of EventID)
+    if uid not in uids:
+        result['error_type'] = 2
+        result['message'] = spec['msg_unregistered'].format(uid=uid.upper(), event=event)
+    # Check Error Type 3 (number of fields)
+    elif len(info) != spec['n_fields']:
+        result['error_type'] = 3
+        result['message'] = spec['msg_incomplete']
+    else:
+        votes, invalid, total = parse_votes(info)
+        summary = spec['summary'].format(event=event, votes=votes, invalid=invalid, total=total)
+        result.update(votes=votes, invalid=invalid, total=total)
+        # Check Error Type 4 (total votes)
+        if total > MAX_TOTAL_VOTES:
+            result['error_type'] = 4
+            result['message'] = summary + spec['msg_too_many']
+        else:
+            result['message'] = summary + spec['msg_accepted']
+    return result
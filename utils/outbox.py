@@ -0,0 +1,311 @@
+import json
+import time
+import random
+import sqlite3
+import requests
+import threading
+from urllib3.exceptions import NewConnectionError
+from fastapi import Form, Query, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+
+from config.config import *
+
+
+
+# Pooled HTTP session for Bubble writes
+bubble_session = requests.Session()
+bubble_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=OUTBOX_CONCURRENCY))
+bubble_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=OUTBOX_CONCURRENCY))
+
+# SQLite connection (WAL mode) shared by the request handlers and the sender
+outbox_lock = threading.Lock()
+outbox_db = None
+
+# Rows currently being sent (id -> coalesce key), and a signal to wake the sender up
+outbox_in_flight = {}
+outbox_wakeup = threading.Event()
+
+
+
+def outbox_connection():
+    """
+    Open the outbox database on first use.
+    """
+    global outbox_db
+    if outbox_db is None:
+        db = sqlite3.connect(f'{local_disk}/outbox.db', check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, method TEXT, url TEXT, body TEXT, body_type TEXT, '
+            'coalesce_key TEXT, created REAL, attempts INTEGER DEFAULT 0, next_attempt REAL, '
+            "status TEXT DEFAULT 'pending', last_error TEXT)"
+        )
+        # Rows of bulk-inserted tables (RAW logs), sent by the RAW log flusher instead of the sender, and
+        # POSTs whose record may exist already, looked up by their unique fields before they are sent
+        for column in ['bulk_table TEXT', 'unique_fields TEXT', 'check_first INTEGER DEFAULT 0']:
+            try:
+                db.execute(f'ALTER TABLE outbox ADD COLUMN {column}')
+            except sqlite3.OperationalError:
+                pass
+        db.execute('CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_attempt)')
+        db.execute('CREATE INDEX IF NOT EXISTS outbox_key ON outbox (coalesce_key, status)')
+        outbox_db = db
+    return outbox_db
+
+
+
+def encode_value(value):
+    """
+    Convert values that JSON does not know (NumPy scalars, datetimes) the way requests would send them.
+    """
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+
+def enqueue_write(method, url, payload, body_type='data', coalesce_key=None, bulk_table=None, unique_fields=None):
+    """
+    Record a Bubble write in the outbox before it is sent.
+
+    Parameters:
+    - method: HTTP method ('POST' or 'PATCH').
+    - url: Target URL.
+    - payload: Dictionary for 'data' (form) and 'json' bodies, or a string for 'text' (bulk) bodies.
+    - body_type: How the payload is sent: 'data', 'json' or 'text'.
+    - coalesce_key: Writes with the same key that are still pending are merged into one, the newer fields winning.
+    - bulk_table: Table the row is inserted into in bulk, by the RAW log flusher (see utils.rawlog).
+    - unique_fields: Fields identifying the record, to look it up when the outcome of its insert is unknown
+      (a POST that timed out, or enqueued while a POST to its key was in flight) and update it instead.
+    """
+    body = payload if body_type == 'text' else json.dumps(payload, default=encode_value)
+    now = time.time()
+    with outbox_lock:
+        db = outbox_connection()
+        row = None
+        check_first = 0
+        if coalesce_key is not None:
+            for row_id, row_body in db.execute(
+                "SELECT id, body FROM outbox WHERE coalesce_key = ? AND status = 'pending' AND body_type = ? ORDER BY id DESC LIMIT 1",
+                (coalesce_key, body_type)
+            ):
+                if row_id not in outbox_in_flight:
+                    row = (row_id, row_body)
+                elif method == 'POST' and unique_fields and bulk_table is None:
+                    # The write in flight may create the record: this one looks it up first
+                    check_first = 1
+        if row:
+            merged = json.loads(row[1])
+            merged.update(json.loads(body))
+            db.execute('UPDATE outbox SET body = ? WHERE id = ?', (json.dumps(merged), row[0]))
+        else:
+            db.execute(
+                'INSERT INTO outbox (method, url, body, body_type, coalesce_key, created, next_attempt, bulk_table, unique_fields, check_first) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (method, url, body, body_type, coalesce_key, now, now, bulk_table, json.dumps(unique_fields) if unique_fields else None, check_first)
+            )
+    outbox_wakeup.set()
+
+
+
+def not_sent(error):
+    """
+    Whether a failed request never reached Bubble: the connection was refused or timed out while connecting.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+
+def send_write(method, url, body, body_type):
+    """
+    Send one outbox row to Bubble.
+    Returns None on success, otherwise (outcome, error message), outcome being:
+    - 'retry': not applied (429, or the connection could not be opened), can be sent again
+    - 'unknown': may have been applied (timeout, 5xx), sent again after a POST's record is looked up
+    - 'failed': rejected (other 4xx), not retried
+    """
+    try:
+        if body_type == 'text':
+            res = bubble_session.request(method, url, headers=headers_bulk, data=body.encode('utf-8'), timeout=OUTBOX_TIMEOUT)
+        elif body_type == 'json':
+            res = bubble_session.request(method, url, headers=headers, json=json.loads(body), timeout=OUTBOX_TIMEOUT)
+        else:
+            res = bubble_session.request(method, url, headers=headers, data=json.loads(body), timeout=OUTBOX_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        return 'retry' if not_sent(e) else 'unknown', str(e)
+    if res.status_code < 300:
+        return None
+    if res.status_code == 429:
+        return 'retry', f'{res.status_code}: {res.text[:200]}'
+    return 'unknown' if res.status_code >= 500 else 'failed', f'{res.status_code}: {res.text[:200]}'
+
+
+
+def find_record(url, body, unique_fields):
+    """
+    Return the id of the record of a table (`url`) whose unique fields match those of a POST body, or None.
+    """
+    payload = json.loads(body)
+    constraints = [{'key': field, 'constraint_type': 'equals', 'value': str(payload[field])} for field in unique_fields]
+    res = bubble_session.get(url, headers=headers, params={'constraints': json.dumps(constraints), 'limit': 1}, timeout=OUTBOX_TIMEOUT)
+    res.raise_for_status()
+    results = res.json()['response']['results']
+    return results[0]['_id'] if results else None
+
+
+
+def process_write(row):
+    """
+    Send an outbox row and record the outcome: delete it, schedule a retry with exponential backoff, or mark it failed.
+    A POST whose record may exist already is looked up first and turned into a PATCH of the record when found.
+    Unexpected errors count as a failed attempt; the row is released for the sender in every case.
+    """
+    row_id, method, url, body, body_type, attempts, unique_fields, check_first = row
+    try:
+        if check_first and method == 'POST':
+            record_id = find_record(url, body, json.loads(unique_fields))
+            if record_id is not None:
+                method, url = 'PATCH', f'{url}/{record_id}'
+                with outbox_lock:
+                    outbox_connection().execute('UPDATE outbox SET method = ?, url = ?, check_first = 0 WHERE id = ?', (method, url, row_id))
+        result = send_write(method, url, body, body_type)
+    except Exception as e:
+        result = 'retry', f'{type(e).__name__}: {e}'
+    with outbox_lock:
+        try:
+            db = outbox_connection()
+            if result is None:
+                db.execute('DELETE FROM outbox WHERE id = ?', (row_id,))
+            else:
+                outcome, error = result
+                if outcome == 'failed':
+                    db.execute("UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?", (error, row_id))
+                    print(f'Process: outbox\t Failed row {row_id} (not retried, see /outbox_failed) {method} {url}: {error}\t Body: {body[:500]}')
+                else:
+                    delay = min(OUTBOX_MAX_BACKOFF, 2 ** attempts) * random.uniform(0.5, 1.0)
+                    check = int(method == 'POST' and (bool(check_first) or (outcome == 'unknown' and unique_fields is not None)))
+                    db.execute(
+                        'UPDATE outbox SET attempts = attempts + 1, next_attempt = ?, last_error = ?, check_first = ? WHERE id = ?',
+                        (time.time() + delay, error, check, row_id)
+                    )
+        except Exception as e:
+            print(f'Process: outbox\t Row {row_id}: {e}')
+        finally:
+            outbox_in_flight.pop(row_id, None)
+    outbox_wakeup.set()
+
+
+
+def outbox_sender():
+    """
+    Drain the outbox with bounded concurrency.
+    Writes sharing a coalesce key are sent one at a time, in order: a write waits while an older write
+    to its key is pending (in flight or backing off). Only rows that are due are selected, so rows
+    backing off never hold back newer ones.
+    """
+    executor = ThreadPoolExecutor(max_workers=OUTBOX_CONCURRENCY, thread_name_prefix='outbox')
+    while True:
+        outbox_wakeup.wait(timeout=1)
+        outbox_wakeup.clear()
+        with outbox_lock:
+            free = OUTBOX_CONCURRENCY - len(outbox_in_flight)
+            if free <= 0:
+                continue
+            busy_keys = set(k for k in outbox_in_flight.values() if k is not None)
+            rows = []
+            for row_id, method, url, body, body_type, attempts, key, unique_fields, check_first in outbox_connection().execute(
+                "SELECT id, method, url, body, body_type, attempts, coalesce_key, unique_fields, check_first FROM outbox o "
+                "WHERE status = 'pending' AND bulk_table IS NULL AND next_attempt <= ? AND (coalesce_key IS NULL OR NOT EXISTS ("
+                "SELECT 1 FROM outbox p WHERE p.coalesce_key = o.coalesce_key AND p.status = 'pending' AND p.id < o.id)) "
+                "ORDER BY id LIMIT 1000",
+                (time.time(),)
+            ):
+                if len(rows) >= free:
+                    break
+                if row_id in outbox_in_flight or (key is not None and key in busy_keys):
+                    continue
+                if key is not None:
+                    # Later writes to the same key wait for this one
+                    busy_keys.add(key)
+                outbox_in_flight[row_id] = key
+                rows.append((row_id, method, url, body, body_type, attempts, unique_fields, check_first))
+        for row in rows:
+            executor.submit(process_write, row)
+
+
+
+def start_outbox_sender():
+    """
+    Start the background sender. Rows left over from a previous run are replayed.
+    """
+    outbox_connection()
+    threading.Thread(target=outbox_sender, daemon=True).start()
+
+
+
+def pending_keys():
+    """
+    Return the coalesce keys that still have pending writes.
+    """
+    with outbox_lock:
+        return set(k for (k,) in outbox_connection().execute(
+            "SELECT DISTINCT coalesce_key FROM outbox WHERE status = 'pending' AND coalesce_key IS NOT NULL"
+        ))
+
+
+
+async def outbox_status():
+    """
+    Report the outbox queue depth and the age of the oldest pending write.
+    """
+    with outbox_lock:
+        db = outbox_connection()
+        pending, oldest = db.execute("SELECT COUNT(*), MIN(created) FROM outbox WHERE status = 'pending'").fetchone()
+        failed = db.execute("SELECT COUNT(*) FROM outbox WHERE status = 'failed'").fetchone()[0]
+        in_flight = len(outbox_in_flight)
+    return {
+        'pending': pending,
+        'in_flight': in_flight,
+        'failed': failed,
+        'oldest_pending_age': time.time() - oldest if oldest else 0,
+    }
+
+
+
+async def list_failed_writes(limit: int = Query(100, ge=1, le=1000)):
+    """
+    Lists the writes Bubble rejected (non-retryable 4xx), oldest first, with their error.
+    """
+    with outbox_lock:
+        rows = outbox_connection().execute(
+            "SELECT id, method, url, body, body_type, created, attempts, last_error FROM outbox WHERE status = 'failed' ORDER BY id LIMIT ?",
+            (limit,)
+        ).fetchall()
+    keys = ['id', 'method', 'url', 'body', 'body_type', 'created', 'attempts', 'last_error']
+    return {'count': len(rows), 'writes': [dict(zip(keys, row)) for row in rows]}
+
+
+
+def requeue_failed_writes(ids: str = Form(None)):
+    """
+    Sends failed writes again: the given comma-separated ids, or all failed writes.
+    """
+    params = [time.time()]
+    query = "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt = ? WHERE status = 'failed'"
+    if ids:
+        try:
+            row_ids = [int(row_id) for row_id in ids.split(',') if row_id.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f'Invalid ids {ids}')
+        if not row_ids:
+            return {'requeued': 0}
+        query += f" AND id IN ({','.join('?' * len(row_ids))})"
+        params += row_ids
+    with outbox_lock:
+        requeued = outbox_connection().execute(query, params).rowcount
+    outbox_wakeup.set()
+    return {'requeued': requeued}
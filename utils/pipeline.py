@@ -0,0 +1,150 @@
+import os
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config.config import *
+
+
+
+# Queue of received messages waiting to be processed (created on startup, bound to the running loop)
+ingest_queue = None
+
+# Worker threads that run the blocking part of the pipeline (Bubble, gateway replies, RAW log)
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+
+# Per inbox journal, the sequence number of the first record not yet processed (every record before
+# it was), and the records processed after it. Kept on the local disk so a restart replays the rest.
+ingest_offsets = {}
+ingest_processed = {}
+ingest_offsets_lock = threading.Lock()
+ingest_offsets_state = {'dirty': False}
+OFFSETS_PATH = f'{local_disk}/ingest_offsets.json'
+
+
+
+def load_offsets():
+    """
+    Load the processed offsets of the inbox journals from the local disk.
+    """
+    try:
+        with open(OFFSETS_PATH, 'r') as json_file:
+            offsets = json.load(json_file)
+    except FileNotFoundError:
+        offsets = {}
+    with ingest_offsets_lock:
+        ingest_offsets.update(offsets)
+    return offsets
+
+
+
+def save_offsets():
+    """
+    Write the processed offsets of the inbox journals to the local disk, when they moved.
+    """
+    with ingest_offsets_lock:
+        if not ingest_offsets_state['dirty']:
+            return
+        offsets = dict(ingest_offsets)
+        ingest_offsets_state['dirty'] = False
+    tmp_path = f'{OFFSETS_PATH}.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(offsets, json_file)
+    os.replace(tmp_path, OFFSETS_PATH)
+
+
+
+def set_offset(journal, seq):
+    """
+    Set the first unprocessed sequence number of a journal (e.g. to its end, on the first start).
+    """
+    with ingest_offsets_lock:
+        ingest_offsets[journal] = seq
+        ingest_offsets_state['dirty'] = True
+
+
+
+def mark_processed(journal, seq):
+    """
+    Record that a journal record was processed, moving the journal's offset past every record processed in a row.
+    """
+    with ingest_offsets_lock:
+        processed = ingest_processed.setdefault(journal, set())
+        processed.add(seq)
+        offset = ingest_offsets.get(journal, 0)
+        while offset in processed:
+            processed.discard(offset)
+            offset += 1
+        if offset != ingest_offsets.get(journal, 0):
+            ingest_offsets[journal] = offset
+            ingest_offsets_state['dirty'] = True
+
+
+
+async def submit_message(process, raw_data, source=None):
+    """
+    Hand a received message over to the processing pipeline.
+    Waits only when the queue is full, so ingest latency stays independent of downstream services.
+    `source` is the (journal name, sequence number) of the message's inbox record, marked processed when done.
+    """
+    await ingest_queue.put((process, raw_data, source))
+
+
+
+async def ingest_worker():
+    """
+    Take messages from the queue and process them in the worker thread pool.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        process, raw_data, source = await ingest_queue.get()
+        try:
+            await loop.run_in_executor(ingest_executor, process, raw_data)
+        except Exception as e:
+            print(f'Process: ingest pipeline\t Keyword: {e}')
+        finally:
+            if source is not None:
+                mark_processed(*source)
+            ingest_queue.task_done()
+
+
+
+async def offsets_saver():
+    """
+    Write the processed offsets to the local disk every second.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(1)
+        try:
+            await loop.run_in_executor(None, save_offsets)
+        except Exception as e:
+            print(f'Process: ingest offsets\t Keyword: {e}')
+
+
+
+async def start_ingest_pipeline():
+    """
+    Create the ingest queue, load the processed offsets and start one worker per pipeline slot.
+    """
+    global ingest_queue
+    ingest_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    load_offsets()
+    for _ in range(INGEST_WORKERS):
+        asyncio.ensure_future(ingest_worker())
+    asyncio.ensure_future(offsets_saver())
+
+
+
+async def ingest_status():
+    """
+    Report the number of messages waiting in the ingest pipeline and the processed offset of each inbox journal.
+    """
+    with ingest_offsets_lock:
+        offsets = dict(ingest_offsets)
+    return {
+        'queued': ingest_queue.qsize() if ingest_queue else 0,
+        'workers': INGEST_WORKERS,
+        'offsets': offsets,
+    }
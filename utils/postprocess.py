@@ -1,8 +1,9 @@
 import json
 import requests
-import pandas as pd
 
 from config.config import *
+from utils.lazy import pd
+from utils.outbox import enqueue_write
 
 
 # Functions to fetch and save quick count results
@@ -199,13 +200,8 @@ def fetch_quickcount():
             if key in existing_ids:
                 record_id = existing_ids[key]
                 # print(f"Updating record: key={key}, existing_id={record_id}")  # Debug print
-                try:
-                    requests.patch(f'{url_bubble}/AggregateRegion/{record_id}', headers=headers, data=payload)
-                except requests.exceptions.RequestException as e:
-                    print(f"Failed to update record {record_id}: {e}")
+                url_record = f'{url_bubble}/AggregateRegion/{record_id}'
+                enqueue_write('PATCH', url_record, payload, coalesce_key=url_record)
             else:
                 # print(f"Inserting new record: key={key}")  # Debug print
-                try:
-                    requests.post(f'{url_bubble}/AggregateRegion', headers=headers, json=payload)
-                except requests.exceptions.RequestException as e:
-                    print(f"Failed to insert new record for key {key}: {e}")
\ No newline at end of file
+                enqueue_write('POST', f'{url_bubble}/AggregateRegion', payload, body_type='json', coalesce_key=f'AggregateRegion:{key[0]}:{key[1]}', unique_fields=['Event ID', 'Region'])
\ No newline at end of file
@@ -1,54 +1,61 @@
-import re
-import time
 import json
+import time
 import random
-import requests
+import hashlib
 import threading
-import numpy as np
-import pandas as pd
-from Bio import Align
-import geopandas as gpd
+import multiprocessing
 from fastapi import Form
-from shapely.geometry import Point
 from fastapi import Form, UploadFile
-from fastapi.responses import StreamingResponse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 
 from config.config import *
+from utils.lazy import pd, region_match
+from utils.registry import reload_event
+from utils.region_alias import REGION_LEVELS, learn_alias, save_aliases
+from utils.votes_store import seed_votes
+from utils.bulk_loader import bulk_insert, fetch_uid_dict
+from utils.jobs import submit_job, job_response, set_job_stage, set_job_progress
 
 
 
-# Load the shapefile
-shapefile_path = 'data/location.shp'
-gdf = gpd.read_file(shapefile_path)
-gdf.crs = "EPSG:4326"
-
-# Load region data from JSON
-with open('data/region.json', 'r') as json_file:
-    region_data = json.load(json_file)
-
 # Create a threading lock for synchronization
 print_lock = threading.Lock()
 
-# List of provinces
-list_provinsi = sorted(region_data.keys())
+# Worker pool running getUID and generate_xlsform jobs
+xlsform_executor = ThreadPoolExecutor(max_workers=XLSFORM_WORKERS, thread_name_prefix='xlsform')
+
+# Region matching processes, spawned on first use and kept, so they keep their region data,
+# reference nodes and match memo from one upload to the next
+region_pool = None
+region_pool_lock = threading.Lock()
 
 
 
 # Function to generate a UID and return an Excel file with the target data
-async def get_uid(event: str = Form(...), N_TPS: int = Form(...)):
+async def get_uid(event: str = Form(...), N_TPS: int = Form(...), async_job: bool = Form(False)):
+    """
+    Generates the target file of an event with N_TPS unique UIDs, as a background job.
+    With async_job, returns the job id right away (progress at /jobs/{job_id}, file at /jobs/{job_id}/download);
+    otherwise waits for the job and returns the file. A retried request attaches to the job while it is
+    queued or running; once it finished, a new request generates new UIDs.
+    """
     event = event.lower()
-    create_target(event, N_TPS)
-    
-    excel_file_path = f'{local_disk}/target_{event}.xlsx'
-    
-    def file_generator():
-        with open(excel_file_path, 'rb') as file_content:
-            yield from file_content
+    key = hashlib.sha1(f'{event}:{N_TPS}'.encode('utf-8')).hexdigest()
+    job = submit_job(xlsform_executor, 'getUID', key, {'event': event, 'N_TPS': N_TPS}, build_target, event, N_TPS, finished=False)
+    return await job_response(job, async_job)
 
-    response = StreamingResponse(file_generator(), media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    response.headers["Content-Disposition"] = f"attachment; filename=target_{event}.xlsx"
 
-    return response
+
+def build_target(event, N_TPS, job_id=None):
+    """
+    Create the target file of an event (job body of `get_uid`).
+    """
+    set_job_stage(job_id, 'target', total=N_TPS)
+    create_target(event, N_TPS)
+    set_job_progress(job_id, N_TPS)
+    return {'file': f'{local_disk}/target_{event}.xlsx', 'filename': f'target_{event}.xlsx', 'uids': N_TPS}
 
 
 
@@ -56,41 +63,74 @@ def rename_region(data):
     """
     Rename regions based on the closest match in the region data.
     """
-    reference = list_provinsi
-    provinsi = find_closest_string(data[0], reference, 'Provinsi')
-    reference = list(region_data[provinsi].keys())
-    kabkota = find_closest_string(data[1], reference, 'Kab/Kota')
-    reference = list(region_data[provinsi][kabkota].keys())
-    kecamatan = find_closest_string(data[2], reference, 'Kecamatan')
-    reference = list(region_data[provinsi][kabkota][kecamatan])
-    kelurahan = find_closest_string(data[3], reference, 'Kelurahan')
-    return provinsi, kabkota, kecamatan, kelurahan
+    return tuple(region_match.normalize_regions(data)['names'])
 
 
 
-def preprocess_text(text):
+def get_region_pool():
     """
-    Preprocess text by removing non-alphanumeric characters and converting to lowercase.
+    Return the region matching process pool, starting it on first use.
     """
-    return re.sub(r'\W+', '', text.lower())
+    global region_pool
+    with region_pool_lock:
+        if region_pool is None:
+            region_pool = ProcessPoolExecutor(max_workers=REGION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return region_pool
 
 
 
-def compare_sequences(seq1, seq2):
+def shutdown_region_pool():
     """
-    Compare two sequences using pairwise alignment and return the best alignment score.
+    Stop the region matching processes (on shutdown, or when the pool broke).
     """
-    aligner = Align.PairwiseAligner()
-    alignments = aligner.align(seq1, seq2)
-    return alignments[0].score
+    global region_pool
+    with region_pool_lock:
+        pool, region_pool = region_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False)
 
 
 
-def compare_with_list(string1, string2_list):
+def normalize_target_regions(df):
     """
-    Compare a string with a list of strings and return the scores.
+    Rename the regions of a target file, once per unique (Provinsi, Kab/Kota, Kecamatan, Kelurahan) tuple.
+    Large targets are spread over the long-lived pool of REGION_WORKERS processes. The scored matches are learned
+    as aliases here only, as the processes never save theirs and would keep aliases deleted meanwhile.
+    Returns one row per tuple: the original and renamed regions, the score and method of each level,
+    the number of TPS and the time taken.
     """
-    return [compare_sequences(string1, seq2) for seq2 in string2_list]
+    ori_columns = [f'{level} Ori' for level in REGION_LEVELS]
+    n_tps = df.groupby(ori_columns, dropna=False, sort=False).size()
+    tuples = [tuple(regions) for regions in n_tps.index]
+
+    start = time.time()
+    results = None
+    mode = 'serial'
+    if len(tuples) >= REGION_POOL_MIN and REGION_WORKERS > 1:
+        try:
+            chunksize = max(1, len(tuples) // (REGION_WORKERS * 4))
+            results = list(get_region_pool().map(partial(region_match.normalize_regions, learn=False), tuples, chunksize=chunksize))
+            mode = f'{REGION_WORKERS} processes'
+        except BrokenProcessPool as e:
+            print(f'Process: normalize regions\t Keyword: {e}')
+            shutdown_region_pool()
+    if results is None:
+        results = [region_match.normalize_regions(regions, learn=False) for regions in tuples]
+    print(f'Process: normalize regions\t {len(tuples)} region tuples in {time.time() - start:.2f} s ({mode})')
+
+    rows = []
+    for result, count in zip(results, n_tps.values):
+        parent = ()
+        row = dict(zip(ori_columns, result['regions']))
+        for level, raw, name, score, method in zip(REGION_LEVELS, result['regions'], result['names'], result['scores'], result['methods']):
+            if method == 'scored':
+                learn_alias(level, parent, raw, name)
+            parent = parent + (name,)
+            row.update({level: name, f'{level} Score': score, f'{level} Method': method})
+        row.update({'TPS': int(count), 'Seconds': result['seconds']})
+        rows.append(row)
+    save_aliases()
+    return pd.DataFrame(rows)
 
 
 
@@ -98,34 +138,43 @@ def find_closest_string(string1, string_list, region):
     """
     Find the closest matching string in a list based on alignment scores.
     """
-    if region == 'Kab/Kota':
-        first_string = string1.split(' ')[0].lower()
-        if first_string != 'kota' and first_string not in ['kab.', 'kabupaten', 'kab']:
-            string1 = 'Kab. ' + string1
-    preprocessed_string_list = [preprocess_text(s) for s in string_list]
-    preprocessed_target = preprocess_text(string1)
-    scores = compare_with_list(preprocessed_target, preprocessed_string_list)
-    ss = [len([i for i in list(s2) if i not in list(preprocessed_target)]) for s2 in preprocessed_string_list]
-    tt = [np.sum([preprocessed_target.count(t1) for t1 in list(t2)])/len(preprocessed_target) for t2 in preprocessed_string_list]
-    scores = np.array(scores) - np.array(ss) - np.array(tt)
-    return string_list[np.argmax(scores)]
+    return region_match.closest(region_match.build_node(string_list), string1, region)
 
 
 
-def get_location(coordinate):
+def votes_rows(df, event):
     """
-    Get location details based on coordinates.
+    Build the initial Votes rows of a target file (empty cells are left out).
     """
-    point = Point(coordinate)
-    selected_row = gdf[gdf.geometry.contains(point)]
-    kabkota = selected_row['Kab/Kota'].values[0]
-    kabkota = f'Kab. {kabkota}' if kabkota.split(' ')[0] not in ['Kab.', 'Kota'] else kabkota
-    return {
-        'Provinsi': selected_row['Provinsi'].values[0],
-        'Kab/Kota': kabkota,
-        'Kecamatan': selected_row['Kecamatan'].values[0],
-        'Kelurahan': selected_row['Kelurahan'].values[0]
+    columns = ['UID', 'Korprov', 'Korwil', 'Provinsi', 'Kab/Kota', 'Kecamatan', 'Kelurahan', 'Provinsi Ori', 'Kab/Kota Ori', 'Kecamatan Ori', 'Kelurahan Ori']
+    rows = []
+    for values in zip(*[df[column] for column in columns]):
+        row = {
+            'Active': False,
+            'Complete': False,
+            'SMS': False,
+            'SCTO': False,
+            'SMS Int': 0,
+            'SCTO Int': 0,
+            'Status': 'Empty',
+            'Event ID': event,
+        }
+        row.update({column: str(value) for column, value in zip(columns, values) if value == value and value is not None})
+        rows.append(row)
+    return rows
+
+
+
+def save_expected_regions(df, event):
+    """
+    Store the expected region of each UID of an event, for GPS verification of SCTO submissions.
+    """
+    expected = {
+        str(uid).upper(): [provinsi, kabkota, kecamatan, kelurahan]
+        for uid, provinsi, kabkota, kecamatan, kelurahan in zip(df['UID'], df['Provinsi'], df['Kab/Kota'], df['Kecamatan'], df['Kelurahan'])
     }
+    with open(f'{local_disk}/expected_{event}.json', 'w') as json_file:
+        json.dump(expected, json_file)
 
 
 
@@ -236,101 +285,88 @@ async def generate_xlsform(
     form_id: str = Form(...),
     target_file_name: str = Form(...),
     target_file: UploadFile = Form(...),
+    async_job: bool = Form(False),
 ):
+    """
+    Normalizes the regions of a target file, seeds the event's Votes rows and builds the XLSForm, as a background job.
+    With async_job, returns the job id right away (progress per stage at /jobs/{job_id}, XLSForm at
+    /jobs/{job_id}/download); otherwise waits for the job and returns the XLSForm.
+    A retried upload of the same target file (same form) attaches to the existing job.
+    """
     event = target_file_name.split('_')[-1].split('.')[0].lower()
+    content = target_file.file.read()
+    key = hashlib.sha1(content + f'\n{form_id}\n{form_title}\n{target_file_name}'.encode('utf-8')).hexdigest()
 
     # Save the target file to a temporary location
-    with open(f'{local_disk}/{target_file_name}', 'wb') as target_file_content:
-        target_file_content.write(target_file.file.read())
+    def save_target_file():
+        with open(f'{local_disk}/{target_file_name}', 'wb') as target_file_content:
+            target_file_content.write(content)
+
+    params = {'form_title': form_title, 'form_id': form_id, 'target_file_name': target_file_name, 'event': event}
+    job = submit_job(xlsform_executor, 'generate_xlsform', key, params, build_xlsform, form_title, form_id, target_file_name, event, prepare=save_target_file)
+    return await job_response(job, async_job)
+
+
 
+def build_xlsform(form_title, form_id, target_file_name, event, job_id=None):
+    """
+    Job body of `generate_xlsform`, in stages: normalize, seed, uids, mirror, xlsform.
+    """
     # Get UIDs from the target file
+    set_job_stage(job_id, 'normalize')
     df = pd.read_excel(f'{local_disk}/{target_file_name}')
 
-    # Rename regions
-    df['Provinsi Ori'] = df['Provinsi'].copy()
-    df['Kab/Kota Ori'] = df['Kab/Kota'].copy()
-    df['Kecamatan Ori'] = df['Kecamatan'].copy()
-    df['Kelurahan Ori'] = df['Kelurahan'].copy()
-    for index, row in df.iterrows():
-        input_regions = [row['Provinsi'], row['Kab/Kota'], row['Kecamatan'], row['Kelurahan']]
-        output_regions = rename_region(input_regions)
-        df.loc[index, 'Provinsi'] = output_regions[0]
-        df.loc[index, 'Kab/Kota'] = output_regions[1]
-        df.loc[index, 'Kecamatan'] = output_regions[2]
-        df.loc[index, 'Kelurahan'] = output_regions[3]
+    # Rename regions, once per unique region tuple, and map the names back in one join
+    region_columns = ['Provinsi', 'Kab/Kota', 'Kecamatan', 'Kelurahan']
+    ori_columns = [f'{column} Ori' for column in region_columns]
+    for column in region_columns:
+        df[f'{column} Ori'] = df[column].copy()
+    columns = list(df.columns)
+    report = normalize_target_regions(df)
+    df = df.drop(columns=region_columns).merge(report[ori_columns + region_columns], on=ori_columns, how='left')[columns]
+    set_job_progress(job_id, len(report), total=len(report))
 
     # Save the target file after renaming regions
     df.to_excel(f'{local_disk}/{target_file_name}', index=False)
-
-    # Break into batches
-    n_batches = int(np.ceil(len(df) / 100))
-
-    for batch in range(n_batches):
-        start = batch * 100
-        end = min((batch + 1) * 100, len(df)) - 1
-        tdf = df.loc[start:end, :]
-
-        # Generate Text for API input
-        data = '\n'.join([
-            f'{{"UID": "{uid}", '
-            f'"Active": false, '
-            f'"Complete": false, '
-            f'"SMS": false, '
-            f'"SCTO": false, '
-            f'"SMS Int": 0, '
-            f'"SCTO Int": 0, '
-            f'"Status": "Empty", '
-            f'"Event ID": "{event}", '
-            f'"Korprov": "{korprov}", '
-            f'"Korwil": "{korwil}", '
-            f'"Provinsi": "{provinsi}", '
-            f'"Kab/Kota": "{kab_kota}", '
-            f'"Kecamatan": "{kecamatan}", '
-            f'"Kelurahan": "{kelurahan}", '
-            f'"Provinsi Ori": "{provinsi_ori}", '
-            f'"Kab/Kota Ori": "{kab_kota_ori}", '
-            f'"Kecamatan Ori": "{kecamatan_ori}", '
-            f'"Kelurahan Ori": "{kelurahan_ori}"}}'
-            for uid, korprov, korwil, provinsi, kab_kota, kecamatan, kelurahan, provinsi_ori, kab_kota_ori, kecamatan_ori, kelurahan_ori in zip(
-                tdf['UID'],
-                tdf['Korprov'],
-                tdf['Korwil'],
-                tdf['Provinsi'],
-                tdf['Kab/Kota'],
-                tdf['Kecamatan'],
-                tdf['Kelurahan'],
-                tdf['Provinsi Ori'],
-                tdf['Kab/Kota Ori'],
-                tdf['Kecamatan Ori'],
-                tdf['Kelurahan Ori']
-            )
-        ])
-
-        # Populate votes table in bulk
-        requests.post(f'{url_bubble}/Votes/bulk', headers=headers_bulk, data=data)
-
-        time.sleep(3)
+    save_expected_regions(df, event)
+
+    # Populate votes table in bulk (resumable: batches already inserted for this event are skipped)
+    rows = votes_rows(df, event)
+    set_job_stage(job_id, 'seed', total=-(-len(rows) // BULK_BATCH_SIZE))
+    bulk = bulk_insert(
+        'Votes', rows, f'{local_disk}/bulk_{event}.json', ['UID', 'Event ID'],
+        progress=lambda done, total, failed: set_job_progress(job_id, done, total=total, failed=failed)
+    )
+    if bulk['failed_rows'] > 0:
+        raise RuntimeError(f"{bulk['failed_rows']} Votes rows were not inserted, upload the target file again to resume")
 
     # Get UIDs and store as json
-    uid_dict = {}
-    for uid_start in range(1, len(df), 50):
-        params = {'Event ID': event, 'start': uid_start, 'end': uid_start+50}
-        res = requests.get(url_getUID, headers=headers, params=params)
-        out = res.json()['response']
-        uid_dict.update(zip(out['UID'], out['id_']))
+    set_job_stage(job_id, 'uids', total=len(df))
+    uid_dict = fetch_uid_dict(event, len(df))
+    set_job_progress(job_id, len(uid_dict), total=len(df))
 
     with open(f'{local_disk}/uid_{event}.json', 'w') as json_file:
         json.dump(uid_dict, json_file)
+    reload_event(event)
+
+    # Mirror the new Votes rows locally
+    set_job_stage(job_id, 'mirror')
+    seed_votes(event)
 
     # Generate xlsform logic using the target file
+    set_job_stage(job_id, 'xlsform')
     create_xlsform_template(f'{local_disk}/{target_file_name}', form_title, form_id, event)
     xlsform_path = f'{local_disk}/xlsform_{form_id}.xlsx'
 
-    def file_generator():
-        with open(xlsform_path, 'rb') as file_content:
-            yield from file_content
+    # Report how each region tuple was renamed
+    with pd.ExcelWriter(xlsform_path, engine='openpyxl', mode='a') as writer:
+        report.to_excel(writer, index=False, sheet_name='normalization')
 
-    response = StreamingResponse(file_generator(), media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    response.headers["Content-Disposition"] = f"attachment; filename=xlsform_{form_id}.xlsx"
-
-    return response
\ No newline at end of file
+    return {
+        'file': xlsform_path,
+        'filename': f'xlsform_{form_id}.xlsx',
+        'rows': len(df),
+        'region_tuples': len(report),
+        'uids': len(uid_dict),
+        'bulk': bulk,
+    }
@@ -0,0 +1,136 @@
+import json
+import time
+import random
+import requests
+import threading
+
+from config.config import *
+from utils.outbox import outbox_lock, outbox_connection, enqueue_write
+from utils.bulk_loader import bulk_request, find_existing
+
+
+
+# RAW log rows are recorded in the outbox (with their bulk table) when logged, and inserted from there in bulk.
+# Rows logged per table since the last flush, rows being flushed, and a signal to wake the flusher up
+raw_counts = {}
+raw_in_flight = set()
+raw_lock = threading.Lock()
+raw_wakeup = threading.Event()
+
+
+
+def log_raw(table, payload, unique_fields):
+    """
+    Record a row for a RAW log table (RAW_SMS, RAW_WhatsApp) in the outbox; rows are inserted in bulk by the flusher.
+    unique_fields identify the row (e.g. ['SMS ID', 'Gateway ID']), to look it up when the outcome of its insert is unknown.
+    """
+    payload = {k: v for k, v in payload.items() if v is not None}
+    enqueue_write('POST', f'{url_bubble}/{table}/bulk', payload, body_type='json', bulk_table=table, unique_fields=unique_fields)
+    with raw_lock:
+        raw_counts[table] = raw_counts.get(table, 0) + 1
+        full = raw_counts[table] >= RAW_BATCH_SIZE
+    if full:
+        raw_wakeup.set()
+
+
+
+def take_batches(force=False):
+    """
+    Take the batches that are due, one per table: full ones, ones whose oldest row is older than RAW_BATCH_AGE,
+    or everything when forced. The rows' attempts are counted before they are sent, so a row sent before
+    a crash is looked up in Bubble before it is sent again.
+    """
+    batches = []
+    now = time.time()
+    with outbox_lock:
+        db = outbox_connection()
+        tables = [table for (table,) in db.execute("SELECT DISTINCT bulk_table FROM outbox WHERE bulk_table IS NOT NULL AND status = 'pending'")]
+        for table in tables:
+            rows = [row for row in db.execute(
+                "SELECT id, body, unique_fields, created, attempts FROM outbox WHERE bulk_table = ? AND status = 'pending' AND next_attempt <= ? ORDER BY id LIMIT ?",
+                (table, now, RAW_BATCH_SIZE + len(raw_in_flight))
+            ) if row[0] not in raw_in_flight][:RAW_BATCH_SIZE]
+            if rows and (force or len(rows) >= RAW_BATCH_SIZE or now - rows[0][3] >= RAW_BATCH_AGE):
+                ids = [row[0] for row in rows]
+                db.execute(f"UPDATE outbox SET attempts = attempts + 1 WHERE id IN ({','.join('?' * len(ids))})", ids)
+                raw_in_flight.update(ids)
+                batches.append((table, rows))
+    with raw_lock:
+        for table, _ in batches:
+            raw_counts[table] = 0
+    return batches
+
+
+
+def flush_raw(table, rows):
+    """
+    Insert outbox rows of a RAW log table through the Bubble bulk endpoint, which is not idempotent.
+    Rows sent before (after a timeout, 5xx or restart) are looked up in Bubble first and only sent again
+    when missing. Rows of a request with an unknown outcome are retried that way, never as single inserts.
+    """
+    payloads = [json.loads(body) for _, body, _, _, _ in rows]
+    unique_fields = json.loads(rows[0][2])
+    inserted, rejected = set(), set()
+    error, retry_after = None, None
+    try:
+        sent_before = [i for i, row in enumerate(rows) if row[4] > 0]
+        if sent_before:
+            inserted.update(sent_before[j] for j in find_existing(table, [payloads[i] for i in sent_before], unique_fields))
+        todo = [i for i in range(len(rows)) if i not in inserted]
+        if todo:
+            outcome, failed, error, retry_after = bulk_request(table, [payloads[i] for i in todo])
+            failed = set(todo[j] for j in failed)
+            inserted.update(i for i in todo if i not in failed)
+            if outcome in ('done', 'rejected'):
+                rejected = failed
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        error = f'Could not check which rows were inserted: {e}'
+    if error:
+        print(f'Process: RAW bulk insert {table}\t {len(rows) - len(inserted)} rows not inserted, keyword: {error}')
+
+    with outbox_lock:
+        db = outbox_connection()
+        for i, (row_id, _, _, _, attempts) in enumerate(rows):
+            if i in inserted:
+                db.execute('DELETE FROM outbox WHERE id = ?', (row_id,))
+            elif i in rejected:
+                db.execute("UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?", (error, row_id))
+            else:
+                delay = retry_after or min(OUTBOX_MAX_BACKOFF, 2 ** attempts) * random.uniform(0.5, 1.0)
+                db.execute('UPDATE outbox SET next_attempt = ?, last_error = ? WHERE id = ?', (time.time() + delay, error, row_id))
+            raw_in_flight.discard(row_id)
+
+
+
+def raw_flusher():
+    """
+    Flush RAW log rows by batch size or age.
+    """
+    while True:
+        raw_wakeup.wait(timeout=RAW_BATCH_AGE / 4)
+        raw_wakeup.clear()
+        try:
+            batches = take_batches()
+            while batches:
+                for table, rows in batches:
+                    flush_raw(table, rows)
+                batches = take_batches()
+        except Exception as e:
+            print(f'Process: RAW log flusher\t Keyword: {e}')
+
+
+
+def start_raw_flusher():
+    """
+    Start the background RAW log flusher. Rows left in the outbox by a previous run are flushed.
+    """
+    threading.Thread(target=raw_flusher, daemon=True).start()
+
+
+
+def flush_all_raw():
+    """
+    Flush the RAW log rows that are due (on shutdown; the rest stay in the outbox for the next run).
+    """
+    for table, rows in take_batches(force=True):
+        flush_raw(table, rows)
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from fastapi import Form, HTTPException
+
+from config.config import *
+from utils.lazy import region_match
+
+
+
+# Region levels, from the top of the hierarchy
+REGION_LEVELS = ['Provinsi', 'Kab/Kota', 'Kecamatan', 'Kelurahan']
+
+# Learned region aliases: (level, parent, raw name) -> {'name', 'source' (auto or manual), 'updated'}
+region_aliases = {}
+region_aliases_lock = threading.Lock()
+region_aliases_state = {'mtime': None, 'checked': 0, 'dirty': set()}
+ALIAS_PATH = f'{local_disk}/region_alias.json'
+
+# Lookups check whether another worker changed the alias file at most once per this many seconds
+ALIAS_REFRESH_INTERVAL = 5
+
+
+
+def alias_key(level, parent, raw):
+    return (level, tuple(parent), str(raw).strip())
+
+
+
+def read_alias_file():
+    """
+    Read the alias entries stored on the local disk.
+    """
+    try:
+        with open(ALIAS_PATH, 'r') as json_file:
+            entries = json.load(json_file)['entries']
+    except FileNotFoundError:
+        return {}
+    return {alias_key(e['level'], e['parent'], e['raw']): {k: e[k] for k in ('name', 'source', 'updated')} for e in entries}
+
+
+
+def refresh_aliases(force=True):
+    """
+    Reload the aliases when another worker changed the file. Without force, the file is checked
+    at most once per ALIAS_REFRESH_INTERVAL. Called with region_aliases_lock held.
+    """
+    now = time.monotonic()
+    if not force and now - region_aliases_state['checked'] < ALIAS_REFRESH_INTERVAL:
+        return
+    region_aliases_state['checked'] = now
+    try:
+        mtime = os.stat(ALIAS_PATH).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime != region_aliases_state['mtime']:
+        stored = read_alias_file()
+        for key in region_aliases_state['dirty']:
+            if key in region_aliases and (key not in stored or stored[key]['updated'] <= region_aliases[key]['updated']):
+                stored[key] = region_aliases[key]
+        region_aliases.clear()
+        region_aliases.update(stored)
+        region_aliases_state['mtime'] = mtime
+
+
+
+def lookup_alias(level, parent, raw):
+    """
+    Return the canonical name learned for a raw region name, or None.
+    """
+    with region_aliases_lock:
+        refresh_aliases(force=False)
+        entry = region_aliases.get(alias_key(level, parent, raw))
+    return entry['name'] if entry else None
+
+
+
+def learn_alias(level, parent, raw, name, source='auto'):
+    """
+    Remember the canonical name of a raw region name. Automatic matches never replace manual entries.
+    """
+    key = alias_key(level, parent, raw)
+    with region_aliases_lock:
+        entry = region_aliases.get(key)
+        if source == 'auto' and entry is not None and (entry['source'] == 'manual' or entry['name'] == name):
+            return
+        region_aliases[key] = {'name': name, 'source': source, 'updated': datetime.now().isoformat()}
+        region_aliases_state['dirty'].add(key)
+
+
+
+def forget_alias(level, parent, raw):
+    """
+    Remove an alias. Returns whether it existed.
+    """
+    key = alias_key(level, parent, raw)
+    with region_aliases_lock:
+        refresh_aliases()
+        removed = region_aliases.pop(key, None) is not None
+        region_aliases_state['dirty'].discard(key)
+        if removed:
+            write_aliases()
+    return removed
+
+
+
+def write_aliases():
+    """
+    Write all aliases to the local disk. Called with region_aliases_lock held.
+    """
+    entries = [dict(level=level, parent=list(parent), raw=raw, **entry) for (level, parent, raw), entry in region_aliases.items()]
+    tmp_path = f'{ALIAS_PATH}.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump({'entries': entries}, json_file)
+    os.replace(tmp_path, ALIAS_PATH)
+    region_aliases_state['mtime'] = os.stat(ALIAS_PATH).st_mtime_ns
+    region_aliases_state['dirty'].clear()
+
+
+
+def save_aliases():
+    """
+    Write the aliases learned since the last save, merged with the entries other workers stored meanwhile.
+    """
+    with region_aliases_lock:
+        if not region_aliases_state['dirty']:
+            return
+        refresh_aliases()
+        write_aliases()
+
+
+
+def alias_parent(level, provinsi, kabkota, kecamatan):
+    """
+    Return the parent names of a level, checking that all of them were given.
+    """
+    if level not in REGION_LEVELS:
+        raise HTTPException(status_code=400, detail=f'Unknown level {level}, expected one of {REGION_LEVELS}')
+    parent = tuple([provinsi, kabkota, kecamatan][:REGION_LEVELS.index(level)])
+    if any(not name for name in parent):
+        raise HTTPException(status_code=400, detail=f'{level} aliases need the names of the levels above it')
+    return parent
+
+
+
+# List the learned region aliases
+async def list_region_aliases(level: str = None, source: str = None, q: str = None):
+    """
+    Lists the learned region aliases, optionally filtered by level, source (auto or manual)
+    or a substring of the raw or canonical name.
+    """
+    with region_aliases_lock:
+        refresh_aliases()
+        items = list(region_aliases.items())
+    entries = []
+    for (entry_level, parent, raw), entry in sorted(items):
+        if level and entry_level != level:
+            continue
+        if source and entry['source'] != source:
+            continue
+        if q and q.lower() not in raw.lower() and q.lower() not in entry['name'].lower():
+            continue
+        entries.append(dict(level=entry_level, parent=list(parent), raw=raw, **entry))
+    return {'count': len(entries), 'entries': entries}
+
+
+
+# Add or override a region alias
+def set_region_alias(
+    level: str = Form(...),
+    raw: str = Form(...),
+    name: str = Form(...),
+    provinsi: str = Form(None),
+    kabkota: str = Form(None),
+    kecamatan: str = Form(None),
+):
+    """
+    Sets the canonical name of a raw region name (a manual entry, never replaced by automatic matches).
+    The name must exist in the region data below the given parent regions.
+    """
+    parent = alias_parent(level, provinsi, kabkota, kecamatan)
+    try:
+        names = region_match.reference_names(level, parent)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f'Unknown parent region {e}')
+    if name not in names:
+        raise HTTPException(status_code=400, detail=f'{name} is not a {level} of {" / ".join(parent) or "Indonesia"}')
+    learn_alias(level, parent, raw, name, source='manual')
+    save_aliases()
+    return {'level': level, 'parent': list(parent), 'raw': raw, 'name': name, 'source': 'manual'}
+
+
+
+# Remove a region alias
+def delete_region_alias(
+    level: str = Form(...),
+    raw: str = Form(...),
+    provinsi: str = Form(None),
+    kabkota: str = Form(None),
+    kecamatan: str = Form(None),
+):
+    """
+    Removes a region alias, so the raw name is matched by scoring again.
+    """
+    parent = alias_parent(level, provinsi, kabkota, kecamatan)
+    removed = forget_alias(level, parent, raw)
+    return {'level': level, 'parent': list(parent), 'raw': raw, 'removed': removed}
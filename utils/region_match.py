@@ -0,0 +1,258 @@
+import re
+import sys
+import time
+import threading
+import numpy as np
+from Bio import Align
+from functools import lru_cache
+
+from config.config import *
+from utils.geodata import get_region_data
+from utils.region_alias import REGION_LEVELS, lookup_alias, learn_alias
+
+
+
+# Aligner shared by all comparisons (default scoring: global, match 1, mismatch and gaps 0)
+aligner = Align.PairwiseAligner()
+
+# Reference names of each hierarchy node, preprocessed once, keyed by (level, parent)
+region_nodes = {}
+region_nodes_lock = threading.Lock()
+
+
+
+def preprocess_text(text):
+    """
+    Preprocess text by removing non-alphanumeric characters and converting to lowercase.
+    """
+    return re.sub(r'\W+', '', text.lower())
+
+
+
+def trigrams(text):
+    """
+    Return the set of character trigrams of a normalized name, padded so short names have some.
+    """
+    padded = f'${text}$'
+    return set(padded[i:i + 3] for i in range(max(1, len(padded) - 2)))
+
+
+
+def build_node(names):
+    """
+    Preprocess a list of reference names: normalized names, the first row of each normalized name,
+    a character count matrix (one row per name, one column per character occurring in the names)
+    and a trigram inverted index (trigram -> rows).
+    """
+    texts = [preprocess_text(name) for name in names]
+    exact = {}
+    chars = {}
+    grams = {}
+    gram_counts = np.zeros(len(texts), dtype=np.float64)
+    for row, text in enumerate(texts):
+        exact.setdefault(text, row)
+        for c in text:
+            chars.setdefault(c, len(chars))
+        text_grams = trigrams(text)
+        gram_counts[row] = len(text_grams)
+        for gram in text_grams:
+            grams.setdefault(gram, []).append(row)
+    counts = np.zeros((len(texts), max(1, len(chars))), dtype=np.float64)
+    for row, text in enumerate(texts):
+        for c in text:
+            counts[row, chars[c]] += 1
+    return {
+        'names': list(names),
+        'texts': texts,
+        'exact': exact,
+        'chars': chars,
+        'counts': counts,
+        'grams': {gram: np.array(rows) for gram, rows in grams.items()},
+        'gram_counts': gram_counts,
+    }
+
+
+
+def shortlist(node, target, limit=REGION_MATCH_SHORTLIST):
+    """
+    Return the rows of the `limit` names sharing the most trigrams with the input (Dice coefficient),
+    in their original order. Returns all rows when the shortlist is disabled (limit 0), for small nodes
+    or when no trigram is shared. Check a new limit against full scoring with `compare_shortlist`.
+    """
+    n = len(node['texts'])
+    if limit <= 0 or n <= limit:
+        return np.arange(n)
+    target_grams = trigrams(target)
+    overlap = np.zeros(n, dtype=np.float64)
+    for gram in target_grams:
+        rows = node['grams'].get(gram)
+        if rows is not None:
+            overlap[rows] += 1
+    if not overlap.any():
+        return np.arange(n)
+    dice = 2 * overlap / (node['gram_counts'] + len(target_grams))
+    return np.sort(np.argpartition(-dice, limit)[:limit])
+
+
+
+def reference_names(level, parent):
+    """
+    Return the names of a hierarchy node from the region data: the provinces, or the children of `parent`.
+    """
+    region_data = get_region_data()
+    if level == 'Provinsi':
+        return sorted(region_data.keys())
+    node = region_data
+    for name in parent:
+        node = node[name]
+    return list(node)
+
+
+
+def get_node(level, parent):
+    """
+    Return the preprocessed reference names of a hierarchy node, building them on first use.
+    """
+    key = (level, parent)
+    node = region_nodes.get(key)
+    if node is None:
+        node = build_node(reference_names(level, parent))
+        with region_nodes_lock:
+            node = region_nodes.setdefault(key, node)
+    return node
+
+
+
+def closest(node, string1, region):
+    """
+    Find the closest name of a node (see `closest_match`).
+    """
+    return closest_match(node, string1, region)[0]
+
+
+
+def closest_match(node, string1, region, limit=REGION_MATCH_SHORTLIST):
+    """
+    Find the closest name of a node: alignment score minus the count of name characters missing from
+    the input, minus the input's count of each name character relative to its length.
+    Exact and normalized-exact matches are returned without scoring, and only the trigram shortlist
+    (of `limit` names, see `shortlist`) is scored.
+    Returns (name, score, method), method being 'exact' (score None) or 'scored'.
+    """
+    if region == 'Kab/Kota':
+        first_string = string1.split(' ')[0].lower()
+        if first_string != 'kota' and first_string not in ['kab.', 'kabupaten', 'kab']:
+            string1 = 'Kab. ' + string1
+    target = preprocess_text(string1)
+    if len(target) == 0:
+        return node['names'][0], None, 'exact'
+    if target in node['exact']:
+        return node['names'][node['exact'][target]], None, 'exact'
+    rows = shortlist(node, target, limit)
+
+    # Character counts of the input over the node's characters
+    target_counts = np.zeros(node['counts'].shape[1], dtype=np.float64)
+    for c in target:
+        if c in node['chars']:
+            target_counts[node['chars'][c]] += 1
+
+    counts = node['counts'][rows]
+    scores = np.array([aligner.score(target, node['texts'][row]) for row in rows])
+    ss = counts @ (target_counts == 0)
+    tt = counts @ target_counts / len(target)
+    scores = scores - ss - tt
+    best = np.argmax(scores)
+    return node['names'][rows[best]], float(scores[best]), 'scored'
+
+
+
+def match_region(level, parent, raw):
+    """
+    Match a raw region name to its canonical name at a level of the hierarchy, below `parent`
+    (tuple of the canonical names above it). Learned and manual aliases are consulted first;
+    scored matches are learned as aliases (exact matches are not, they need no alias).
+    """
+    return match_region_detail(level, parent, raw)[0]
+
+
+
+def match_region_detail(level, parent, raw, learn=True):
+    """
+    Match a raw region name like `match_region`. Returns (name, score, method), method being
+    'alias' or 'exact' (score None) or 'scored'. Scored matches are learned only with `learn`.
+    """
+    name = lookup_alias(level, parent, raw)
+    if name is not None:
+        return name, None, 'alias'
+    match = score_region(level, parent, raw)
+    if learn and match[2] == 'scored':
+        learn_alias(level, parent, raw, match[0])
+    return match
+
+
+
+@lru_cache(maxsize=REGION_MATCH_CACHE)
+def score_region(level, parent, raw):
+    """
+    Score a raw region name against the names of its hierarchy node. Repeated inputs are answered from memory.
+    """
+    return closest_match(get_node(level, parent), raw, level)
+
+
+
+def normalize_regions(regions, learn=True):
+    """
+    Match a raw (Provinsi, Kab/Kota, Kecamatan, Kelurahan) tuple level by level, learning the scored matches
+    as aliases unless `learn` is False (in the region matching processes, whose caller learns them).
+    Returns the canonical names with the score and method of each level and the time taken.
+    """
+    start = time.time()
+    parent = ()
+    names, scores, methods = [], [], []
+    for level, raw in zip(REGION_LEVELS, regions):
+        name, score, method = match_region_detail(level, parent, raw, learn)
+        names.append(name)
+        scores.append(score)
+        methods.append(method)
+        parent = parent + (name,)
+    return {'regions': tuple(regions), 'names': names, 'scores': scores, 'methods': methods, 'seconds': time.time() - start}
+
+
+
+def compare_shortlist(tuples, limit):
+    """
+    Match raw (Provinsi, Kab/Kota, Kecamatan, Kelurahan) tuples level by level with full scoring and
+    with a shortlist of `limit` names (aliases left aside), descending with the full-scoring names.
+    Returns the number of levels compared and the disagreements as (level, parent, raw, full, shortlisted).
+    """
+    compared = 0
+    disagreements = []
+    for regions in tuples:
+        parent = ()
+        for level, raw in zip(REGION_LEVELS, regions):
+            node = get_node(level, parent)
+            full = closest_match(node, raw, level, limit=0)[0]
+            short = closest_match(node, raw, level, limit=limit)[0]
+            compared += 1
+            if full != short:
+                disagreements.append((level, parent, raw, full, short))
+            parent = parent + (full,)
+    return compared, disagreements
+
+
+
+if __name__ == '__main__':
+    # Check that a shortlist keeps the matches of full scoring on target files, before enabling it:
+    # python -m utils.region_match <shortlist size> <target file>...
+    from utils.lazy import pd
+    limit = int(sys.argv[1])
+    tuples = set()
+    for path in sys.argv[2:]:
+        df = pd.read_excel(path)
+        tuples.update(tuple(str(value) for value in row) for row in df[REGION_LEVELS].dropna().itertuples(index=False))
+    start = time.time()
+    compared, disagreements = compare_shortlist(sorted(tuples), limit)
+    for disagreement in disagreements:
+        print('Disagreement: %s below %s: %r -> full %r, shortlist %r' % disagreement)
+    print(f'{compared} levels of {len(tuples)} region tuples compared in {time.time() - start:.1f} s, {len(disagreements)} disagreements')
+    sys.exit(1 if disagreements else 0)
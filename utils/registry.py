@@ -0,0 +1,104 @@
+import os
+import json
+import threading
+
+from config.config import *
+from utils.lazy import pd
+from utils.message import compile_spec
+
+
+
+# Cached event data: n_candidate, registered UIDs, UID -> Bubble id and UID -> expected region, keyed by event
+event_registry = {}
+registry_lock = threading.Lock()
+
+
+
+def event_files(event):
+    """
+    Return the local files an event is built from.
+    """
+    return [
+        f'{local_disk}/event_{event}.json',
+        f'{local_disk}/target_{event}.xlsx',
+        f'{local_disk}/uid_{event}.json',
+        f'{local_disk}/expected_{event}.json',
+    ]
+
+
+
+def files_signature(paths):
+    """
+    Return the modification times of the given files (None for missing files).
+    """
+    signature = []
+    for path in paths:
+        try:
+            signature.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+
+def load_event(event):
+    """
+    Load the number of candidates (with the compiled message spec), the registered UIDs,
+    the UID -> Bubble id mapping and the UID -> expected region mapping of an event.
+    """
+    event_file, target_file, uid_file, expected_file = event_files(event)
+    signature = files_signature([event_file, target_file, uid_file, expected_file])
+
+    with open(event_file, 'r') as json_file:
+        n_candidate = json.load(json_file)['n_candidate']
+
+    uids = set()
+    if os.path.exists(target_file):
+        tmp = pd.read_excel(target_file, usecols=['UID'])
+        uids = set(tmp['UID'].dropna().astype(str).str.lower())
+
+    uid_dict = {}
+    if os.path.exists(uid_file):
+        with open(uid_file, 'r') as json_file:
+            uid_dict = json.load(json_file)
+
+    expected = {}
+    if os.path.exists(expected_file):
+        with open(expected_file, 'r') as json_file:
+            expected = json.load(json_file)
+
+    return {
+        'event': event,
+        'n_candidate': n_candidate,
+        'spec': compile_spec(n_candidate),
+        'uids': uids,
+        'uid_dict': uid_dict,
+        'expected': expected,
+        'signature': signature,
+    }
+
+
+
+def get_event(event):
+    """
+    Return the cached data of an event, loading it once and reloading it when its files change.
+    Raises FileNotFoundError when the event has not been created.
+    """
+    event = event.lower()
+    entry = event_registry.get(event)
+    if entry is None or entry['signature'] != files_signature(event_files(event)):
+        with registry_lock:
+            entry = event_registry.get(event)
+            if entry is None or entry['signature'] != files_signature(event_files(event)):
+                entry = load_event(event)
+                event_registry[event] = entry
+    return entry
+
+
+
+def reload_event(event):
+    """
+    Drop the cached data of an event so it is reloaded on next use.
+    """
+    with registry_lock:
+        event_registry.pop(event.lower(), None)
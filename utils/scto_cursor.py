@@ -0,0 +1,180 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+from config.config import *
+
+
+
+# One lock per form, so syncs of the same form never overlap
+form_locks = {}
+form_locks_lock = threading.Lock()
+
+# Format of CompletionDate and SubmissionDate in SurveyCTO's JSON export (UTC)
+SCTO_DATE_FORMAT = "%b %d, %Y %I:%M:%S %p"
+
+
+
+def form_lock(form_id):
+    """
+    Return the lock guarding the sync cursor of a form.
+    """
+    with form_locks_lock:
+        return form_locks.setdefault(form_id, threading.Lock())
+
+
+
+def load_cursor(form_id):
+    """
+    Load the sync cursor of a form: the latest processed CompletionDate (UTC, ISO format), the date
+    the API's oldest_completion_date filters on, the processed submission KEYs with their
+    fingerprint and CompletionDate, and the failed submission KEYs (see `record_failure`).
+    """
+    try:
+        with open(f'{local_disk}/cursor_{form_id}.json', 'r') as json_file:
+            cursor = json.load(json_file)
+    except FileNotFoundError:
+        return {'last_completion': None, 'processed': {}, 'failed': {}}
+    # Cursors written before they tracked CompletionDate hold the (earlier) SubmissionDate
+    if 'last_completion' not in cursor:
+        cursor['last_completion'] = cursor.pop('last_submission', None)
+    cursor.setdefault('failed', {})
+    return cursor
+
+
+
+def save_cursor(form_id, cursor):
+    """
+    Write the sync cursor of a form, dropping KEYs that fall before the fetch window.
+    Failed submissions still to be retried hold the cursor back to their CompletionDate, so they stay in the window.
+    """
+    retrying = [failure['completed'] for failure in cursor['failed'].values() if failure['attempts'] < SCTO_MAX_ATTEMPTS]
+    if cursor['last_completion'] and retrying:
+        cursor['last_completion'] = min(cursor['last_completion'], min(retrying))
+    if cursor['last_completion']:
+        oldest = (datetime.fromisoformat(cursor['last_completion']) - timedelta(seconds=SCTO_CURSOR_OVERLAP)).isoformat()
+        cursor['processed'] = {k: v for k, v in cursor['processed'].items() if v[1] >= oldest}
+    tmp_path = f'{local_disk}/cursor_{form_id}.json.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(cursor, json_file)
+    os.replace(tmp_path, f'{local_disk}/cursor_{form_id}.json')
+
+
+
+def fetch_window_start(cursor, input_time):
+    """
+    Return the oldest completion date to fetch: the cursor minus SCTO_CURSOR_OVERLAP (a few minutes, for
+    submissions completed while the previous fetch ran), or 301 seconds before `input_time` on the first sync.
+    The cursor is a CompletionDate, the date the fetch filters on, so late uploads from offline devices
+    are fetched without a wider overlap.
+    """
+    if cursor['last_completion']:
+        return datetime.fromisoformat(cursor['last_completion']) - timedelta(seconds=SCTO_CURSOR_OVERLAP)
+    return input_time - timedelta(seconds=301)
+
+
+
+def completion_date(data):
+    """
+    Return the CompletionDate of a submission (UTC) in ISO format, or its SubmissionDate when the export has none.
+    """
+    return datetime.strptime(data.get('CompletionDate') or data['SubmissionDate'], SCTO_DATE_FORMAT).isoformat()
+
+
+
+def submission_fingerprint(data):
+    """
+    Hash a submission, so changed (e.g. reviewed and corrected) submissions are processed again.
+    """
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+
+def record_failure(cursor, data, fingerprint, error):
+    """
+    Record a failed submission in a sync cursor with its error and number of attempts (counted again
+    from 1 when the submission changed). Submissions are given up after SCTO_MAX_ATTEMPTS attempts.
+    """
+    failure = cursor['failed'].get(data['KEY'])
+    if failure is None or failure['fingerprint'] != fingerprint:
+        failure = {'fingerprint': fingerprint, 'completed': completion_date(data), 'attempts': 0}
+    failure.update(attempts=failure['attempts'] + 1, error=error, updated=datetime.utcnow().isoformat())
+    cursor['failed'][data['KEY']] = failure
+    return failure
+
+
+
+def given_up(cursor, key, fingerprint):
+    """
+    Whether a submission failed SCTO_MAX_ATTEMPTS times without changing since.
+    """
+    failure = cursor['failed'].get(key)
+    return failure is not None and failure['fingerprint'] == fingerprint and failure['attempts'] >= SCTO_MAX_ATTEMPTS
+
+
+
+# Active forms polled by the built-in SurveyCTO poller, keyed by form_id
+scto_forms_lock = threading.Lock()
+
+
+
+def load_forms():
+    """
+    Load the registry of active forms (event, form_id, n_candidate, proc_id_a4 and poll schedule).
+    """
+    try:
+        with open(f'{local_disk}/scto_forms.json', 'r') as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+
+
+
+def save_forms(forms):
+    """
+    Write the registry of active forms.
+    """
+    tmp_path = f'{local_disk}/scto_forms.json.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(forms, json_file, default=str)
+    os.replace(tmp_path, f'{local_disk}/scto_forms.json')
+
+
+
+def update_form(form_id, create=True, **fields):
+    """
+    Add or update a form in the registry of active forms. With create=False, forms that are
+    no longer registered are left out (returns None).
+    """
+    with scto_forms_lock:
+        forms = load_forms()
+        if form_id not in forms and not create:
+            return None
+        forms.setdefault(form_id, {}).update(fields)
+        save_forms(forms)
+        return forms[form_id]
+
+
+
+def unregister_form(form_id):
+    """
+    Remove a form from the registry of active forms.
+    """
+    with scto_forms_lock:
+        forms = load_forms()
+        removed = forms.pop(form_id, None)
+        save_forms(forms)
+        return removed
+
+
+
+def next_interval(interval, n_new):
+    """
+    Adapt a form's poll interval to its submission arrival rate: halve it when new submissions
+    came in, grow it by half when none did, within [SCTO_POLL_MIN, SCTO_POLL_MAX] seconds.
+    """
+    if n_new > 0:
+        return max(SCTO_POLL_MIN, interval / 2)
+    return min(SCTO_POLL_MAX, interval * 1.5)
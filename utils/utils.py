@@ -1,33 +1,96 @@
 import os
 import json
-from fastapi import Form
+from typing import Optional
+from fastapi import Form, Query
+from fastapi.responses import StreamingResponse
 from config.config import *
+from utils.journal import sms_journal, wa_journal
+from utils.registry import get_event, reload_event
+from utils.votes_store import drop_votes
+from utils.scto_cursor import unregister_form
 
 
 
-async def read_sms_inbox():
+def inbox_filter(record, start=None, end=None, port=None, sender=None, event=None):
     """
-    Reads the SMS inbox from a JSON file and returns the data.
+    Check whether an inbox record matches the given filters.
     """
-    try:
-        with open(f"{local_disk}/sms_inbox.json", "r") as json_file:
-            data = [json.loads(line) for line in json_file]
-        return {"sms_inbox": data}
-    except FileNotFoundError:
-        return {"message": "File not found"}
+    receive_date = record.get('Receive Date') or ''
+    if start and receive_date < start:
+        return False
+    if end and receive_date > end:
+        return False
+    if port and str(record.get('Gateway Port')) != port:
+        return False
+    if sender and record.get('Sender') != sender:
+        return False
+    if event:
+        info = [part.strip() for part in (record.get('Message') or '').lower().split('#')]
+        if len(info) < 3 or info[0] != 'kk' or info[2] != event.lower():
+            return False
+    return True
 
 
 
-async def read_wa_inbox():
+def stream_inbox(journal, cursor, limit, start, end, port, sender, event):
     """
-    Reads the WhatsApp inbox from a JSON file and returns the data.
+    Stream matching inbox records as NDJSON, followed by a line with the cursor of the next page.
     """
-    try:
-        with open(f"{local_disk}/wa_inbox.json", "r") as json_file:
-            data = [json.loads(line) for line in json_file]
-        return {"wa_inbox": data}
-    except FileNotFoundError:
-        return {"message": "File not found"}
+    sources = journal.snapshot()
+    end_seq = sources[-1]['first_seq'] + sources[-1]['count']
+
+    def ndjson_generator():
+        next_cursor = max(cursor, end_seq)
+        n = 0
+        for seq, record in journal.read(sources, cursor, start, end):
+            if inbox_filter(record, start, end, port, sender, event):
+                yield json.dumps(dict(record, Seq=seq)) + '\n'
+                n += 1
+                if n >= limit:
+                    next_cursor = seq + 1
+                    break
+        yield json.dumps({"next_cursor": next_cursor}) + '\n'
+
+    return StreamingResponse(ndjson_generator(), media_type='application/x-ndjson')
+
+
+
+async def read_sms_inbox(
+    cursor: int = 0,
+    limit: int = Query(1000, ge=1, le=10000),
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    port: Optional[str] = None,
+    sender: Optional[str] = None,
+    event: Optional[str] = None,
+):
+    """
+    Reads the SMS inbox journal page by page and streams it as NDJSON.
+
+    Parameters:
+    - cursor: Sequence number to start from (the `next_cursor` of the previous page).
+    - limit: Maximum number of records in the page.
+    - start, end: Receive date range, 'YYYY-MM-DD HH:MM:SS'.
+    - port, sender, event: Gateway port, sender number and EventID filters.
+    """
+    return stream_inbox(sms_journal, cursor, limit, start, end, port, sender, event)
+
+
+
+async def read_wa_inbox(
+    cursor: int = 0,
+    limit: int = Query(1000, ge=1, le=10000),
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    port: Optional[str] = None,
+    sender: Optional[str] = None,
+    event: Optional[str] = None,
+):
+    """
+    Reads the WhatsApp inbox journal page by page and streams it as NDJSON.
+    Takes the same parameters as `read_sms_inbox`.
+    """
+    return stream_inbox(wa_journal, cursor, limit, start, end, port, sender, event)
 
 
 
@@ -36,6 +99,9 @@ async def delete_event(event: str = Form(...), form_id: str = Form(...)):
     event = event.lower()
     os.system(f'rm -f {local_disk}/*_{event}.*')
     os.system(f'rm -f {local_disk}/*_{form_id}.*')
+    reload_event(event)
+    drop_votes(event)
+    unregister_form(form_id)
 
 
 # Function to create a JSON file with the number of candidates for a given event
@@ -43,5 +109,8 @@ async def create_json_ncandidate(event: str = Form(...), N_candidate: int = Form
     event = event.lower()
     with open(f'{local_disk}/event_{event}.json', 'w') as json_file:
         json.dump({"n_candidate": N_candidate}, json_file)
+    reload_event(event)
+    # Compile the event's message spec right away
+    get_event(event)
 
 
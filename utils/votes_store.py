@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+
+from config.config import *
+from utils.outbox import bubble_session, pending_keys
+
+
+
+# Fields of the Votes table used by SMS, WhatsApp and SCTO processing
+VOTES_FIELDS = [
+    '_id', 'UID', 'Event ID', 'SMS', 'SMS Timestamp', 'SCTO', 'SCTO Votes', 'SCTO Invalid', 'SCTO Timestamp',
+    'Validator', 'Provinsi', 'Kab/Kota', 'Kecamatan', 'Kelurahan', 'Modified Date'
+]
+
+# Local mirror of the Votes table: event -> UID -> row
+votes_store = {}
+votes_store_lock = threading.Lock()
+
+# Fields of local writes newer than this (seconds) are kept when a reconciliation pull returns older data
+VOTES_SYNC_GRACE = 120
+
+# Reconciliation pulls rows modified since the newest mirrored 'Modified Date' minus this margin (seconds)
+VOTES_SYNC_OVERLAP = 60
+
+# Offset from UTC of the local (WIB) times of SMS and SCTO timestamps
+LOCAL_UTC_OFFSET = timedelta(hours=7)
+
+
+
+def bubble_date(value, local=False):
+    """
+    Format a timestamp the way Bubble returns dates (UTC), converting it from local time (WIB) when `local`.
+    """
+    if isinstance(value, str):
+        value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    if local:
+        value = value - LOCAL_UTC_OFFSET
+    return value.strftime("%Y-%m-%dT%H:%M:%S.") + f'{value.microsecond // 1000:03d}Z'
+
+
+
+def compact_row(row):
+    """
+    Keep only the Votes fields used by the server.
+    """
+    return {k: row[k] for k in VOTES_FIELDS if k in row}
+
+
+
+def fetch_votes(event, modified_after=None):
+    """
+    Pull every Votes row of an event from Bubble, page by page, or only the rows modified after a Bubble date.
+    """
+    filter_params = [{"key": "Event ID", "constraint_type": "equals", "value": event}]
+    if modified_after:
+        filter_params.append({"key": "Modified Date", "constraint_type": "greater than", "value": modified_after})
+    rows = []
+    cursor = 0
+    while True:
+        params = {"constraints": json.dumps(filter_params), "cursor": cursor, "limit": 100}
+        res = bubble_session.get(f'{url_bubble}/Votes', headers=headers, params=params, timeout=60)
+        res.raise_for_status()
+        out = res.json()['response']
+        rows.extend(compact_row(row) for row in out['results'])
+        cursor += len(out['results'])
+        if out.get('remaining', 0) <= 0 or len(out['results']) == 0:
+            break
+    return rows
+
+
+
+def save_votes(event):
+    """
+    Write the snapshot of an event's Votes rows to the local disk.
+    """
+    with votes_store_lock:
+        rows = list(votes_store.get(event, {}).values())
+    tmp_path = f'{local_disk}/votes_{event}.json.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(rows, json_file, default=str)
+    os.replace(tmp_path, f'{local_disk}/votes_{event}.json')
+
+
+
+def load_votes(event):
+    """
+    Load the snapshot of an event's Votes rows into memory (once).
+    """
+    if event in votes_store:
+        return votes_store[event]
+    rows = []
+    try:
+        with open(f'{local_disk}/votes_{event}.json', 'r') as json_file:
+            rows = json.load(json_file)
+    except FileNotFoundError:
+        pass
+    with votes_store_lock:
+        if event not in votes_store:
+            votes_store[event] = {row['UID'].upper(): row for row in rows}
+    return votes_store[event]
+
+
+
+def merge_votes(event, rows, pull_start, replace=False):
+    """
+    Apply rows pulled from Bubble to the local Votes rows of an event (replacing all of them when `replace`),
+    field by field: the fields of our own writes that Bubble may not have applied yet (still in the outbox,
+    or written within VOTES_SYNC_GRACE seconds of the pull) keep their local value, the others take Bubble's.
+    """
+    unsent = pending_keys()
+    with votes_store_lock:
+        current = votes_store.get(event, {})
+        merged = {} if replace else current
+        for row in rows:
+            uid = row['UID'].upper()
+            local = current.get(uid)
+            if local and local.get('_local_fields'):
+                pending = f"{url_bubble}/votes/{row.get('_id')}" in unsent
+                kept = {k: ts for k, ts in local['_local_fields'].items() if pending or ts > pull_start - VOTES_SYNC_GRACE}
+                if kept:
+                    row = dict(row, _local_fields=kept)
+                    row.update((k, local[k]) for k in kept if k in local)
+            merged[uid] = row
+        votes_store[event] = merged
+
+
+
+def seed_votes(event):
+    """
+    Replace the local Votes rows of an event with a full pull from Bubble.
+    """
+    event = event.lower()
+    pull_start = time.time()
+    rows = fetch_votes(event)
+    merge_votes(event, rows, pull_start, replace=True)
+    save_votes(event)
+    return len(rows)
+
+
+
+def sync_votes(event):
+    """
+    Pull the Votes rows of an event modified since the newest mirrored row (a full pull when nothing
+    is mirrored yet, or the mirror predates 'Modified Date'). Returns the number of rows pulled.
+    """
+    event = event.lower()
+    load_votes(event)
+    with votes_store_lock:
+        rows = votes_store.get(event, {})
+        newest = max((row['Modified Date'] for row in rows.values() if row.get('Modified Date')), default=None)
+    if newest is None:
+        return seed_votes(event)
+    since = datetime.strptime(newest, "%Y-%m-%dT%H:%M:%S.%fZ") - timedelta(seconds=VOTES_SYNC_OVERLAP)
+    pull_start = time.time()
+    changed = fetch_votes(event, modified_after=bubble_date(since))
+    if changed:
+        merge_votes(event, changed, pull_start)
+        save_votes(event)
+    return len(changed)
+
+
+
+def get_votes_row(event, uid):
+    """
+    Return the Votes row of a UID within an event, asking Bubble only when the row is not mirrored yet.
+    Returns None when the UID has no Votes row.
+    """
+    event, uid = event.lower(), uid.upper()
+    row = load_votes(event).get(uid)
+    if row is None:
+        filter_params = [
+            {"key": "UID", "constraint_type": "equals", "value": uid},
+            {"key": "Event ID", "constraint_type": "equals", "value": event}
+        ]
+        res = bubble_session.get(f'{url_bubble}/Votes', headers=headers, params={"constraints": json.dumps(filter_params), "limit": 1}, timeout=60)
+        res.raise_for_status()
+        results = res.json()['response']['results']
+        if not results:
+            return None
+        row = compact_row(results[0])
+        with votes_store_lock:
+            votes_store.setdefault(event, {})[uid] = row
+    return row
+
+
+
+def prefetch_votes(event, uids):
+    """
+    Mirror the Votes rows of several UIDs of one event that are not mirrored yet, 100 per Bubble request.
+    """
+    event = event.lower()
+    load_votes(event)
+    with votes_store_lock:
+        missing = sorted(set(uid.upper() for uid in uids) - set(votes_store.get(event, {})))
+    for start in range(0, len(missing), 100):
+        filter_params = [
+            {"key": "UID", "constraint_type": "in", "value": missing[start:start + 100]},
+            {"key": "Event ID", "constraint_type": "equals", "value": event}
+        ]
+        res = bubble_session.get(f'{url_bubble}/Votes', headers=headers, params={"constraints": json.dumps(filter_params), "limit": 100}, timeout=60)
+        res.raise_for_status()
+        with votes_store_lock:
+            rows = votes_store.setdefault(event, {})
+            for row in res.json()['response']['results']:
+                rows[row['UID'].upper()] = compact_row(row)
+
+
+
+def record_votes_write(event, uid, payload):
+    """
+    Apply a write we sent to Bubble to the local Votes row, recording when each changed field was written (see `merge_votes`).
+    Fields without a value are skipped, as they are not sent to Bubble either.
+    """
+    event, uid = event.lower(), uid.upper()
+    load_votes(event)
+    now = time.time()
+    with votes_store_lock:
+        # Looked up under the lock, as seed_votes may have swapped in a fresh dict meanwhile
+        rows = votes_store.setdefault(event, {})
+        row = dict(rows.get(uid, {'UID': uid, 'Event ID': event}))
+        written = dict(row.get('_local_fields', {}))
+        for k in VOTES_FIELDS:
+            if payload.get(k) is None:
+                continue
+            value = payload[k]
+            if k in ['SMS Timestamp', 'SCTO Timestamp']:
+                try:
+                    value = bubble_date(value, local=True)
+                except ValueError:
+                    pass
+            # Values echoed back unchanged (e.g. Validator) are left to Bubble
+            if row.get(k) != value:
+                row[k] = value
+                written[k] = now
+        row['_local_fields'] = written
+        rows[uid] = row
+
+
+
+def drop_votes(event):
+    """
+    Forget the local Votes rows of an event.
+    """
+    with votes_store_lock:
+        votes_store.pop(event.lower(), None)
+
+
+
+def reconcile_votes():
+    """
+    Refresh the local Votes rows of every event that has a UID mapping on the local disk,
+    pulling only the rows modified since the last refresh.
+    """
+    for file_name in os.listdir(local_disk):
+        if file_name.startswith('uid_') and file_name.endswith('.json'):
+            event = file_name[len('uid_'):-len('.json')]
+            try:
+                sync_votes(event)
+            except Exception as e:
+                print(f'Failed to reconcile votes for event {event}: {e}')
@@ -0,0 +1,109 @@
+import os
+import re
+import time
+import threading
+from datetime import datetime
+from fastapi.responses import JSONResponse
+
+from config.config import *
+from utils.lazy import geodata
+from utils.registry import get_event
+from utils.votes_store import load_votes
+
+
+
+# Warm-up state: status (pending, warming, ready), and duration and error of each step
+warmup_state = {'status': 'pending', 'started': None, 'finished': None, 'steps': {}}
+warmup_lock = threading.Lock()
+process_started = time.time()
+
+
+
+def list_events():
+    """
+    Return the events created on the local disk.
+    """
+    return sorted(m.group(1) for m in (re.match(r'event_(.+)\.json$', name) for name in os.listdir(local_disk)) if m)
+
+
+
+def warm_events():
+    """
+    Load every event (n_candidate, message spec, UIDs, UID -> Bubble id) and its local Votes rows.
+    """
+    events = list_events()
+    for event in events:
+        get_event(event)
+        load_votes(event)
+    return {'events': len(events)}
+
+
+
+def warm_geodata():
+    """
+    Load the geodata cache (building it when the source files changed), the region tree and the region index.
+    """
+    data = geodata.get_geodata()
+    geodata.get_region_data()
+    geodata.region_position(())
+    return {'polygons': data['count']}
+
+
+
+# Warm-up steps, run in order
+WARMUP_FUNCTIONS = {
+    'events': warm_events,
+    'geodata': warm_geodata,
+}
+
+
+
+def run_warmup():
+    """
+    Run the warm-up steps listed in WARMUP_STEPS, timing each one. A failed step is reported
+    but does not keep the worker from becoming ready.
+    """
+    with warmup_lock:
+        warmup_state.update(status='warming', started=datetime.now().isoformat())
+    for name in WARMUP_STEPS:
+        if name not in WARMUP_FUNCTIONS:
+            continue
+        start = time.time()
+        step = {}
+        try:
+            step['result'] = WARMUP_FUNCTIONS[name]()
+        except Exception as e:
+            print(f'Process: warm-up {name}\t Keyword: {e}')
+            step['error'] = str(e)
+        step['seconds'] = time.time() - start
+        print(f'Process: warm-up {name}\t {step["seconds"]:.3f} s')
+        with warmup_lock:
+            warmup_state['steps'][name] = step
+    with warmup_lock:
+        warmup_state.update(status='ready', finished=datetime.now().isoformat())
+
+
+
+def start_warmup():
+    """
+    Start the warm-up in the background, so the liveness endpoint answers meanwhile.
+    """
+    threading.Thread(target=run_warmup, daemon=True).start()
+
+
+
+async def liveness():
+    """
+    Liveness probe: the worker is up and its event loop responds.
+    """
+    return {'status': 'alive', 'uptime': time.time() - process_started}
+
+
+
+async def readiness():
+    """
+    Readiness probe: 200 once the warm-up finished, 503 (with the warm-up progress) before.
+    """
+    with warmup_lock:
+        state = dict(warmup_state, steps=dict(warmup_state['steps']))
+    return JSONResponse(status_code=200 if state['status'] == 'ready' else 503, content=state)